@@ -0,0 +1,217 @@
+"""
+Backfill / replay das conversões (UTMify e Meta CAPI) de um intervalo.
+
+Pagina a Stripe (checkout.Session.list ou Event.list), remonta os mesmos
+payloads do webhook (pelo ledger de pedidos; pedido já pago no ledger não
+vai na Stripe de novo) e envia direto aos destinos com paralelismo limitado
+e um token bucket por destino. O cursor de cada página concluída fica no
+SQLite (checkpoint): rodar de novo com os mesmos argumentos continua de
+onde parou. Envio que falhar vai para o outbox, e o app tenta de novo.
+
+    python backfill.py --since 2025-09-01 --until 2025-09-02
+    python backfill.py --since 2025-09-01T12:00 --until 2025-09-01T18:00 --source events --dest utmify --rate 5
+
+--dry-run monta tudo mas não envia, não grava checkpoint e não grava
+pedidos no ledger (orders.preview). Para testar sem a Stripe de verdade,
+aponte --stripe-api-base para um stub local (ex.: bench/fake_stripe.py,
+usado por bench/backfill_replay.py).
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+
+import stripe
+
+import hydrate
+import main as app
+import orders
+import outbox
+import store
+from resilience import TokenBucket
+from upstreams import stripe_call
+
+BACKFILL_RATE        = float(os.getenv("BACKFILL_RATE", "10"))       # envios/s por destino
+BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "8"))
+PAGE_SIZE            = 100
+
+EVENT_TYPES = ["checkout.session.completed", "payment_intent.succeeded"]
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    run_id     TEXT PRIMARY KEY,
+    cursor     TEXT,
+    orders     INTEGER NOT NULL DEFAULT 0,
+    sent       INTEGER NOT NULL DEFAULT 0,
+    failed     INTEGER NOT NULL DEFAULT 0,
+    done       INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+""")
+
+
+def _load_checkpoint(run_id: str) -> dict:
+    row = store.connect().execute("SELECT * FROM backfill_checkpoints WHERE run_id = ?", (run_id,)).fetchone()
+    return dict(row) if row else {"cursor": None, "orders": 0, "sent": 0, "failed": 0, "done": 0}
+
+
+def _save_checkpoint(run_id: str, cp: dict):
+    store.connect().execute(
+        "INSERT OR REPLACE INTO backfill_checkpoints (run_id, cursor, orders, sent, failed, done, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (run_id, cp["cursor"], cp["orders"], cp["sent"], cp["failed"], cp["done"], time.time()),
+    )
+
+
+def _list_page(source: str, since: float, until: float, cursor: str):
+    """Uma página (mais novo primeiro). Síncrona: rode via stripe_call."""
+    params = {"created": {"gte": int(since), "lt": int(until)}, "limit": PAGE_SIZE}
+    if cursor:
+        params["starting_after"] = cursor
+    if source == "sessions":
+        return stripe.checkout.Session.list(status="complete", **params)
+    return stripe.Event.list(types=EVENT_TYPES, **params)
+
+
+async def _order_for(source: str, item, save: bool = True):
+    """Pedido pago (do ledger ou remontado da Stripe) para um item da página, ou None.
+
+    Com save=False (dry-run) o pedido remontado não é gravado no ledger.
+    """
+    if source == "events":
+        obj, approved_at = item.data.object, item.created
+        is_upsell = item.type == "payment_intent.succeeded"
+        if is_upsell and (obj.get("metadata") or {}).get("upsell") != "true":
+            return None
+    else:
+        obj, approved_at, is_upsell = item, item.created, False
+        if obj.get("payment_status") not in (None, "paid"):
+            return None
+
+    known = orders.get(obj.id)
+    if known is not None and known["status"] == "paid":
+        return known
+    hydrator = hydrate.Hydrator({"data": {"object": obj}})
+    if is_upsell:
+        return await app.record_upsell_paid(hydrator, approved_at=approved_at, save=save)
+    return app.record_checkout_paid(obj, await hydrator.line_items(obj.id), approved_at=approved_at, save=save)
+
+
+class Backfill:
+    def __init__(self, source: str, since: float, until: float, destinations: tuple,
+                 rate: float = BACKFILL_RATE, concurrency: int = BACKFILL_CONCURRENCY, dry_run: bool = False):
+        self.source = source
+        self.since = since
+        self.until = until
+        self.destinations = destinations
+        self.dry_run = dry_run
+        self.run_id = f"{source}:{int(since)}:{int(until)}:{','.join(sorted(destinations))}"
+        self.buckets = {dest: TokenBucket(rate) for dest in destinations}
+        self.limit = asyncio.Semaphore(concurrency)
+
+    async def _send(self, dest: str, order: dict, cp: dict):
+        if dest == "capi":
+            payload = orders.capi_event(order, order["capi_event"] or "Purchase")
+        else:
+            payload = orders.utmify_order(order)
+        if self.dry_run:
+            cp["sent"] += 1
+            return
+        await self.buckets[dest].acquire()
+        try:
+            resp = await outbox.SENDERS[dest](payload)
+            ok = resp.status_code < 300
+            error = f"HTTP {resp.status_code}: {resp.text[:200]}"
+        except Exception as e:
+            ok, error = False, repr(e)
+        if ok:
+            cp["sent"] += 1
+        else:
+            # o app reenvia com retry/backoff
+            outbox.enqueue(dest, payload, label=f"backfill {order['order_id']}")
+            cp["failed"] += 1
+            print(f"‼️ backfill {dest} {order['order_id']}: {error} (foi para o outbox)")
+
+    async def _process(self, item, cp: dict):
+        async with self.limit:
+            order = await _order_for(self.source, item, save=not self.dry_run)
+            if order is None:
+                return
+            cp["orders"] += 1
+            await asyncio.gather(*(self._send(dest, order, cp) for dest in self.destinations))
+
+    async def run(self, restart: bool = False, max_pages: int = None) -> dict:
+        cp = _load_checkpoint(self.run_id)
+        if restart:
+            cp = {"cursor": None, "orders": 0, "sent": 0, "failed": 0, "done": 0}
+        if cp["done"]:
+            print(f"→ backfill {self.run_id} já concluído (use --restart para refazer)")
+            return cp
+        if cp["cursor"]:
+            print(f"→ retomando {self.run_id} depois de {cp['cursor']} ({cp['orders']} pedidos já enviados)")
+
+        started, start_orders, pages = time.monotonic(), cp["orders"], 0
+        while max_pages is None or pages < max_pages:
+            page = await stripe_call(_list_page, self.source, self.since, self.until, cp["cursor"])
+            await asyncio.gather(*(self._process(item, cp) for item in page.data))
+            pages += 1
+            if page.data:
+                cp["cursor"] = page.data[-1].id
+            cp["done"] = int(not page.has_more)
+            if not self.dry_run:
+                _save_checkpoint(self.run_id, cp)
+            elapsed = time.monotonic() - started
+            print(
+                f"→ página {pages}: {cp['orders']} pedidos, {cp['sent']} envios, {cp['failed']} falhas "
+                f"({(cp['orders'] - start_orders) / max(elapsed, 1e-9):.1f} pedidos/s)"
+            )
+            if cp["done"]:
+                break
+        return cp
+
+
+def _date(value: str) -> float:
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Backfill/replay de conversões para UTMify e Meta CAPI")
+    parser.add_argument("--since", required=True, help="início (UTC, ISO), ex.: 2025-09-01 ou 2025-09-01T12:00")
+    parser.add_argument("--until", required=True, help="fim exclusivo (UTC, ISO)")
+    parser.add_argument("--source", choices=("sessions", "events"), default="sessions",
+                        help="sessions: checkouts pagos; events: checkouts + upsells (Event.list, últimos 30 dias)")
+    parser.add_argument("--dest", choices=("utmify", "capi"), action="append", help="padrão: os dois")
+    parser.add_argument("--rate", type=float, default=BACKFILL_RATE, help="envios/s por destino")
+    parser.add_argument("--concurrency", type=int, default=BACKFILL_CONCURRENCY)
+    parser.add_argument("--max-pages", type=int, help="para depois de N páginas (o checkpoint guarda o resto)")
+    parser.add_argument("--restart", action="store_true", help="ignora o checkpoint e começa do zero")
+    parser.add_argument("--dry-run", action="store_true", help="não envia nem grava pedidos/checkpoint")
+    parser.add_argument("--stripe-api-base", help="ex.: stub local http://127.0.0.1:12111")
+    args = parser.parse_args(argv)
+
+    stripe.api_key = app.STRIPE_SECRET_KEY
+    if args.stripe_api_base:
+        stripe.api_base = args.stripe_api_base
+
+    async def _run():
+        backfill = Backfill(
+            args.source, _date(args.since), _date(args.until), tuple(args.dest or ("utmify", "capi")),
+            rate=args.rate, concurrency=args.concurrency, dry_run=args.dry_run,
+        )
+        try:
+            return await backfill.run(restart=args.restart, max_pages=args.max_pages)
+        finally:
+            await app.upstreams.aclose()
+
+    started = time.monotonic()
+    cp = asyncio.run(_run())
+    elapsed = time.monotonic() - started
+    status = "concluído" if cp["done"] else "interrompido (rode de novo para continuar)"
+    print(f"→ backfill {status}: {cp['orders']} pedidos, {cp['sent']} envios, {cp['failed']} falhas em {elapsed:.1f}s"
+          + (" [dry-run]" if args.dry_run else ""))
+    return cp
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Backfill/replay (backfill.py) contra o Stripe fake.
+
+Semeia checkouts e upsells num intervalo, roda um --dry-run, depois um
+backfill real parado no meio (--max-pages) e retomado pelo checkpoint.
+Confere que cada pedido chegou uma única vez na UTMify e na CAPI e mede a
+vazão com o rate limit configurado.
+
+    python bench/backfill_replay.py --sessions 250 --upsells 50 --rate 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import fake_stripe
+from fakes import serve_in_background
+
+RECEIVED = {"graph": Counter(), "utmify": Counter()}
+SINCE, UNTIL = "2025-09-01", "2025-09-02"
+
+
+async def fake_graph_events(request):
+    body = await request.json()
+    for event in body.get("data", []):
+        RECEIVED["graph"][event["event_id"]] += 1
+    return JSONResponse({"events_received": len(body.get("data", []))})
+
+
+async def fake_utmify(request):
+    RECEIVED["utmify"][(await request.json())["orderId"]] += 1
+    return JSONResponse({"ok": True})
+
+
+def seed(sessions: int, upsells: int) -> set:
+    start = int(time.mktime(time.strptime(SINCE, "%Y-%m-%d"))) - time.timezone
+    step = 86400 // max(sessions + upsells, 1)
+    ids = set()
+    fake_stripe.seed_price("price_upsell", amount=2700, name="Upsell")
+    for i in range(sessions):
+        ids.add(fake_stripe.seed_session("price_main", created=start + i * step)["id"])
+    for i in range(upsells):
+        ids.add(fake_stripe.seed_payment_intent("price_upsell", created=start + (sessions + i) * step)["id"])
+    # fora do intervalo: não pode sair
+    fake_stripe.seed_session("price_main", created=start - 60)
+    fake_stripe.seed_session("price_main", created=start + 86400)
+    return ids
+
+
+def backfill(*args):
+    import backfill as cli
+    started = time.perf_counter()
+    cp = cli.main(["--since", SINCE, "--until", UNTIL, "--source", "events", *args])
+    return cp, time.perf_counter() - started
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sessions", type=int, default=250)
+    parser.add_argument("--upsells", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=200, help="envios/s por destino")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="latência do Stripe fake (s)")
+    args = parser.parse_args()
+    fake_stripe.LATENCY = args.latency
+
+    port = serve_in_background(Starlette(routes=[
+        *fake_stripe.app.routes,
+        Route("/graph/{pixel}/events", fake_graph_events, methods=["POST"]),
+        Route("/utmify", fake_utmify, methods=["POST"]),
+    ]))
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "PIXEL_ID":          "bench",
+        "ACCESS_TOKEN":      "bench",
+        "GRAPH_API_URL":     f"{base}/graph",
+        "UTMIFY_API_URL":    f"{base}/utmify",
+        "UTMIFY_API_KEY":    "bench",
+        "STATE_DB_PATH":     os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    expected = seed(args.sessions, args.upsells)
+    common = ["--stripe-api-base", base, "--rate", str(args.rate), "--concurrency", str(args.concurrency)]
+
+    cp, elapsed = backfill("--dry-run", *common)
+    import orders
+    written = len(orders.between(0, float("inf")))
+    print(f"dry-run: {cp['orders']} pedidos em {elapsed:.2f}s; enviados de verdade: "
+          f"{sum(RECEIVED['utmify'].values())}, gravados no ledger: {written} (esperado 0 e 0)")
+    dry_ok = cp["orders"] == len(expected) and not RECEIVED["utmify"] and not RECEIVED["graph"] and not written
+
+    fake_stripe.CALLS.clear()
+    cp, first = backfill("--max-pages", "1", *common)
+    cp, rest = backfill(*common)
+    total = first + rest
+    print(f"backfill: {cp['orders']} pedidos, {cp['sent']} envios em {total:.2f}s "
+          f"({cp['sent'] / total:.0f} envios/s com --rate {args.rate:g} por destino)")
+    print(f"chamadas à Stripe: {dict(fake_stripe.CALLS)}")
+
+    dupes = {dest: [k for k, n in c.items() if n > 1] for dest, c in RECEIVED.items()}
+    missing = {dest: expected - set(c) for dest, c in RECEIVED.items()}
+    if not dry_ok or any(dupes.values()) or any(missing.values()) or cp["failed"]:
+        print(f"‼️ esperado cada pedido exatamente uma vez por destino; "
+              f"duplicados={ {d: len(v) for d, v in dupes.items()} } faltando={ {d: len(v) for d, v in missing.items()} }")
+        sys.exit(1)
+    print("ok: cada pedido chegou exatamente uma vez na UTMify e na CAPI")
+
+
+if __name__ == "__main__":
+    main_()
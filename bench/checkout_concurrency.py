@@ -0,0 +1,132 @@
+"""
+Load test: checkouts concorrentes com upstreams lentos.
+
+Sobe um fake local (Stripe + Graph + UTMify) com latência fixa e dispara N
+POSTs simultâneos em /create-checkout-session. Com o I/O assíncrono o tempo
+total fica perto da latência de UMA requisição, não de N em série; o
+tracking (Graph/UTMify) sai pelo outbox depois da resposta.
+
+    python bench/checkout_concurrency.py --requests 20 --latency 0.3
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from fakes import serve_in_background
+
+LATENCY = 0.3
+
+
+async def fake_checkout_session(request):
+    await asyncio.sleep(LATENCY)
+    form = urllib.parse.parse_qs((await request.body()).decode())
+    price_id = form.get("line_items[0][price]", ["price_bench"])[0]
+    sid = f"cs_test_{time.monotonic_ns()}"
+    return JSONResponse({
+        "id": sid,
+        "object": "checkout.session",
+        "url": f"https://checkout.stripe.com/c/pay/{sid}",
+        "currency": "usd",
+        "amount_total": 1000,
+        "created": int(time.time()),
+        "customer_details": None,
+        "metadata": {},
+        "line_items": {
+            "object": "list",
+            "data": [{
+                "id": "li_bench",
+                "object": "item",
+                "description": "Bench item",
+                "quantity": 1,
+                "amount_subtotal": 1000,
+                "price": {"id": price_id, "object": "price", "nickname": None},
+            }],
+        },
+    })
+
+
+async def fake_graph_events(request):
+    await asyncio.sleep(LATENCY)
+    body = await request.json()
+    return JSONResponse({"events_received": len(body.get("data", []))})
+
+
+async def fake_ok(request):
+    await asyncio.sleep(LATENCY)
+    return JSONResponse({"ok": True})
+
+
+fake_app = Starlette(routes=[
+    Route("/v1/checkout/sessions", fake_checkout_session, methods=["POST"]),
+    Route("/graph/{pixel}/events", fake_graph_events, methods=["POST"]),
+    Route("/utmify", fake_ok, methods=["POST"]),
+])
+
+
+async def run(n: int):
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app, client=("127.0.0.1", 1234))
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            async def one(i):
+                resp = await client.post("/create-checkout-session", json={"price_id": f"price_{i}"})
+                resp.raise_for_status()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(n)))
+            elapsed = time.perf_counter() - started
+
+        # espera o outbox drenar (2 eventos por checkout)
+        while main.outbox.store.connect().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]:
+            await asyncio.sleep(0.05)
+        drained = time.perf_counter() - started
+    return elapsed, drained
+
+
+def main_():
+    global LATENCY
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.3, help="latência de cada upstream (s)")
+    args = parser.parse_args()
+    LATENCY = args.latency
+
+    port = serve_in_background(fake_app)
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "PIXEL_ID":          "bench",
+        "ACCESS_TOKEN":      "bench",
+        "GRAPH_API_URL":     f"{base}/graph",
+        "UTMIFY_API_URL":    f"{base}/utmify",
+        "UTMIFY_API_KEY":    "bench",
+        "STATE_DB_PATH":     os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stripe
+    stripe.api_base = base
+
+    elapsed, drained = asyncio.run(run(args.requests))
+    # no caminho crítico só resta a chamada à Stripe
+    per_request = args.latency
+    serial = args.requests * per_request
+    print(f"{args.requests} checkouts concorrentes em {elapsed:.2f}s "
+          f"(1 checkout ≈ {per_request:.2f}s, em série seria ≈ {serial:.2f}s); "
+          f"outbox drenado em {drained:.2f}s")
+    if elapsed > serial / 2:
+        print("‼️ checkouts ainda estão serializando atrás do upstream lento")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,154 @@
+"""
+Reload / duplo clique no /create-checkout-session contra o Stripe fake.
+
+Dispara rajadas do mesmo visitante (cliques simultâneos e reloads em
+seguida, com e sem Idempotency-Key) e confere: uma Session.create e um
+InitiateCheckout por visitante, repetições servidas do cache local (mede a
+latência delas), UTM diferente abre outra Session, Idempotency-Key reusado
+com outros dados dá 422 e a Session paga sai do cache. Visitantes anônimos
+(sem e-mail nem visitor_id) com as mesmas UTMs nunca dividem Session; entre
+eles só o Idempotency-Key reaproveita.
+
+    python bench/checkout_reuse.py --visitors 20 --clicks 5 --latency 0.2
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import fake_stripe
+from fakes import serve_in_background
+
+RECEIVED = {"InitiateCheckout": 0}
+
+
+async def fake_graph_events(request):
+    body = await request.json()
+    RECEIVED["InitiateCheckout"] += sum(e["event_name"] == "InitiateCheckout" for e in body.get("data", []))
+    return JSONResponse({"events_received": len(body.get("data", []))})
+
+
+async def fake_utmify(request):
+    return JSONResponse({"ok": True})
+
+
+async def run(visitors: int, clicks: int):
+    import httpx
+    import main
+
+    failures = []
+    transport = httpx.ASGITransport(app=main.app, client=("127.0.0.1", 1234))
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            async def post(body, key=None):
+                started = time.perf_counter()
+                resp = await client.post("/create-checkout-session", json=body,
+                                         headers={"Idempotency-Key": key} if key else {})
+                return resp, time.perf_counter() - started
+
+            def body(v, campaign="bench"):
+                return {"price_id": "price_bench", "customer_email": f"buyer{v}@example.com",
+                        "utm_source": "bench", "utm_campaign": campaign}
+
+            # cliques simultâneos (metade com Idempotency-Key) e depois reloads
+            firsts = await asyncio.gather(*(
+                post(body(v), key=f"key-{v}" if v % 2 else None) for v in range(visitors) for _ in range(clicks)
+            ))
+            # reloads um a um (a latência é a do cache, não da fila de requisições)
+            reloads = [await post(body(v)) for v in range(visitors) for _ in range(clicks)]
+            hits = [t for resp, t in reloads if resp.headers.get("idempotent-replayed") == "true"]
+            sessions = {resp.json()["session_id"] for resp, _ in firsts + reloads}
+            if len(sessions) != visitors or len(hits) != len(reloads):
+                failures.append(f"{len(sessions)} Sessions para {visitors} visitantes, {len(hits)} hits")
+
+            other, _ = await post(body(0, campaign="other"))
+            if other.json()["session_id"] in sessions:
+                failures.append("UTM diferente reaproveitou a Session")
+            conflict, _ = await post(body(1, campaign="other"), key="key-1")
+            if conflict.status_code != 422:
+                failures.append(f"Idempotency-Key com outros dados deu {conflict.status_code}")
+
+            # Session paga sai do cache: o próximo clique abre outra
+            paid = fake_stripe._objects[firsts[0][0].json()["session_id"]]
+            await main.handle_checkout_completed({"id": "evt_paid", "type": "checkout.session.completed",
+                                                  "data": {"object": {**paid, "status": "complete", "customer_details": {
+                                                      "email": "buyer0@example.com", "name": "Buyer", "phone": None}}}})
+            after, _ = await post(body(0))
+            if after.json()["session_id"] == paid["id"]:
+                failures.append("Session paga continuou no cache")
+
+            # anônimos do mesmo anúncio: uma Session para cada; o mesmo Idempotency-Key reaproveita
+            anon = {"price_id": "price_bench", "utm_source": "bench", "utm_campaign": "bench"}
+            a, _ = await post(anon)
+            b, _ = await post(anon)
+            again, _ = await post(anon, key="anon-key")
+            replay, _ = await post(anon, key="anon-key")
+            if a.json()["session_id"] == b.json()["session_id"] or b.headers.get("idempotent-replayed"):
+                failures.append("visitantes anônimos dividiram a mesma Session")
+            if replay.json()["session_id"] != again.json()["session_id"]:
+                failures.append("Idempotency-Key de visitante anônimo não reaproveitou a Session")
+
+        conn = main.outbox.store.connect()
+        while conn.execute("SELECT COUNT(*) FROM outbox WHERE dead = 0").fetchone()[0]:
+            await asyncio.sleep(0.05)
+    return hits, failures
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--visitors", type=int, default=20)
+    parser.add_argument("--clicks", type=int, default=5, help="cliques/reloads de cada visitante")
+    parser.add_argument("--latency", type=float, default=0.2, help="latência do Stripe fake (s)")
+    args = parser.parse_args()
+    fake_stripe.LATENCY = args.latency
+
+    port = serve_in_background(Starlette(routes=[
+        *fake_stripe.app.routes,
+        Route("/graph/{pixel}/events", fake_graph_events, methods=["POST"]),
+        Route("/utmify", fake_utmify, methods=["POST"]),
+    ]))
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STRIPE_API_BASE":   base,
+        "PIXEL_ID":          "bench",
+        "ACCESS_TOKEN":      "bench",
+        "GRAPH_API_URL":     f"{base}/graph",
+        "UTMIFY_API_URL":    f"{base}/utmify",
+        "UTMIFY_API_KEY":    "bench",
+        "STATE_DB_PATH":     os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    fake_stripe.seed_price("price_bench")
+
+    hits, failures = asyncio.run(run(args.visitors, args.clicks))
+    ms = sorted(t * 1000 for t in hits)
+    import checkout_reuse
+    fp = checkout_reuse.fingerprint("price_bench", 1, "buyer3@example.com", {"utm_source": "bench", "utm_campaign": "bench"})
+    started = time.perf_counter()
+    for _ in range(1000):
+        checkout_reuse.get(fp)
+    lookup_us = (time.perf_counter() - started) * 1000
+    creates = fake_stripe.CALLS["checkout.Session.create"]
+    print(f"{args.visitors} visitantes x {args.clicks} cliques + {args.clicks} reloads: "
+          f"Session.create: {creates}, InitiateCheckout: {RECEIVED['InitiateCheckout']}")
+    print(f"reloads servidos do cache: {len(ms)} (p50 {statistics.median(ms):.2f}ms, "
+          f"p99 {ms[int(len(ms) * 0.99) - 1]:.2f}ms pela rota inteira, via ASGI); "
+          f"consulta ao cache: {lookup_us:.0f}µs")
+    # visitantes + UTM diferente + clique depois do pagamento + 3 anônimos
+    if creates != args.visitors + 5 or RECEIVED["InitiateCheckout"] != creates:
+        failures.append(f"esperado {args.visitors + 5} Session.create/InitiateCheckout")
+    if failures:
+        print("‼️ " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,32 @@
+"""
+Fake do endpoint de validação de IPN do PayPal (cmd=_notify-validate).
+
+Responde VERIFIED, ou INVALID quando o corpo traz test_invalid=1. CALLS
+conta as validações recebidas; LATENCY/JITTER/ERROR_RATE como no
+fake_stripe (o erro injetado é um 503).
+"""
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fakes import inject
+
+LATENCY = 0.0
+JITTER = 0.0
+ERROR_RATE = 0.0
+CALLS = 0
+ERRORS = 0
+
+
+async def validate(request):
+    global CALLS, ERRORS
+    CALLS += 1
+    if await inject(LATENCY, JITTER, ERROR_RATE):
+        ERRORS += 1
+        return PlainTextResponse("Service Unavailable", status_code=503)
+    body = (await request.body()).decode("latin-1")
+    if not body.startswith("cmd=_notify-validate&"):
+        return PlainTextResponse("INVALID")
+    return PlainTextResponse("INVALID" if "test_invalid=1" in body else "VERIFIED")
+
+
+routes = [Route("/cgi-bin/webscr", validate, methods=["POST"])]
@@ -0,0 +1,357 @@
+"""
+Stripe fake em memória para os benchmarks (só o que o main.py usa).
+
+Conta as chamadas por operação (CALLS) para medir quantas idas à API cada
+fluxo faz. `seed_session()` / `seed_payment_intent()` criam os objetos que
+os eventos de webhook referenciam.
+
+LATENCY (+ até JITTER) atrasa toda resposta; ERROR_RATE faz uma fração delas
+falhar com ERROR_STATUS (contadas em ERRORS) antes de mexer no estado.
+"""
+import itertools
+import time
+import urllib.parse
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from fakes import inject
+
+LATENCY = 0.0
+JITTER = 0.0
+ERROR_RATE = 0.0
+ERROR_STATUS = 500
+CALLS = Counter()
+ERRORS = Counter()
+
+_ids = itertools.count(1)
+_objects = {}          # id -> dict
+_line_items = {}       # session id -> [line item]
+_events = []           # eventos "entregues", do mais antigo ao mais novo
+
+
+def _new_id(prefix: str) -> str:
+    return f"{prefix}_fake{next(_ids):06d}"
+
+
+def _decode(body: str) -> dict:
+    """Form encoding da Stripe (a[b][0]=v) -> dict aninhado."""
+    out = {}
+    for key, value in urllib.parse.parse_qsl(body, keep_blank_values=True):
+        parts = key.replace("]", "").split("[")
+        node = out
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return out
+
+
+async def _params(request) -> dict:
+    if request.method == "GET":
+        return _decode(request.url.query)
+    return _decode((await request.body()).decode())
+
+
+def _error(status: int, message: str):
+    return JSONResponse({"error": {"type": "invalid_request_error", "message": message}}, status_code=status)
+
+
+def _list(data: list, url: str):
+    return JSONResponse({"object": "list", "data": data, "has_more": False, "url": url})
+
+
+def _page(items: list, p: dict, url: str):
+    """Paginação da Stripe: mais novo primeiro, created[gte/lt], starting_after e limit."""
+    created = p.get("created") or {}
+    items = [o for o in items
+             if o["created"] >= int(created.get("gte", 0)) and o["created"] < int(created.get("lt", 2 ** 62))]
+    items.sort(key=lambda o: (o["created"], o["id"]), reverse=True)
+    if p.get("starting_after"):
+        ids = [o["id"] for o in items]
+        items = items[ids.index(p["starting_after"]) + 1:] if p["starting_after"] in ids else []
+    limit = int(p.get("limit", 10))
+    return JSONResponse({"object": "list", "data": items[:limit], "has_more": len(items) > limit, "url": url})
+
+
+def _route(name: str, path: str, method: str):
+    def wrap(fn):
+        async def endpoint(request):
+            CALLS[name] += 1
+            if await inject(LATENCY, JITTER, ERROR_RATE):
+                ERRORS[name] += 1
+                return JSONResponse(
+                    {"error": {"type": "api_error", "message": "erro injetado pelo bench"}},
+                    status_code=ERROR_STATUS, headers={"Retry-After": "1"} if ERROR_STATUS == 429 else None,
+                )
+            return await fn(request, await _params(request), **request.path_params)
+        return Route(path, endpoint, methods=[method])
+    return wrap
+
+
+def seed_price(price_id: str, amount: int = 1000, name: str = "Produto fake") -> dict:
+    product = {"id": f"prod_{price_id}", "object": "product", "name": name, "active": True}
+    price = {
+        "id": price_id, "object": "price", "active": True, "currency": "usd",
+        "unit_amount": amount, "nickname": None, "product": product,
+    }
+    _objects[price_id] = price
+    return price
+
+
+def seed_customer(email: str = "buyer@example.com") -> dict:
+    cust = {"id": _new_id("cus"), "object": "customer", "email": email, "name": "Buyer", "phone": None, "metadata": {}}
+    _objects[cust["id"]] = cust
+    return cust
+
+
+def _emit(event_type: str, obj: dict):
+    _events.append({
+        "id": _new_id("evt"), "object": "event", "type": event_type,
+        "created": obj["created"], "data": {"object": obj},
+    })
+
+
+def seed_session(price_id: str = "price_fake", quantity: int = 1, customer: dict = None, created: int = None) -> dict:
+    """Session 'complete' com um line item, como chega no checkout.session.completed."""
+    price = _objects.get(price_id) or seed_price(price_id)
+    customer = customer or seed_customer()
+    sid = _new_id("cs_test")
+    total = price["unit_amount"] * quantity
+    pm = {"id": _new_id("pm"), "object": "payment_method", "type": "card", "customer": customer["id"]}
+    _objects[pm["id"]] = pm
+    intent = {
+        "id": _new_id("pi"), "object": "payment_intent", "status": "succeeded",
+        "amount": total, "currency": "usd", "created": int(time.time()),
+        "customer": customer["id"], "payment_method": pm["id"], "latest_charge": None,
+        "metadata": {},
+    }
+    _objects[intent["id"]] = intent
+    session = {
+        "id": sid, "object": "checkout.session", "status": "complete",
+        "url": None, "currency": "usd", "amount_total": total, "created": created or int(time.time()),
+        "customer": customer["id"], "payment_intent": intent["id"],
+        "customer_details": {"email": customer["email"], "name": customer["name"], "phone": None},
+        "metadata": {"utm_source": "bench"},
+    }
+    _objects[sid] = session
+    _line_items[sid] = [{
+        "id": _new_id("li"), "object": "item", "description": price["product"]["name"],
+        "currency": "usd", "quantity": quantity, "amount_subtotal": total, "amount_total": total,
+        "price": price,
+    }]
+    _emit("checkout.session.completed", session)
+    return session
+
+
+def seed_payment_intent(price_id: str = "price_fake", customer: dict = None, created: int = None) -> dict:
+    price = _objects.get(price_id) or seed_price(price_id)
+    customer = customer or seed_customer()
+    intent = {
+        "id": _new_id("pi"), "object": "payment_intent", "status": "succeeded",
+        "amount": price["unit_amount"], "currency": "usd", "created": created or int(time.time()),
+        "customer": customer["id"], "latest_charge": None,
+        "metadata": {"upsell": "true", "price_id": price_id, "quantity": "1", "utm_source": "bench"},
+    }
+    _objects[intent["id"]] = intent
+    _emit("payment_intent.succeeded", intent)
+    return intent
+
+
+def _expanded(obj: dict, expand: dict) -> dict:
+    """Aplica expand[]=a.b (ids conhecidos viram objetos, em qualquer nível)."""
+    out = dict(obj)
+    for path in (expand or {}).values():
+        node = out
+        for field in path.split("."):
+            if field == "data" or not isinstance(node, dict):
+                break
+            value = node.get(field)
+            if isinstance(value, str) and value in _objects:
+                value = node[field] = dict(_objects[value])
+            node = value
+    return out
+
+
+@_route("checkout.Session.create", "/v1/checkout/sessions", "POST")
+async def create_session(request, p):
+    item = p.get("line_items", {}).get("0", {})
+    price = _objects.get(item.get("price")) or seed_price(item.get("price", "price_fake"))
+    session = seed_session(price["id"], int(item.get("quantity", 1)))
+    _events.pop()  # ainda não foi pago: nada de checkout.session.completed
+    session.update(status="open", url=f"https://checkout.stripe.com/c/pay/{session['id']}",
+                   metadata=p.get("metadata", {}), customer_details=None, payment_intent=None)
+    return JSONResponse({**session, "line_items": {"object": "list", "data": _line_items[session["id"]]}})
+
+
+@_route("checkout.Session.list", "/v1/checkout/sessions", "GET")
+async def list_sessions(request, p):
+    sessions = [o for o in _objects.values() if o["object"] == "checkout.session"]
+    if p.get("status"):
+        sessions = [o for o in sessions if o["status"] == p["status"]]
+    return _page(sessions, p, "/v1/checkout/sessions")
+
+
+@_route("checkout.Session.retrieve", "/v1/checkout/sessions/{sid}", "GET")
+async def retrieve_session(request, p, sid):
+    if sid not in _objects:
+        return _error(404, f"No such checkout.session: {sid}")
+    session = _expanded(_objects[sid], p.get("expand"))
+    return JSONResponse({**session, "line_items": {"object": "list", "data": _line_items.get(sid, [])}})
+
+
+@_route("checkout.Session.list_line_items", "/v1/checkout/sessions/{sid}/line_items", "GET")
+async def list_line_items(request, p, sid):
+    return _list(_line_items.get(sid, []), f"/v1/checkout/sessions/{sid}/line_items")
+
+
+@_route("Customer.create", "/v1/customers", "POST")
+async def create_customer(request, p):
+    cust = seed_customer(p.get("email", ""))
+    cust.update(name=p.get("name"), metadata=p.get("metadata", {}))
+    return JSONResponse(cust)
+
+
+@_route("Customer.retrieve", "/v1/customers/{cid}", "GET")
+async def retrieve_customer(request, p, cid):
+    return JSONResponse(_objects[cid]) if cid in _objects else _error(404, f"No such customer: {cid}")
+
+
+@_route("Customer.modify", "/v1/customers/{cid}", "POST")
+async def modify_customer(request, p, cid):
+    if cid not in _objects:
+        return _error(404, f"No such customer: {cid}")
+    _objects[cid].update(p)
+    return JSONResponse(_objects[cid])
+
+
+@_route("Price.list", "/v1/prices", "GET")
+async def list_prices(request, p):
+    return _list([o for o in _objects.values() if o["object"] == "price"], "/v1/prices")
+
+
+@_route("Price.retrieve", "/v1/prices/{pid}", "GET")
+async def retrieve_price(request, p, pid):
+    return JSONResponse(_objects[pid]) if pid in _objects else _error(404, f"No such price: {pid}")
+
+
+@_route("PaymentIntent.create", "/v1/payment_intents", "POST")
+async def create_payment_intent(request, p):
+    intent = {
+        "id": _new_id("pi"), "object": "payment_intent", "status": "requires_confirmation",
+        "amount": int(p.get("amount", 0)), "currency": p.get("currency", "usd"),
+        "created": int(time.time()), "customer": p.get("customer"), "latest_charge": None,
+        "metadata": p.get("metadata", {}),
+    }
+    intent["client_secret"] = f"{intent['id']}_secret_fake"
+    _objects[intent["id"]] = intent
+    return JSONResponse(intent)
+
+
+@_route("PaymentIntent.retrieve", "/v1/payment_intents/{pid}", "GET")
+async def retrieve_payment_intent(request, p, pid):
+    if pid not in _objects:
+        return _error(404, f"No such payment_intent: {pid}")
+    return JSONResponse(_expanded(_objects[pid], p.get("expand")))
+
+
+@_route("InvoiceItem.list", "/v1/invoiceitems", "GET")
+async def list_invoice_items(request, p):
+    items = [o for o in _objects.values() if o["object"] == "invoiceitem" and o["customer"] == p.get("customer")]
+    if p.get("pending") == "true":
+        items = [o for o in items if o["invoice"] is None]
+    return _list(items, "/v1/invoiceitems")
+
+
+@_route("InvoiceItem.create", "/v1/invoiceitems", "POST")
+async def create_invoice_item(request, p):
+    item = {
+        "id": _new_id("ii"), "object": "invoiceitem", "customer": p.get("customer"),
+        "amount": int(p.get("amount", 0)), "currency": p.get("currency", "usd"),
+        "description": p.get("description"), "metadata": p.get("metadata", {}), "invoice": None,
+    }
+    _objects[item["id"]] = item
+    return JSONResponse(item)
+
+
+@_route("InvoiceItem.delete", "/v1/invoiceitems/{iid}", "DELETE")
+async def delete_invoice_item(request, p, iid):
+    item = _objects.get(iid)
+    if item is None:
+        return _error(404, f"No such invoiceitem: {iid}")
+    if item["invoice"] is not None:
+        # como na Stripe: item já faturado não se apaga
+        return _error(400, f"Invoice item {iid} is attached to invoice {item['invoice']} and cannot be deleted")
+    del _objects[iid]
+    return JSONResponse({"id": iid, "object": "invoiceitem", "deleted": True})
+
+
+@_route("Invoice.create", "/v1/invoices", "POST")
+async def create_invoice(request, p):
+    inv = {
+        "id": _new_id("in"), "object": "invoice", "status": "draft", "customer": p.get("customer"),
+        "currency": "usd", "collection_method": p.get("collection_method", "charge_automatically"),
+        "description": p.get("description"), "footer": p.get("footer"), "metadata": p.get("metadata", {}),
+        "due_date": None, "payment_intent": None, "hosted_invoice_url": None, "invoice_pdf": None,
+    }
+    amount = 0
+    if p.get("pending_invoice_items_behavior") == "include":
+        for o in list(_objects.values()):
+            if o["object"] == "invoiceitem" and o["customer"] == inv["customer"] and o["invoice"] is None:
+                o["invoice"] = inv["id"]
+                amount += o["amount"]
+                inv["currency"] = o["currency"]
+    inv.update(amount_due=amount, amount_paid=0)
+    _objects[inv["id"]] = inv
+    return JSONResponse(inv)
+
+
+@_route("Invoice.search", "/v1/invoices/search", "GET")
+async def search_invoices(request, p):
+    # só entende metadata['parent_session_id']:'cs_...'
+    sid = p.get("query", "").rsplit(":", 1)[-1].strip("'")
+    found = [o for o in _objects.values()
+             if o["object"] == "invoice" and o["metadata"].get("parent_session_id") == sid]
+    return JSONResponse({"object": "search_result", "data": found, "has_more": False, "url": "/v1/invoices/search"})
+
+
+@_route("Invoice.retrieve", "/v1/invoices/{iid}", "GET")
+async def retrieve_invoice(request, p, iid):
+    if iid not in _objects:
+        return _error(404, f"No such invoice: {iid}")
+    return JSONResponse(_expanded(_objects[iid], p.get("expand")))
+
+
+@_route("Invoice.modify", "/v1/invoices/{iid}", "POST")
+async def modify_invoice(request, p, iid):
+    if iid not in _objects:
+        return _error(404, f"No such invoice: {iid}")
+    _objects[iid].update({k: v for k, v in p.items() if k != "days_until_due"})
+    return JSONResponse(_objects[iid])
+
+
+@_route("Invoice.finalize_invoice", "/v1/invoices/{iid}/finalize", "POST")
+async def finalize_invoice(request, p, iid):
+    inv = _objects[iid]
+    inv.update(status="paid" if inv["amount_due"] == 0 else "open", due_date=int(time.time()) + 30 * 86400)
+    return JSONResponse(inv)
+
+
+@_route("Invoice.pay", "/v1/invoices/{iid}/pay", "POST")
+async def pay_invoice(request, p, iid):
+    inv = _objects[iid]
+    inv.update(status="paid", amount_paid=inv["amount_due"])
+    return JSONResponse(inv)
+
+
+@_route("Event.list", "/v1/events", "GET")
+async def list_events(request, p):
+    types = set((p.get("types") or {}).values()) | ({p["type"]} if p.get("type") else set())
+    events = [e for e in _events if not types or e["type"] in types]
+    return _page(events, p, "/v1/events")
+
+
+app = Starlette(routes=[
+    r for r in globals().values() if isinstance(r, Route)
+])
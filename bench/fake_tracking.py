@@ -0,0 +1,49 @@
+"""
+Fakes da Conversions API (Graph /{pixel}/events) e da UTMify.
+
+RECEIVED conta eventos da CAPI ("graph") e pedidos da UTMify ("utmify")
+aceitos. Latência e erros são por destino (LATENCY/JITTER/ERROR_RATE,
+chaves "graph" e "utmify"); o erro injetado é um 500, contado em ERRORS.
+"""
+from collections import Counter
+
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from fakes import inject
+
+LATENCY = {"graph": 0.0, "utmify": 0.0}
+JITTER = {"graph": 0.0, "utmify": 0.0}
+ERROR_RATE = {"graph": 0.0, "utmify": 0.0}
+RECEIVED = Counter()
+ERRORS = Counter()
+
+
+async def _faulty(name: str):
+    if await inject(LATENCY[name], JITTER[name], ERROR_RATE[name]):
+        ERRORS[name] += 1
+        return JSONResponse({"error": {"message": "erro injetado pelo bench"}}, status_code=500)
+    return None
+
+
+async def graph_events(request):
+    error = await _faulty("graph")
+    if error:
+        return error
+    data = (await request.json()).get("data", [])
+    RECEIVED["graph"] += len(data)
+    return JSONResponse({"events_received": len(data)})
+
+
+async def utmify(request):
+    error = await _faulty("utmify")
+    if error:
+        return error
+    RECEIVED["utmify"] += 1
+    return JSONResponse({"ok": True})
+
+
+routes = [
+    Route("/graph/{pixel}/events", graph_events, methods=["POST"]),
+    Route("/utmify", utmify, methods=["POST"]),
+]
@@ -0,0 +1,33 @@
+"""
+Utilitários dos benchmarks: sobe apps ASGI fake num uvicorn em background
+e injeta latência/erros nas respostas dos fakes.
+"""
+import asyncio
+import random
+import socket
+import threading
+import time
+
+import uvicorn
+
+
+def serve_in_background(app) -> int:
+    """Sobe `app` em 127.0.0.1 numa porta livre (thread daemon); devolve a porta."""
+    sock = socket.socket()
+    # sem TCP_NODELAY o Nagle + delayed ACK somam ~40ms a cada resposta
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return port
+
+
+async def inject(latency: float, jitter: float = 0.0, error_rate: float = 0.0) -> bool:
+    """Espera latency (+ até jitter, uniforme); True quando a resposta deve ser um erro injetado."""
+    delay = latency + (random.uniform(0, jitter) if jitter else 0.0)
+    if delay:
+        await asyncio.sleep(delay)
+    return bool(error_rate) and random.random() < error_rate
@@ -0,0 +1,104 @@
+"""
+Invoice espelho inline x deferred (INVOICE_MIRROR_MODE).
+
+Processa os mesmos checkout.session.completed nos dois modos contra o
+Stripe fake e compara chamadas à Stripe e latência por evento. No modo
+deferred roda depois o lote: uma passada interrompida (stop depois do
+primeiro lote) e a retomada pelo cursor, conferindo uma invoice paga por
+sessão.
+
+    python bench/invoice_mirror_deferred.py --events 20 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import fake_stripe
+from fakes import serve_in_background
+
+
+async def handle(main, n: int) -> float:
+    elapsed = 0.0
+    for i in range(n):
+        session = fake_stripe.seed_session()
+        started = time.perf_counter()
+        await main.handle_checkout_completed(
+            {"id": f"evt_{session['id']}", "type": "checkout.session.completed", "data": {"object": session}}
+        )
+        elapsed += time.perf_counter() - started
+    return elapsed / n
+
+
+def invoices() -> list:
+    return [o for o in fake_stripe._objects.values() if o["object"] == "invoice"]
+
+
+async def run(n: int, batch_size: int):
+    import invoice_mirror
+    import main
+
+    results = {}
+    for mode in ("inline", "deferred"):
+        invoice_mirror.INVOICE_MIRROR_MODE = mode
+        fake_stripe.CALLS.clear()
+        per_event = await handle(main, n)
+        results[mode] = (sum(fake_stripe.CALLS.values()) / n, per_event)
+
+    # lote: primeira passada parada depois de um lote, retomada pelo cursor
+    invoice_mirror.INVOICE_MIRROR_BATCH_SIZE = batch_size
+    fake_stripe.CALLS.clear()
+    before = len(invoices())
+    stop = asyncio.Event()
+    original = invoice_mirror._advance
+
+    def advance_then_stop(seq):
+        original(seq)
+        stop.set()
+
+    invoice_mirror._advance = advance_then_stop
+    first = await invoice_mirror.run_pass(main.mirror_invoice, stop)
+    invoice_mirror._advance = original
+    cursor = invoice_mirror._cursor()
+    started = time.perf_counter()
+    rest = await invoice_mirror.run_pass(main.mirror_invoice)
+    elapsed = time.perf_counter() - started
+    return results, first, cursor, rest, elapsed, len(invoices()) - before
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="latência de cada chamada à Stripe (s)")
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    fake_stripe.LATENCY = args.latency
+
+    port = serve_in_background(fake_stripe.app)
+    os.environ.update({
+        "STRIPE_SECRET_KEY":          "sk_test_bench",
+        "STATE_DB_PATH":              os.path.join(tempfile.mkdtemp(), "bench.db"),
+        "INVOICE_MIRROR_CONCURRENCY": str(args.concurrency),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stripe
+    stripe.api_key = "sk_test_bench"
+    stripe.api_base = f"http://127.0.0.1:{port}"
+
+    results, first, cursor, rest, elapsed, created = asyncio.run(run(args.events, args.batch_size))
+    for mode, (calls, per_event) in results.items():
+        print(f"{mode:9s}: {calls:.1f} chamadas à Stripe/evento, {per_event * 1000:.0f}ms/evento no webhook")
+    print(f"lote: {first} sessões, parou no cursor {cursor}; retomada fez mais {rest} em {elapsed:.2f}s "
+          f"(concorrência {args.concurrency}); {created} invoices criadas, "
+          f"Invoice.modify: {fake_stripe.CALLS['Invoice.modify']}")
+    paid = [i for i in invoices() if i["status"] == "paid"]
+    if first + rest != args.events or created != args.events or len(paid) != 2 * args.events:
+        print("‼️ esperada exatamente uma invoice paga por sessão")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,168 @@
+"""
+Custo de JSON por evento de webhook: caminho antigo vs fastjson.
+
+Antes: stripe.Webhook.construct_event (decode, assinatura, json.loads com
+OrderedDict e árvore de StripeObject), decode do corpo para a fila, json.loads
+no worker, json.dumps do payload da CAPI/UTMify (httpx json=) e JSONResponse
+padrão. Depois: assinatura nos bytes (main.verify_webhook_signature),
+fastjson.loads, corpo para a fila sem decode, fastjson.dumps e
+fastjson.JSONResponse. Mede também o evento ignorado (tipo que não
+processamos), que só paga a assinatura e o parse.
+
+Roda duas vezes: com orjson e com FAST_JSON=0 (fallback da stdlib).
+
+    python bench/json_fastpath.py --events 5000
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "whsec_bench"
+
+
+def checkout_event(i: int) -> dict:
+    """checkout.session.completed com o formato (e o tamanho, ~3KB) de um evento real."""
+    sid = f"cs_live_a1{i:0>56}"
+    return {
+        "id": f"evt_1Q{i:0>22}", "object": "event", "api_version": "2024-06-20", "created": 1718000000 + i,
+        "livemode": True, "pending_webhooks": 2, "request": {"id": None, "idempotency_key": None},
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": sid, "object": "checkout.session", "adaptive_pricing": {"enabled": False},
+            "after_expiration": None, "allow_promotion_codes": False, "amount_subtotal": 4700, "amount_total": 4700,
+            "automatic_tax": {"enabled": False, "liability": None, "status": None},
+            "billing_address_collection": None, "cancel_url": "https://example.com/oferta?utm_source=fb",
+            "client_reference_id": None, "client_secret": None, "consent": None, "consent_collection": None,
+            "created": 1718000000 + i, "currency": "usd", "currency_conversion": None, "custom_fields": [],
+            "custom_text": {"after_submit": None, "shipping_address": None, "submit": None, "terms_of_service_acceptance": None},
+            "customer": f"cus_Q{i:0>13}", "customer_creation": "always",
+            "customer_details": {
+                "address": {"city": "São Paulo", "country": "BR", "line1": "Rua Exemplo, 123", "line2": "Apto 45",
+                            "postal_code": "01234-567", "state": "SP"},
+                "email": f"comprador{i}@example.com", "name": "Comprador de Teste", "phone": "+5511999999999",
+                "tax_exempt": "none", "tax_ids": [],
+            },
+            "customer_email": None, "expires_at": 1718086400 + i, "invoice": None,
+            "invoice_creation": {"enabled": False, "invoice_data": {
+                "account_tax_ids": None, "custom_fields": None, "description": None, "footer": None,
+                "issuer": None, "metadata": {}, "rendering_options": None}},
+            "livemode": True, "locale": "pt-BR",
+            "metadata": {"utm_source": "facebook", "utm_medium": "cpc", "utm_campaign": "campanha-lancamento|1234567890",
+                         "utm_content": "criativo-video-03|9876543210", "utm_term": "publico-lookalike|1122334455",
+                         "funnel": "principal"},
+            "mode": "payment", "payment_intent": f"pi_3Q{i:0>22}", "payment_link": None,
+            "payment_method_collection": "if_required", "payment_method_configuration_details": None,
+            "payment_method_options": {"card": {"request_three_d_secure": "automatic", "setup_future_usage": "off_session"}},
+            "payment_method_types": ["card"], "payment_status": "paid",
+            "phone_number_collection": {"enabled": True}, "recovered_from": None, "saved_payment_method_options": None,
+            "setup_intent": None, "shipping_address_collection": None, "shipping_cost": None, "shipping_details": None,
+            "shipping_options": [], "status": "complete", "submit_type": None, "subscription": None,
+            "success_url": "https://example.com/upsell?sid={CHECKOUT_SESSION_ID}",
+            "total_details": {"amount_discount": 0, "amount_shipping": 0, "amount_tax": 0},
+            "ui_mode": "hosted", "url": None,
+        }},
+    }
+
+
+def capi_payload(i: int) -> dict:
+    return {"data": [{
+        "event_name": "Purchase", "event_time": 1718000000 + i, "event_id": f"cs_live_a1{i:0>56}",
+        "action_source": "website", "event_source_url": "https://example.com/oferta?utm_source=fb",
+        "user_data": {"em": hashlib.sha256(f"comprador{i}@example.com".encode()).hexdigest(),
+                      "ph": hashlib.sha256(b"5511999999999").hexdigest(),
+                      "client_ip_address": "203.0.113.10", "client_user_agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_5)",
+                      "fbc": "fb.1.1718000000.IwAR0abcdef", "fbp": "fb.1.1718000000.123456789"},
+        "custom_data": {"currency": "USD", "value": 47.0, "content_type": "product",
+                        "contents": [{"id": "prod_Q1", "quantity": 1, "item_price": 47.0}]},
+    }]}
+
+
+def signed(payload: bytes) -> str:
+    t = int(time.time())
+    return f"t={t},v1=" + hmac.new(SECRET.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+
+
+def per_event(fn, items) -> float:
+    started = time.perf_counter()
+    for item in items:
+        fn(item)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def measure(n: int) -> dict:
+    os.environ.update({"STRIPE_WEBHOOK_SECRET": SECRET, "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(), "bench.db")})
+    sys.path.insert(0, ROOT)
+    import stripe
+    from fastapi.responses import JSONResponse as StdJSONResponse
+
+    import fastjson
+    import main
+
+    events = [json.dumps(checkout_event(i)).encode() for i in range(n)]
+    ignored = [e.replace(b'"checkout.session.completed"', b'"charge.succeeded"') for e in events]
+    requests = [(e, signed(e)) for e in events]
+    ignored_requests = [(e, signed(e)) for e in ignored]
+    capi = [capi_payload(i) for i in range(n)]
+
+    def before(req):
+        payload, sig = req
+        event = stripe.Webhook.construct_event(payload, sig, SECRET)
+        if event["type"] in main.WEBHOOK_HANDLERS:
+            row = payload.decode("utf-8")       # fila (TEXT)
+            json.loads(row)                     # worker
+        StdJSONResponse({"received": True})
+
+    def after(req):
+        payload, sig = req
+        main.verify_webhook_signature(payload, sig)
+        event = fastjson.loads(payload)
+        if event["type"] in main.WEBHOOK_HANDLERS:
+            fastjson.loads(payload)             # worker (bytes direto da fila)
+        fastjson.JSONResponse({"received": True})
+
+    # aquece
+    for fn in (before, after):
+        per_event(fn, requests[:200])
+    return {
+        "backend": "orjson" if fastjson.FAST_JSON else "json (stdlib)",
+        "bytes": sum(map(len, events)) // n,
+        "before": per_event(before, requests),
+        "after": per_event(after, requests),
+        "ignored_before": per_event(before, ignored_requests),
+        "ignored_after": per_event(after, ignored_requests),
+        "encode_before": per_event(lambda p: json.dumps(p).encode(), capi),
+        "encode_after": per_event(fastjson.dumps, capi),
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(measure(args.events)))
+        return
+
+    for fast in ("1", "0"):
+        out = subprocess.run([sys.executable, __file__, "--events", str(args.events), "--child"],
+                             env={**os.environ, "FAST_JSON": fast}, capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{r['backend']} (evento de {r['bytes']} bytes):")
+        print(f"  webhook processado: {r['before']:6.1f}µs -> {r['after']:6.1f}µs por evento "
+              f"({r['before'] / r['after']:.1f}x)")
+        print(f"  webhook ignorado:   {r['ignored_before']:6.1f}µs -> {r['ignored_after']:6.1f}µs "
+              f"({r['ignored_before'] / r['ignored_after']:.1f}x)")
+        print(f"  payload CAPI:       {r['encode_before']:6.1f}µs -> {r['encode_after']:6.1f}µs "
+              f"({r['encode_before'] / r['encode_after']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main_()
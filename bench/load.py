@@ -0,0 +1,368 @@
+"""
+Teste de carga do app inteiro contra upstreams fake (nada sai da máquina).
+
+Sobe no processo do bench os fakes da Stripe (Checkout Session, Customer,
+Price, Product, PaymentIntent, InvoiceItem, Invoice), da Conversions API,
+da UTMify e da validação de IPN do PayPal, cada um com latência e taxa de
+erro configuráveis, e o app num `uvicorn --workers N` (como no Procfile).
+
+Dispara /create-checkout-session, /upsell/intent, /webhook (assinado) e
+/track-paypal em malha aberta, na taxa pedida por endpoint: a latência conta
+a partir do horário agendado de cada requisição, então fila no cliente
+também aparece nos percentis. Depois espera as filas (webhooks e outbox)
+drenarem e salva tudo em JSON (commit, config, p50/p95/p99, vazão, erros,
+chamadas aos upstreams) para comparar entre commits:
+
+    python bench/load.py --rps 20 --seconds 30 --stripe-latency 0.15 --stripe-errors 0.01
+    python bench/load.py --rps webhook=100,checkout=20 --compare bench/results/load-abc1234-....json
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import hmac
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+from collections import Counter
+
+import httpx
+from starlette.applications import Starlette
+
+import fake_paypal
+import fake_stripe
+import fake_tracking
+from fakes import serve_in_background
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, "bench", "results")
+SECRET = "whsec_bench"
+ENDPOINTS = ("checkout", "upsell", "webhook", "paypal")
+
+
+def rates(value: str) -> dict:
+    """"20" -> 20 req/s em cada endpoint; "webhook=100,checkout=20" -> só esses."""
+    if "=" not in value:
+        return {name: float(value) for name in ENDPOINTS}
+    out = {}
+    for pair in value.split(","):
+        name, rps = pair.split("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"endpoint desconhecido: {name} (use {', '.join(ENDPOINTS)})")
+        out[name] = float(rps)
+    return out
+
+
+def percentile(ms: list, p: float) -> float:
+    """Nearest-rank sobre a lista já ordenada."""
+    return ms[max(0, math.ceil(p / 100 * len(ms)) - 1)] if ms else None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# --- requisições de cada endpoint (i = número da requisição) ---
+
+def checkout_request(i: int, sessions: list):
+    body = {"price_id": "price_bench", "customer_email": f"load{i}@example.com",
+            "utm_source": "load", "utm_campaign": f"campanha-{i % 10}"}
+    return "POST", "/create-checkout-session", {"json": body}
+
+
+def upsell_request(i: int, sessions: list):
+    # Session distinta a cada toque (o single-flight não mascara o custo)
+    return "POST", "/upsell/intent", {"json": {"sid": sessions[i % len(sessions)]["id"], "price_id": "price_upsell"}}
+
+
+def webhook_request(i: int, sessions: list):
+    event = {"id": f"evt_load_{os.getpid()}_{i}", "object": "event", "type": "checkout.session.completed",
+             "created": int(time.time()), "data": {"object": sessions[i % len(sessions)]}}
+    payload = json.dumps(event).encode()
+    t = int(time.time())
+    sig = hmac.new(SECRET.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+    return "POST", "/webhook", {"content": payload, "headers": {
+        "Stripe-Signature": f"t={t},v1={sig}", "Content-Type": "application/json"}}
+
+
+def paypal_request(i: int, sessions: list):
+    body = urllib.parse.urlencode({
+        "txn_id": f"LOAD{os.getpid()}X{i:08d}", "payment_status": "Completed", "payer_email": f"load{i}@example.com",
+        "mc_gross": "47.00", "mc_currency": "USD", "item_number": "ebook", "item_name": "Ebook",
+        "quantity": "1", "custom_utm_source": "load",
+    })
+    return "POST", "/track-paypal", {"content": body, "headers": {"Content-Type": "application/x-www-form-urlencoded"}}
+
+
+REQUESTS = {"checkout": checkout_request, "upsell": upsell_request, "webhook": webhook_request, "paypal": paypal_request}
+
+
+async def drive(client, name: str, rps: float, seconds: float, sessions: list, max_in_flight: int) -> dict:
+    """Malha aberta: agenda uma requisição a cada 1/rps, sem esperar as anteriores."""
+    latencies, statuses = [], Counter()
+    limit = asyncio.Semaphore(max_in_flight)
+    start = time.perf_counter()
+    finished = start
+
+    async def one(i: int, scheduled: float):
+        nonlocal finished
+        method, path, kwargs = REQUESTS[name](i, sessions)
+        async with limit:
+            try:
+                resp = await client.request(method, path, **kwargs)
+                statuses[str(resp.status_code)] += 1
+                ok = resp.is_success
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+                ok = False
+        finished = max(finished, time.perf_counter())
+        if ok:
+            latencies.append(time.perf_counter() - scheduled)
+
+    tasks = []
+    for i in range(int(rps * seconds)):
+        scheduled = start + i / rps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(i, scheduled)))
+    await asyncio.gather(*tasks)
+
+    ms = sorted(l * 1000 for l in latencies)
+    sent = len(tasks)
+    return {
+        "target_rps": rps, "sent": sent, "ok": len(ms), "errors": sent - len(ms),
+        "error_rate": round((sent - len(ms)) / sent, 4) if sent else 0.0,
+        "status": dict(statuses),
+        "throughput_rps": round(len(ms) / (finished - start), 2) if ms else 0.0,
+        "p50_ms": percentile(ms, 50), "p95_ms": percentile(ms, 95), "p99_ms": percentile(ms, 99),
+        "max_ms": ms[-1] if ms else None,
+    }
+
+
+async def load(base: str, targets: dict, seconds: float, sessions: dict, max_in_flight: int) -> dict:
+    limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as client:
+        results = await asyncio.gather(*(
+            drive(client, name, rps, seconds, sessions[name], max_in_flight) for name, rps in targets.items()
+        ))
+    return dict(zip(targets, results))
+
+
+async def wait_ready(base: str, timeout: float = 60) -> bool:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return True
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    return False
+
+
+def backlog(db: str) -> dict:
+    conn = sqlite3.connect(db, timeout=10)
+    try:
+        q = lambda sql: conn.execute(sql).fetchone()[0]
+        return {
+            "webhook_pending": q("SELECT COUNT(*) FROM webhook_events WHERE dead = 0"),
+            "webhook_dead":    q("SELECT COUNT(*) FROM webhook_events WHERE dead = 1"),
+            "outbox_pending":  q("SELECT COUNT(*) FROM outbox WHERE dead = 0"),
+            "outbox_dead":     q("SELECT COUNT(*) FROM outbox WHERE dead = 1"),
+        }
+    finally:
+        conn.close()
+
+
+def drain(db: str, timeout: float) -> dict:
+    """Espera webhooks e outbox esvaziarem (os retries com backoff podem passar do prazo)."""
+    started = time.perf_counter()
+    while True:
+        state = backlog(db)
+        if not state["webhook_pending"] and not state["outbox_pending"] or time.perf_counter() - started > timeout:
+            return {"drain_seconds": round(time.perf_counter() - started, 2), **state}
+        time.sleep(0.2)
+
+
+def run(args, targets: dict) -> dict:
+    port = serve_in_background(Starlette(routes=[*fake_stripe.app.routes, *fake_paypal.routes, *fake_tracking.routes]))
+    fakes_base = f"http://127.0.0.1:{port}"
+    fake_stripe.seed_price("price_bench", amount=4700, name="Produto principal")
+    fake_stripe.seed_price("price_upsell", amount=2700, name="Upsell")
+    # Sessions pagas: o /webhook entrega e o /upsell/intent usa (uma por requisição)
+    sessions = {name: [fake_stripe.seed_session("price_bench") for _ in range(max(1, int(rps * args.seconds)))]
+                if name in ("upsell", "webhook") else [] for name, rps in targets.items()}
+    workdir = tempfile.mkdtemp()
+    db = os.path.join(workdir, "load.db")
+    app_log = os.path.join(workdir, "app.log")
+    app_port = free_port()
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY":       str(args.workers),
+        "STRIPE_SECRET_KEY":     "sk_test_bench",
+        "STRIPE_WEBHOOK_SECRET": SECRET,
+        "STRIPE_API_BASE":       fakes_base,
+        "GRAPH_API_URL":         f"{fakes_base}/graph",
+        "UTMIFY_API_URL":        f"{fakes_base}/utmify",
+        "PAYPAL_IPN_URL":        f"{fakes_base}/cgi-bin/webscr",
+        "PIXEL_ID":              "bench",
+        "ACCESS_TOKEN":          "bench",
+        "UTMIFY_API_KEY":        "bench",
+        "STATE_DB_PATH":         db,
+    }
+    with open(app_log, "w") as out:
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+             "--workers", str(args.workers), "--timeout-graceful-shutdown", "10", "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=out, stderr=subprocess.STDOUT,
+        )
+    base = f"http://127.0.0.1:{app_port}"
+    try:
+        if not asyncio.run(wait_ready(base)):
+            raise SystemExit(f"‼️ o app não ficou pronto; veja {app_log}")
+        # latência e erros só depois da subida (o aquecimento do catálogo não entra na conta)
+        fake_stripe.LATENCY, fake_stripe.JITTER = args.stripe_latency, args.jitter
+        fake_stripe.ERROR_RATE, fake_stripe.ERROR_STATUS = args.stripe_errors, args.stripe_error_status
+        fake_paypal.LATENCY, fake_paypal.JITTER, fake_paypal.ERROR_RATE = args.paypal_latency, args.jitter, args.paypal_errors
+        for name in ("graph", "utmify"):
+            fake_tracking.LATENCY[name] = getattr(args, f"{name}_latency")
+            fake_tracking.JITTER[name] = args.jitter
+            fake_tracking.ERROR_RATE[name] = getattr(args, f"{name}_errors")
+        fake_stripe.CALLS.clear()
+
+        started = time.perf_counter()
+        endpoints = asyncio.run(load(base, targets, args.seconds, sessions, args.max_in_flight))
+        elapsed = time.perf_counter() - started
+        background = drain(db, args.drain_timeout)
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")} | {"rps": targets},
+        "elapsed_seconds": round(elapsed, 2),
+        "endpoints": endpoints,
+        "background": background,
+        "upstreams": {
+            "stripe_calls": dict(fake_stripe.CALLS), "stripe_errors": dict(fake_stripe.ERRORS),
+            "paypal_calls": fake_paypal.CALLS, "paypal_errors": fake_paypal.ERRORS,
+            "capi_events": fake_tracking.RECEIVED["graph"], "utmify_orders": fake_tracking.RECEIVED["utmify"],
+            "tracking_errors": dict(fake_tracking.ERRORS),
+        },
+        "app_log": app_log,
+    }
+
+
+def report(result: dict):
+    print(f"commit {result['commit']}, {result['config']['workers']} worker(s), {result['host']['cpus']} CPUs, "
+          f"{result['config']['seconds']:.0f}s")
+    for name, r in result["endpoints"].items():
+        if not r["ok"]:
+            print(f"  {name:9} alvo {r['target_rps']:6.1f} req/s: nenhuma resposta 2xx {r['status']}")
+            continue
+        print(f"  {name:9} alvo {r['target_rps']:6.1f} req/s -> {r['throughput_rps']:6.1f} req/s; "
+              f"p50 {r['p50_ms']:7.1f}ms  p95 {r['p95_ms']:7.1f}ms  p99 {r['p99_ms']:7.1f}ms; "
+              f"erros {r['errors']}/{r['sent']} {({k: v for k, v in r['status'].items() if not k.startswith('2')}) or ''}")
+    b = result["background"]
+    print(f"  filas: drenadas em {b['drain_seconds']:.1f}s; pendentes {b['webhook_pending']} webhooks / "
+          f"{b['outbox_pending']} outbox; descartados {b['webhook_dead']} / {b['outbox_dead']}")
+    u = result["upstreams"]
+    print(f"  upstreams: {sum(u['stripe_calls'].values())} chamadas à Stripe ({sum(u['stripe_errors'].values())} com erro "
+          f"injetado), {u['paypal_calls']} validações de IPN, {u['capi_events']} eventos na CAPI, "
+          f"{u['utmify_orders']} pedidos na UTMify")
+
+
+def compare(result: dict, path: str, tolerance: float) -> list:
+    """Imprime a variação contra um resultado anterior; devolve as regressões acima de `tolerance` (%)."""
+    with open(path) as f:
+        before = json.load(f)
+    print(f"comparado com {before['commit']} ({before['timestamp']}):")
+    regressions = []
+    for name, r in result["endpoints"].items():
+        old = before["endpoints"].get(name)
+        if not old or not old["ok"] or not r["ok"]:
+            continue
+        if old["target_rps"] != r["target_rps"]:
+            print(f"  {name:9} alvo diferente ({old['target_rps']:.1f} -> {r['target_rps']:.1f} req/s); não comparado")
+            continue
+        deltas = {k: (r[k] - old[k]) / old[k] * 100 for k in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms") if old[k]}
+        print(f"  {name:9} vazão {deltas.get('throughput_rps', 0):+6.1f}%  p50 {deltas.get('p50_ms', 0):+6.1f}%  "
+              f"p95 {deltas.get('p95_ms', 0):+6.1f}%  p99 {deltas.get('p99_ms', 0):+6.1f}%  "
+              f"erros {old['error_rate']:.2%} -> {r['error_rate']:.2%}")
+        if tolerance is not None and (deltas.get("p99_ms", 0) > tolerance or -deltas.get("throughput_rps", 0) > tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rps", type=rates, default="10", help='por endpoint: "20" ou "webhook=100,checkout=20"')
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn --workers (WEB_CONCURRENCY)")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="conexões simultâneas do gerador")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latência extra uniforme em todos os fakes (s)")
+    parser.add_argument("--stripe-latency", type=float, default=0.1)
+    parser.add_argument("--stripe-errors", type=float, default=0.0, help="fração das chamadas à Stripe que falham")
+    parser.add_argument("--stripe-error-status", type=int, default=500, help="500, 429 (rate limit)...")
+    parser.add_argument("--graph-latency", type=float, default=0.05)
+    parser.add_argument("--graph-errors", type=float, default=0.0)
+    parser.add_argument("--utmify-latency", type=float, default=0.05)
+    parser.add_argument("--utmify-errors", type=float, default=0.0)
+    parser.add_argument("--paypal-latency", type=float, default=0.1)
+    parser.add_argument("--paypal-errors", type=float, default=0.0)
+    parser.add_argument("--drain-timeout", type=float, default=60, help="espera máxima pelas filas depois da carga (s)")
+    parser.add_argument("--out", help="arquivo JSON do resultado (padrão: bench/results/load-<commit>-<hora>.json)")
+    parser.add_argument("--compare", help="JSON de uma rodada anterior")
+    parser.add_argument("--max-regression", type=float,
+                        help="com --compare: sai com erro se p99 subir ou a vazão cair mais que isso (%%)")
+    args = parser.parse_args()
+    targets = args.rps   # o argparse passa o default pelo type também
+
+    result = run(args, targets)
+    out = args.out or os.path.join(
+        RESULTS, f"load-{result['commit']}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(result, f, indent=2)
+    report(result)
+    print(f"resultado em {out}")
+
+    if args.compare:
+        regressions = compare(result, args.compare, args.max_regression)
+        if regressions:
+            print(f"‼️ regressão acima de {args.max_regression:.0f}% em: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
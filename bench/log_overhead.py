@@ -0,0 +1,97 @@
+"""
+Custo de logar no caminho do handler: print() do corpo inteiro vs log.py.
+
+O stdout vira um pipe lido devagar (como um coletor de logs atrasado). N
+tasks "logam" a resposta de um upstream (--body bytes) e o bench mede quanto
+cada chamada segura o event loop e o atraso de um timer de 10ms rodando ao
+lado. Com print() o loop trava quando o pipe enche; com log.py a chamada só
+enfileira (fila cheia descarta e conta em log_records_dropped_total).
+
+    python bench/log_overhead.py --records 2000 --body 4096 --reader-delay 0.001
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def slow_reader(fd: int, delay: float, stop: threading.Event):
+    while not stop.is_set():
+        if not os.read(fd, 4096):
+            return
+        time.sleep(delay)
+
+
+async def run(emit, records: int, tasks: int) -> dict:
+    costs, lags = [], []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    async def worker(n: int):
+        for i in range(n):
+            started = time.perf_counter()
+            emit(i)
+            costs.append(time.perf_counter() - started)
+            await asyncio.sleep(0)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(records // tasks) for _ in range(tasks)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await tick
+    us = sorted(c * 1e6 for c in costs)
+    ms = sorted(l * 1000 for l in lags) or [0.0]
+    return {"elapsed": elapsed, "p50": statistics.median(us), "p99": us[int(len(us) * 0.99) - 1],
+            "lag_max": ms[-1]}
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--tasks", type=int, default=20)
+    parser.add_argument("--body", type=int, default=4096, help="tamanho do corpo logado (bytes)")
+    parser.add_argument("--reader-delay", type=float, default=0.001, help="pausa do leitor a cada 4KB (s)")
+    args = parser.parse_args()
+
+    # stdout -> pipe com leitor lento; o relatório sai no stderr
+    read_fd, write_fd = os.pipe()
+    os.dup2(write_fd, 1)
+    stop = threading.Event()
+    threading.Thread(target=slow_reader, args=(read_fd, args.reader_delay, stop), daemon=True).start()
+
+    import log
+    logger = log.get("bench")
+    body = "x" * args.body
+
+    def with_print(i):
+        print(f"→ [outbox] Purchase #{i}:", 200, body, flush=True)
+
+    def with_log(i):
+        logger.info("enviado", label="Purchase", status=200, body=body)
+
+    results = {name: asyncio.run(run(emit, args.records, args.tasks))
+               for name, emit in (("print()", with_print), ("log.py", with_log))}
+    log.flush()
+    stop.set()
+
+    dropped = sum(log.DROPPED._values.values())
+    for name, r in results.items():
+        print(f"{name:8} {args.records} registros em {r['elapsed']:.2f}s; por chamada p50 {r['p50']:.0f}µs, "
+              f"p99 {r['p99']:.0f}µs; atraso máximo do timer {r['lag_max']:.1f}ms", file=sys.stderr)
+    print(f"log.py: corpo truncado em {log.LOG_FIELD_MAX} caracteres, {dropped:.0f} registros descartados "
+          f"(fila de {log.LOG_QUEUE_SIZE})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,132 @@
+"""
+Rajada de IPNs do PayPal (com reenvios duplicados) contra o /track-paypal.
+
+Mede o tempo de resposta do endpoint (só grava e devolve 200) e, depois
+que as filas drenam, quantas validações foram ao PayPal e quantos
+Customers / eventos de tracking saíram: um por txn_id, por mais reenvios
+que cheguem. Antes da rajada chegam IPNs forjados (o PayPal responde
+INVALID) com txn_ids das transações reais, que não podem barrar as
+verdadeiras.
+
+    python bench/paypal_ipn_burst.py --txns 50 --dups 4 --latency 0.3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import fake_paypal
+import fake_stripe
+from fakes import serve_in_background
+
+
+RECEIVED = {"graph": 0, "utmify": 0}
+
+
+async def fake_graph_events(request):
+    body = await request.json()
+    RECEIVED["graph"] += len(body.get("data", []))
+    return JSONResponse({"events_received": len(body.get("data", []))})
+
+
+async def fake_utmify(request):
+    RECEIVED["utmify"] += 1
+    return JSONResponse({"ok": True})
+
+
+def ipn_body(i: int, invalid: bool = False) -> bytes:
+    fields = {
+        "txn_id": f"TXN{i:08d}", "payment_status": "Completed", "payer_email": f"buyer{i}@example.com",
+        "mc_gross": "47.00", "mc_currency": "USD", "item_number": "ebook", "item_name": "Ebook",
+        "quantity": "1", "custom_utm_source": "bench",
+    }
+    if invalid:
+        fields["test_invalid"] = "1"
+    return urllib.parse.urlencode(fields).encode()
+
+
+async def run(txns: int, dups: int, invalid: int):
+    import httpx
+    import main
+
+    bodies = [ipn_body(i) for i in range(txns) for _ in range(dups)]
+    forged = [ipn_body(i, invalid=True) for i in range(invalid)]   # mesmos txn_ids das reais
+    transport = httpx.ASGITransport(app=main.app, client=("127.0.0.1", 1234))
+    conn = main.webhook_queue.store.connect()
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+            async def one(body):
+                started = time.perf_counter()
+                resp = await client.post("/track-paypal", content=body,
+                                         headers={"Content-Type": "application/x-www-form-urlencoded"})
+                resp.raise_for_status()
+                return time.perf_counter() - started
+
+            # forjados primeiro, já recusados pelo PayPal quando as reais chegam
+            await asyncio.gather(*(one(b) for b in forged))
+            while conn.execute("SELECT COUNT(*) FROM webhook_events WHERE dead = 0").fetchone()[0]:
+                await asyncio.sleep(0.05)
+
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(one(b) for b in bodies))
+            accepted = time.perf_counter() - started
+
+        # espera a fila de IPNs e depois o outbox (tracking) drenarem
+        for table in ("webhook_events", "outbox"):
+            while conn.execute(f"SELECT COUNT(*) FROM {table} WHERE dead = 0").fetchone()[0]:
+                await asyncio.sleep(0.05)
+        drained = time.perf_counter() - started
+    return latencies, accepted, drained
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--txns", type=int, default=50, help="transações distintas")
+    parser.add_argument("--dups", type=int, default=4, help="envios de cada IPN")
+    parser.add_argument("--invalid", type=int, default=5, help="IPNs forjados (o PayPal recusa) com txn_id real")
+    parser.add_argument("--latency", type=float, default=0.3, help="latência da validação no PayPal (s)")
+    args = parser.parse_args()
+    fake_paypal.LATENCY = args.latency
+
+    port = serve_in_background(Starlette(routes=[
+        *fake_stripe.app.routes,
+        *fake_paypal.routes,
+        Route("/graph/{pixel}/events", fake_graph_events, methods=["POST"]),
+        Route("/utmify", fake_utmify, methods=["POST"]),
+    ]))
+    base = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "PIXEL_ID":          "bench",
+        "ACCESS_TOKEN":      "bench",
+        "GRAPH_API_URL":     f"{base}/graph",
+        "UTMIFY_API_URL":    f"{base}/utmify",
+        "UTMIFY_API_KEY":    "bench",
+        "PAYPAL_IPN_URL":    f"{base}/cgi-bin/webscr",
+        "STATE_DB_PATH":     os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stripe
+    stripe.api_base = base
+
+    latencies, accepted, drained = asyncio.run(run(args.txns, args.dups, args.invalid))
+    ms = sorted(l * 1000 for l in latencies)
+    print(f"{len(ms)} IPNs aceitos em {accepted:.2f}s "
+          f"(p50 {statistics.median(ms):.1f}ms, p99 {ms[int(len(ms) * 0.99) - 1]:.1f}ms); fila drenada em {drained:.2f}s")
+    print(f"validações no PayPal: {fake_paypal.CALLS}  Customer.create: {fake_stripe.CALLS['Customer.create']}")
+    print(f"eventos na CAPI: {RECEIVED['graph']}  pedidos na UTMify: {RECEIVED['utmify']}")
+    if fake_stripe.CALLS["Customer.create"] != args.txns or any(n != args.txns for n in RECEIVED.values()):
+        print("‼️ esperado exatamente um Customer/evento por txn_id verificado")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
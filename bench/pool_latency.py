@@ -0,0 +1,75 @@
+"""
+Micro-benchmark: latência por chamada com pool frio x pool quente.
+
+- frio:   um cliente novo por chamada (TCP + TLS a cada vez, como o
+          requests.post() de antes);
+- quente: o cliente compartilhado de upstreams.get_client() (keep-alive).
+
+Por padrão mede contra um fake local (só TCP); use --url para medir contra
+um endpoint HTTPS real e ver o custo do handshake TLS, ex.:
+
+    python bench/pool_latency.py --url https://graph.facebook.com/ --calls 20
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from fakes import serve_in_background
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import upstreams  # noqa: E402
+
+
+async def _ok(request):
+    return PlainTextResponse("ok")
+
+
+def _summary(label: str, samples: list) -> str:
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    return f"{label:<7} média {statistics.mean(ms):7.2f}ms  p50 {statistics.median(ms):7.2f}ms  p95 {p95:7.2f}ms"
+
+
+async def run(url: str, calls: int):
+    cold = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        async with httpx.AsyncClient() as client:
+            await client.get(url)
+        cold.append(time.perf_counter() - started)
+
+    client = upstreams.get_client("graph")
+    await client.get(url)  # aquece a conexão
+    warm = []
+    for _ in range(calls):
+        started = time.perf_counter()
+        await client.get(url)
+        warm.append(time.perf_counter() - started)
+    await upstreams.aclose()
+    return cold, warm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", help="endpoint a medir (padrão: fake local)")
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    url = args.url or f"http://127.0.0.1:{serve_in_background(Starlette(routes=[Route('/', _ok)]))}/"
+    cold, warm = asyncio.run(run(url, args.calls))
+    print(f"{url} — {args.calls} chamadas sequenciais")
+    print(_summary("frio", cold))
+    print(_summary("quente", warm))
+    print(f"economia por chamada: {(statistics.mean(cold) - statistics.mean(warm)) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Rajada de escritas na Stripe contra um fake que devolve 429 acima de um
+limite por segundo (como o rate limit por conta da Stripe).
+
+Roda a mesma rajada de Customer.modify com o token bucket de escrita abaixo
+e acima do limite do fake: abaixo quase não há 429; acima os 429 são
+repetidos com backoff e o mesmo Idempotency-Key, e nenhuma chamada falha.
+
+    python bench/stripe_rate_limit.py --calls 300 --limit 40 --rates 35,80
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+
+import fake_stripe
+from fakes import serve_in_background
+
+LIMIT = 40
+_window = [0, 0]                     # [segundo, requisições nele]
+REJECTED = Counter()
+KEYS = defaultdict(list)             # Idempotency-Key -> status de cada tentativa
+
+
+class RateLimited:
+    """Middleware ASGI: mais de LIMIT requisições no mesmo segundo -> 429."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope["headers"])
+        key = headers.get(b"idempotency-key", b"").decode()
+        second = int(time.monotonic())
+        if _window[0] != second:
+            _window[:] = [second, 0]
+        _window[1] += 1
+        if _window[1] > LIMIT:
+            REJECTED["429"] += 1
+            KEYS[key].append(429)
+            resp = JSONResponse(
+                {"error": {"type": "invalid_request_error", "code": "rate_limit",
+                           "message": "Too many requests hit the API too quickly."}},
+                status_code=429, headers={"Retry-After": "1"},
+            )
+            return await resp(scope, receive, send)
+        KEYS[key].append(200)
+        return await self.app(scope, receive, send)
+
+
+async def burst(calls: int, customers: list):
+    import stripe
+    from upstreams import stripe_call
+
+    async def one(i):
+        try:
+            await stripe_call(stripe.Customer.modify, customers[i % len(customers)]["id"], metadata={"n": str(i)})
+            return None
+        except Exception as e:
+            return e
+
+    started = time.perf_counter()
+    errors = [e for e in await asyncio.gather(*(one(i) for i in range(calls))) if e is not None]
+    return time.perf_counter() - started, errors
+
+
+def main_():
+    global LIMIT
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--limit", type=int, default=40, help="requisições/s que o fake aceita")
+    parser.add_argument("--rates", default="35,80", help="STRIPE_RATE_WRITE a testar (vírgula)")
+    args = parser.parse_args()
+    LIMIT = args.limit
+
+    port = serve_in_background(RateLimited(Starlette(routes=fake_stripe.app.routes)))
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STRIPE_MAX_CONCURRENCY": "32",
+        "STATE_DB_PATH": os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stripe
+    import upstreams
+    from resilience import TokenBucket
+    stripe.api_key = "sk_test_bench"
+    stripe.api_base = f"http://127.0.0.1:{port}"
+    customers = [fake_stripe.seed_customer(f"buyer{i}@example.com") for i in range(20)]
+
+    failed = False
+    for rate in (float(r) for r in args.rates.split(",")):
+        upstreams.STRIPE_BUCKETS["write"] = TokenBucket(rate)
+        REJECTED.clear()
+        KEYS.clear()
+        fake_stripe.CALLS.clear()
+        time.sleep(1.1)   # janela do fake zerada
+        elapsed, errors = asyncio.run(burst(args.calls, customers))
+        retried = [k for k, statuses in KEYS.items() if 429 in statuses]
+        done_once = all(statuses.count(200) == 1 for statuses in KEYS.values())
+        print(f"STRIPE_RATE_WRITE={rate:g}: {args.calls} chamadas em {elapsed:.2f}s "
+              f"({args.calls / elapsed:.1f}/s, limite do fake {LIMIT}/s); 429: {REJECTED['429']}, "
+              f"chaves repetidas após 429: {len(retried)}, falhas: {len(errors)}")
+        if errors or not done_once or fake_stripe.CALLS["Customer.modify"] != args.calls:
+            print(f"‼️ esperado zero falhas e cada Idempotency-Key aceito uma única vez ({errors[:1]})")
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
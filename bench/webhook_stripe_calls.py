@@ -0,0 +1,89 @@
+"""
+Conta as chamadas à API da Stripe por evento de webhook processado.
+
+Roda os handlers do main.py contra o Stripe fake (bench/fake_stripe.py) e
+mostra quantas chamadas cada evento fez, por operação, e quanto tempo cada
+evento levou (com --latency aparecem os ramos independentes em paralelo).
+Falha se aparecer alguma busca redundante (retrieve de algo que já veio no
+payload ou a mesma listagem duas vezes) ou se, com o mesmo customer
+comprando de novo, algum item já faturado for tratado como pendente.
+
+    python bench/webhook_stripe_calls.py --events 5 --latency 0.1
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import fake_stripe
+from fakes import serve_in_background
+
+# chamadas que a hidratação elimina
+REDUNDANT = ("checkout.Session.retrieve", "Customer.retrieve")
+
+
+async def run(n: int):
+    import main
+
+    results = {}
+    for event_type, seed, handler in (
+        ("checkout.session.completed", fake_stripe.seed_session, main.handle_checkout_completed),
+        ("payment_intent.succeeded", fake_stripe.seed_payment_intent, main.handle_payment_intent_succeeded),
+    ):
+        fake_stripe.CALLS.clear()
+        elapsed = 0.0
+        for i in range(n):
+            obj = seed()
+            started = time.perf_counter()
+            await handler({"id": f"evt_{event_type}_{i}", "type": event_type, "data": {"object": obj}})
+            elapsed += time.perf_counter() - started
+        results[event_type] = (dict(fake_stripe.CALLS), elapsed / n)
+
+    # cliente que volta: os itens da 1ª compra já estão faturados, não são "pendentes antigos"
+    fake_stripe.CALLS.clear()
+    customer, elapsed = fake_stripe.seed_customer(), 0.0
+    for i in range(n):
+        obj = fake_stripe.seed_session(customer=customer)
+        started = time.perf_counter()
+        await main.handle_checkout_completed({"id": f"evt_repeat_{i}", "type": "checkout.session.completed",
+                                              "data": {"object": obj}})
+        elapsed += time.perf_counter() - started
+    results["checkout.session.completed (mesmo customer)"] = (dict(fake_stripe.CALLS), elapsed / n)
+    return results
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=5, help="eventos de cada tipo")
+    parser.add_argument("--latency", type=float, default=0.0, help="latência de cada chamada à Stripe (s)")
+    args = parser.parse_args()
+    fake_stripe.LATENCY = args.latency
+
+    port = serve_in_background(fake_stripe.app)
+    os.environ.update({
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STATE_DB_PATH":     os.path.join(tempfile.mkdtemp(), "bench.db"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import stripe
+    stripe.api_key = "sk_test_bench"
+    stripe.api_base = f"http://127.0.0.1:{port}"
+    fake_stripe.seed_price("price_fake")
+
+    failed = False
+    for event_type, (calls, per_event) in asyncio.run(run(args.events)).items():
+        total = sum(calls.values())
+        print(f"{event_type}: {total / args.events:.1f} chamadas/evento, {per_event * 1000:.0f}ms/evento")
+        for op, count in sorted(calls.items()):
+            print(f"   {op:<36} {count / args.events:.1f}")
+            if op in REDUNDANT or (op.endswith("list_line_items") and count > args.events) or op == "InvoiceItem.delete":
+                failed = True
+    if failed:
+        print("‼️ busca redundante na Stripe (ou item já faturado tratado como pendente)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
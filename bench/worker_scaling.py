@@ -0,0 +1,187 @@
+"""
+Escala por CPU: o app em `uvicorn --workers N` (como no Procfile) contra
+upstreams fake, com rajada de webhooks assinados.
+
+Para cada N mede requisições/s e latência do /webhook, confere que só um
+worker listou o catálogo no startup (cache compartilhado no SQLite), que o
+/health respondeu por mais de um worker e, depois de um SIGTERM no meio da
+carga, que nenhum evento ficou preso com lease (o que não deu tempo de
+processar voltou para a fila).
+
+    python bench/worker_scaling.py --workers 1,2,4 --seconds 10 --clients 32
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import signal
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+import fake_stripe
+from fakes import serve_in_background
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "whsec_bench"
+
+
+async def fake_graph_events(request):
+    body = await request.json()
+    return JSONResponse({"events_received": len(body.get("data", []))})
+
+
+async def fake_utmify(request):
+    return JSONResponse({"ok": True})
+
+
+def signed(event: dict) -> tuple:
+    payload = json.dumps(event).encode()
+    t = int(time.time())
+    sig = hmac.new(SECRET.encode(), f"{t}.".encode() + payload, hashlib.sha256).hexdigest()
+    return payload, {"Stripe-Signature": f"t={t},v1={sig}", "Content-Type": "application/json"}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(base: str, workers: int, timeout: float = 60) -> set:
+    """Espera o /health dar 200; devolve os pids de worker que responderam."""
+    pids = set()
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base) as client:
+        while time.monotonic() < deadline and len(pids) < workers:
+            try:
+                # conexões novas, para cair em workers diferentes
+                resp = await client.get("/health", headers={"Connection": "close"})
+                if resp.status_code == 200:
+                    pids.add(resp.json()["worker"])
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.05)
+    return pids
+
+
+async def load(base: str, seconds: float, clients: int, sessions: list) -> list:
+    latencies = []
+    deadline = time.monotonic() + seconds
+    counter = iter(range(10 ** 9))
+
+    async def client_loop(client):
+        while time.monotonic() < deadline:
+            i = next(counter)
+            session = sessions[i % len(sessions)]
+            payload, headers = signed({
+                "id": f"evt_bench_{os.getpid()}_{time.monotonic_ns()}_{i}", "object": "event",
+                "type": "checkout.session.completed", "data": {"object": session},
+            })
+            started = time.perf_counter()
+            resp = await client.post("/webhook", content=payload, headers=headers)
+            resp.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(clients)))
+    return latencies
+
+
+def run(n: int, args, fakes_base: str, sessions: list) -> dict:
+    db = os.path.join(tempfile.mkdtemp(), "bench.db")
+    port = free_port()
+    env = {
+        **os.environ,
+        "WEB_CONCURRENCY":       str(n),
+        "STRIPE_SECRET_KEY":     "sk_test_bench",
+        "STRIPE_WEBHOOK_SECRET": SECRET,
+        "STRIPE_API_BASE":       fakes_base,
+        "GRAPH_API_URL":         f"{fakes_base}/graph",
+        "UTMIFY_API_URL":        f"{fakes_base}/utmify",
+        "PIXEL_ID":              "bench",
+        "ACCESS_TOKEN":          "bench",
+        "UTMIFY_API_KEY":        "bench",
+        "STATE_DB_PATH":         db,
+        "SHUTDOWN_DRAIN_SECONDS": str(args.drain),
+    }
+    fake_stripe.CALLS.clear()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(n), "--timeout-graceful-shutdown", "10", "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    try:
+        pids = asyncio.run(wait_ready(base, n))
+        started = time.perf_counter()
+        latencies = asyncio.run(load(base, args.seconds, args.clients, sessions))
+        elapsed = time.perf_counter() - started
+        warm_calls = fake_stripe.CALLS["Price.list"]
+
+        # SIGTERM com a fila ainda cheia: tem que sair drenando, sem evento preso
+        term = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=60)
+        shutdown = time.perf_counter() - term
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+    conn = sqlite3.connect(db)
+    queued = conn.execute("SELECT COUNT(*) FROM webhook_events WHERE dead = 0").fetchone()[0]
+    stuck = conn.execute("SELECT COUNT(*) FROM webhook_events WHERE locked_until > ?", (time.time(),)).fetchone()[0]
+    processed = conn.execute("SELECT COUNT(*) FROM processed_keys WHERE namespace = 'stripe_event'").fetchone()[0]
+    ms = sorted(l * 1000 for l in latencies)
+    return {
+        "workers": n, "rps": len(ms) / elapsed, "p50": statistics.median(ms), "p99": ms[int(len(ms) * 0.99) - 1],
+        "health_pids": len(pids), "catalog_lists": warm_calls, "accepted": len(ms),
+        "processed": processed, "queued": queued, "stuck": stuck, "shutdown": shutdown,
+    }
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--drain", type=float, default=15, help="SHUTDOWN_DRAIN_SECONDS")
+    args = parser.parse_args()
+
+    port = serve_in_background(Starlette(routes=[
+        *fake_stripe.app.routes,
+        Route("/graph/{pixel}/events", fake_graph_events, methods=["POST"]),
+        Route("/utmify", fake_utmify, methods=["POST"]),
+    ]))
+    fake_stripe.seed_price("price_bench")
+    sessions = [fake_stripe.seed_session("price_bench") for _ in range(200)]
+
+    print(f"CPUs: {os.cpu_count()}")
+    failed = False
+    for n in (int(w) for w in args.workers.split(",")):
+        r = run(n, args, f"http://127.0.0.1:{port}", sessions)
+        print(f"--workers {r['workers']}: {r['rps']:.0f} webhooks/s (p50 {r['p50']:.1f}ms, p99 {r['p99']:.1f}ms); "
+              f"/health de {r['health_pids']} workers; Price.list no startup: {r['catalog_lists']}; "
+              f"SIGTERM -> saiu em {r['shutdown']:.1f}s, {r['processed']} processados + {r['queued']} na fila "
+              f"de {r['accepted']}, {r['stuck']} presos")
+        if r["stuck"] or r["catalog_lists"] > 1 or r["processed"] + r["queued"] != r["accepted"]:
+            failed = True
+    if failed:
+        print("‼️ esperado: um Price.list só, nenhum evento preso e nenhum perdido")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,109 @@
+"""
+Cache do catálogo (Price + Product expandido).
+
+Aquecido no startup com stripe.Price.list(expand=["data.product"]); as
+entradas têm TTL e são invalidadas pelos webhooks price.* / product.*.
+Fica no SQLite local para que todos os workers enxerguem a mesma
+invalidação (o evento é processado por um worker só) e o mesmo
+aquecimento: com --workers só um deles lista o catálogo (warm_shared).
+"""
+import os
+import time
+
+import stripe
+
+import fastjson
+import metrics
+import store
+from upstreams import stripe_call
+
+CATALOG_TTL_SECONDS = float(os.getenv("CATALOG_TTL_SECONDS", "3600"))
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS catalog_prices (
+    price_id   TEXT PRIMARY KEY,
+    product_id TEXT,
+    data       TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS catalog_prices_product ON catalog_prices (product_id);
+""")
+
+LOOKUPS = metrics.Counter("catalog_lookups_total", "Consultas ao cache de catálogo", ("result",))
+
+
+def _product_id(price) -> str:
+    prod = price.get("product")
+    return prod.get("id") if hasattr(prod, "get") else prod
+
+
+def _put_many(prices):
+    expires_at = time.time() + CATALOG_TTL_SECONDS
+    store.connect().executemany(
+        "INSERT OR REPLACE INTO catalog_prices (price_id, product_id, data, expires_at) VALUES (?, ?, ?, ?)",
+        [(p["id"], _product_id(p), fastjson.dumps_str(p), expires_at) for p in prices],
+    )
+
+
+def warm() -> int:
+    """Carrega o catálogo inteiro (síncrona: rode via stripe_call)."""
+    prices = list(stripe.Price.list(limit=100, expand=["data.product"]).auto_paging_iter())
+    _put_many(prices)
+    return len(prices)
+
+
+def warm_shared(wait: float = 15.0) -> int:
+    """
+    warm() num worker só: quem pega o lease lista o catálogo, os outros
+    esperam o cache dele (até `wait` s). Síncrona: rode via stripe_call.
+    """
+    if store.claim("catalog.warm", CATALOG_TTL_SECONDS / 2):
+        try:
+            return warm()
+        except Exception:
+            store.release("catalog.warm")
+            raise
+    deadline = time.monotonic() + wait
+    while True:
+        n = cached_count()
+        if n or time.monotonic() >= deadline:
+            return n
+        time.sleep(0.2)
+
+
+def cached_count() -> int:
+    return store.connect().execute(
+        "SELECT COUNT(*) FROM catalog_prices WHERE expires_at > ?", (time.time(),)
+    ).fetchone()[0]
+
+
+def cached_price(price_id: str):
+    """Price do cache local (ou None), sem ir na Stripe."""
+    row = store.connect().execute(
+        "SELECT data FROM catalog_prices WHERE price_id = ? AND expires_at > ?",
+        (price_id, time.time()),
+    ).fetchone()
+    if row is None:
+        return None
+    return stripe.Price.construct_from(fastjson.loads(row["data"]), stripe.api_key)
+
+
+async def get_price(price_id: str):
+    """Price com `product` expandido; só vai na Stripe se não estiver no cache."""
+    price = cached_price(price_id)
+    if price is not None:
+        LOOKUPS.inc(result="hit")
+        return price
+    LOOKUPS.inc(result="miss")
+    price = await stripe_call(stripe.Price.retrieve, price_id, expand=["product"])
+    _put_many([price])
+    return price
+
+
+def invalidate(event: dict):
+    """Descarta as entradas afetadas por um evento price.* ou product.*."""
+    obj = event["data"]["object"]
+    if event["type"].startswith("price."):
+        store.connect().execute("DELETE FROM catalog_prices WHERE price_id = ?", (obj["id"],))
+    elif event["type"].startswith("product."):
+        store.connect().execute("DELETE FROM catalog_prices WHERE product_id = ?", (obj["id"],))
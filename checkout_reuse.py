@@ -0,0 +1,98 @@
+"""
+Reaproveitamento de Sessions do Checkout ainda abertas.
+
+Reload da página ou duplo clique no botão de compra com os mesmos dados
+(price_id, quantity, comprador e UTMs) devolve a Session já criada, sem
+Session.create nem InitiateCheckout/UTMify duplicados. Só há reuso pelos
+dados quando o comprador é identificado (e-mail ou visitor_id/cart_id do
+cliente): sem isso, quem clica no mesmo anúncio manda dados idênticos e
+pegaria a Session de outra pessoa. O header opcional Idempotency-Key é
+chave sempre: repetir a chave devolve a mesma Session, e repeti-la com
+outros dados é erro. As entradas ficam no SQLite (valem em
+todos os workers), expiram bem antes da Session na Stripe (24h) e saem no
+checkout.session.completed.
+"""
+import hashlib
+import json
+import os
+import time
+
+import metrics
+import orders
+import store
+
+CHECKOUT_REUSE_TTL_SECONDS = float(os.getenv("CHECKOUT_REUSE_TTL_SECONDS", "1800"))
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS checkout_reuse (
+    key          TEXT PRIMARY KEY,      -- fp:<fingerprint> ou idem:<Idempotency-Key>
+    fingerprint  TEXT NOT NULL,
+    session_id   TEXT NOT NULL,
+    checkout_url TEXT NOT NULL,
+    expires_at   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS checkout_reuse_session ON checkout_reuse (session_id);
+CREATE INDEX IF NOT EXISTS checkout_reuse_expiry ON checkout_reuse (expires_at);
+""")
+
+LOOKUPS = metrics.Counter("checkout_reuse_lookups_total", "Consultas ao cache de Sessions abertas", ("result",))
+
+
+class IdempotencyKeyMismatch(Exception):
+    """Idempotency-Key já usado com outros dados de checkout."""
+
+
+def fingerprint(price_id: str, quantity, customer_email: str, utms: dict, visitor_id: str = None) -> str:
+    raw = json.dumps(
+        [price_id, str(quantity), (customer_email or "").strip().lower(), visitor_id or "", orders.utms(utms)],
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def identified(customer_email: str, visitor_id: str = None) -> bool:
+    """Só com o comprador identificado o fingerprint separa uma pessoa da outra."""
+    return bool((customer_email or "").strip() or visitor_id)
+
+
+def get(fp: str, idempotency_key: str = None, by_fingerprint: bool = True):
+    """
+    {"session_id", "checkout_url"} de uma Session aberta com a mesma chave, ou
+    None. by_fingerprint=False consulta só o Idempotency-Key (comprador anônimo).
+    """
+    conn = store.connect()
+    now = time.time()
+    keys = ([f"idem:{idempotency_key}"] if idempotency_key else []) + ([f"fp:{fp}"] if by_fingerprint else [])
+    for key in keys:
+        row = conn.execute(
+            "SELECT fingerprint, session_id, checkout_url FROM checkout_reuse WHERE key = ? AND expires_at > ?",
+            (key, now),
+        ).fetchone()
+        if row is None:
+            continue
+        if row["fingerprint"] != fp:
+            LOOKUPS.inc(result="conflict")
+            raise IdempotencyKeyMismatch(idempotency_key)
+        LOOKUPS.inc(result="hit")
+        return {"session_id": row["session_id"], "checkout_url": row["checkout_url"]}
+    LOOKUPS.inc(result="miss")
+    return None
+
+
+def put(fp: str, idempotency_key: str, session_id: str, checkout_url: str, by_fingerprint: bool = True):
+    now = time.time()
+    keys = ([f"fp:{fp}"] if by_fingerprint else []) + ([f"idem:{idempotency_key}"] if idempotency_key else [])
+    if not keys:
+        return
+    with store.transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO checkout_reuse (key, fingerprint, session_id, checkout_url, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(key, fp, session_id, checkout_url, now + CHECKOUT_REUSE_TTL_SECONDS) for key in keys],
+        )
+        conn.execute("DELETE FROM checkout_reuse WHERE expires_at <= ?", (now,))
+
+
+def forget(session_id: str):
+    """Session paga (ou encerrada): não serve mais para ninguém."""
+    store.connect().execute("DELETE FROM checkout_reuse WHERE session_id = ?", (session_id,))
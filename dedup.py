@@ -0,0 +1,87 @@
+"""
+Deduplicação de eventos já processados (entregas at-least-once).
+
+LRU em memória na frente de uma tabela SQLite compartilhada entre os
+workers do uvicorn; as chaves expiram por TTL. Os contadores de hit/miss
+ficam em /metrics (dedup_lookups_total).
+"""
+import os
+import time
+from collections import OrderedDict
+
+import metrics
+import store
+
+DEDUP_TTL_SECONDS    = float(os.getenv("DEDUP_TTL_SECONDS", str(7 * 24 * 3600)))  # Stripe reentrega por até 3 dias
+DEDUP_LRU_SIZE       = int(os.getenv("DEDUP_LRU_SIZE", "10000"))
+DEDUP_EVICT_INTERVAL = float(os.getenv("DEDUP_EVICT_INTERVAL", "600"))
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS processed_keys (
+    namespace  TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS processed_keys_expiry ON processed_keys (expires_at);
+""")
+
+LOOKUPS = metrics.Counter(
+    "dedup_lookups_total", "Consultas ao store de deduplicação", ("namespace", "result")
+)
+
+
+class ProcessedStore:
+    """Conjunto de chaves já processadas de um namespace (ex.: "stripe_event")."""
+
+    def __init__(self, namespace: str, ttl: float = DEDUP_TTL_SECONDS, maxsize: int = DEDUP_LRU_SIZE):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lru = OrderedDict()   # key -> expires_at
+        self._last_evict = 0.0
+
+    def _remember(self, key: str, expires_at: float):
+        self._lru[key] = expires_at
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def seen(self, key: str) -> bool:
+        now = time.time()
+        expires_at = self._lru.get(key)
+        if expires_at is not None and expires_at > now:
+            self._lru.move_to_end(key)
+            LOOKUPS.inc(namespace=self.namespace, result="hit")
+            return True
+
+        row = store.connect().execute(
+            "SELECT expires_at FROM processed_keys WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (self.namespace, key, now),
+        ).fetchone()
+        if row:
+            self._remember(key, row["expires_at"])
+            LOOKUPS.inc(namespace=self.namespace, result="hit")
+            return True
+
+        LOOKUPS.inc(namespace=self.namespace, result="miss")
+        return False
+
+    def mark(self, key: str):
+        now = time.time()
+        expires_at = now + self.ttl
+        store.connect().execute(
+            "INSERT OR REPLACE INTO processed_keys (namespace, key, expires_at) VALUES (?, ?, ?)",
+            (self.namespace, key, expires_at),
+        )
+        self._remember(key, expires_at)
+        if now - self._last_evict > DEDUP_EVICT_INTERVAL:
+            self._last_evict = now
+            self.evict_expired()
+
+    def evict_expired(self) -> int:
+        cur = store.connect().execute(
+            "DELETE FROM processed_keys WHERE namespace = ? AND expires_at <= ?",
+            (self.namespace, time.time()),
+        )
+        return cur.rowcount
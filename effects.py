@@ -0,0 +1,103 @@
+"""
+Executor de efeitos colaterais dos handlers como um grafo de dependências.
+
+Cada tarefa declara de quais outras depende (`after`) e recebe os
+resultados delas como argumentos; ramos independentes rodam em paralelo,
+então o handler leva o tempo do ramo mais longo e não a soma. Uma falha
+só derruba as tarefas que dependem dela; as demais rodam até o fim e o
+primeiro erro é relançado no final (o webhook_queue faz o retry).
+
+Com `key` (o id do evento), as tarefas registradas com once=True que já
+terminaram numa tentativa anterior não rodam de novo no retry: só o ramo
+que falhou é refeito. O resultado delas não é guardado (devolvem None no
+retry), então use once só em efeitos dos quais ninguém depende.
+"""
+import asyncio
+import inspect
+import time
+
+import dedup
+import log
+import metrics
+
+logger = log.get("effects")
+
+_done = dedup.ProcessedStore("effect")   # "grafo:key:tarefa" já concluída
+
+EFFECT_DURATION = metrics.Histogram(
+    "handler_effect_seconds", "Duração de cada efeito colateral dos handlers", ("graph", "task", "result")
+)
+
+
+class SkippedError(Exception):
+    """A tarefa não rodou porque uma dependência falhou."""
+
+
+class TaskGraph:
+    def __init__(self, name: str, key: str = None):
+        self.name = name
+        self.key = key
+        self._tasks = {}   # nome -> (fn, dependências), em ordem de inserção
+        self._once = set()
+
+    def add(self, name: str, fn, after=(), once: bool = False):
+        """Registra `fn(*resultados_de_after)`; sync ou async. Dependências vêm antes."""
+        for dep in after:
+            if dep not in self._tasks:
+                raise ValueError(f"{self.name}: {name!r} depende de {dep!r}, que não foi registrada")
+        if name in self._tasks:
+            raise ValueError(f"{self.name}: tarefa {name!r} duplicada")
+        self._tasks[name] = (fn, tuple(after))
+        if once:
+            self._once.add(name)
+
+    def _done_key(self, name: str):
+        if self.key is None or name not in self._once:
+            return None
+        return f"{self.name}:{self.key}:{name}"
+
+    async def _run_one(self, futures: dict, name: str, fn, deps: tuple):
+        done_key = self._done_key(name)
+        if done_key is not None and _done.seen(done_key):
+            logger.info("tarefa já concluída numa tentativa anterior", graph=self.name, task=name)
+            return None
+        args = []
+        for dep in deps:
+            try:
+                args.append(await futures[dep])
+            except Exception as e:
+                raise SkippedError(f"{dep} falhou") from e
+        started = time.perf_counter()
+        result = "ok"
+        try:
+            value = fn(*args)
+            if inspect.isawaitable(value):
+                value = await value
+            if done_key is not None:
+                _done.mark(done_key)
+            return value
+        except Exception:
+            result = "error"
+            raise
+        finally:
+            EFFECT_DURATION.observe(time.perf_counter() - started, graph=self.name, task=name, result=result)
+
+    async def run(self) -> dict:
+        """Roda o grafo; devolve {tarefa: resultado} ou relança o primeiro erro."""
+        futures = {}
+        for name, (fn, deps) in self._tasks.items():
+            futures[name] = asyncio.ensure_future(self._run_one(futures, name, fn, deps))
+        outcomes = await asyncio.gather(*futures.values(), return_exceptions=True)
+
+        results, first_error = {}, None
+        for name, outcome in zip(futures, outcomes):
+            if isinstance(outcome, SkippedError):
+                logger.info("tarefa não rodou", graph=self.name, task=name, reason=str(outcome))
+            elif isinstance(outcome, BaseException):
+                logger.error("tarefa falhou", graph=self.name, task=name, error=repr(outcome))
+                first_error = first_error or outcome
+            else:
+                results[name] = outcome
+        if first_error is not None:
+            raise first_error
+        return results
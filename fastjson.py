@@ -0,0 +1,48 @@
+"""
+JSON dos payloads (webhooks, filas no SQLite, CAPI/UTMify e respostas).
+
+Usa o orjson quando está instalado e cai no json da stdlib quando não está
+(ou com FAST_JSON=0). A saída é a mesma nos dois: UTF-8, sem espaços.
+dumps() devolve bytes (corpo HTTP); dumps_str() é para colunas TEXT.
+"""
+import importlib.util
+import json
+import os
+
+from fastapi.responses import JSONResponse as _JSONResponse
+
+FAST_JSON = os.getenv("FAST_JSON", "1") == "1" and importlib.util.find_spec("orjson") is not None
+
+if FAST_JSON:
+    import orjson
+
+    JSONDecodeError = orjson.JSONDecodeError   # subclasse de json.JSONDecodeError
+
+    def loads(data):
+        """bytes, memoryview ou str."""
+        return orjson.loads(data)
+
+    def dumps(obj, default=None) -> bytes:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_str(obj, default=None) -> str:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
+else:
+    JSONDecodeError = json.JSONDecodeError
+
+    def loads(data):
+        """bytes, memoryview ou str."""
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+    def dumps_str(obj, default=None) -> str:
+        return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj, default=None) -> bytes:
+        return dumps_str(obj, default).encode()
+
+
+class JSONResponse(_JSONResponse):
+    """JSONResponse do FastAPI serializando com dumps()."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,144 @@
+"""
+Roteamento price_id -> funil (success/cancel URL, footer da invoice e
+quantidades permitidas), carregado de funnels.json (ou FUNNELS_JSON).
+
+Cada funil herda de "default" o que não definir. O arquivo é relido quando
+o mtime muda (checado no máximo a cada FUNNELS_RELOAD_INTERVAL segundos),
+então lançar um produto novo é só publicar a config, sem restart. Uma
+config inválida é rejeitada e a anterior continua valendo.
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import catalog
+import log
+
+FUNNELS_CONFIG          = os.getenv("FUNNELS_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "funnels.json"))
+FUNNELS_JSON            = os.getenv("FUNNELS_JSON")
+FUNNELS_RELOAD_INTERVAL = float(os.getenv("FUNNELS_RELOAD_INTERVAL", "5"))
+
+logger = log.get("funnels")
+
+_FIELDS = ("success_url", "cancel_url", "invoice_footer", "allowed_quantities")
+
+
+@dataclass(frozen=True)
+class Funnel:
+    name: str
+    success_url: str
+    cancel_url: str
+    invoice_footer: str
+    allowed_quantities: Optional[frozenset] = None
+
+    def allows(self, quantity) -> bool:
+        if self.allowed_quantities is None:
+            return True
+        try:
+            return int(quantity) in self.allowed_quantities
+        except (TypeError, ValueError):
+            return False
+
+
+def _funnel(name: str, cfg: dict, base: dict) -> Funnel:
+    merged = {k: cfg.get(k, base.get(k)) for k in _FIELDS}
+    for k in ("success_url", "cancel_url", "invoice_footer"):
+        if not isinstance(merged[k], str) or not merged[k]:
+            raise ValueError(f"funil {name!r}: campo {k!r} ausente ou inválido")
+    qty = merged["allowed_quantities"]
+    if qty is not None:
+        if not isinstance(qty, list) or not all(isinstance(q, int) and q > 0 for q in qty):
+            raise ValueError(f"funil {name!r}: allowed_quantities deve ser lista de inteiros > 0")
+        qty = frozenset(qty)
+    return Funnel(name, merged["success_url"], merged["cancel_url"], merged["invoice_footer"], qty)
+
+
+def parse(config: dict):
+    """Valida a config e devolve (default, {price_id: Funnel})."""
+    if not isinstance(config, dict):
+        raise ValueError("a config de funis deve ser um objeto")
+    base = config.get("default", {})
+    if not isinstance(base, dict):
+        raise ValueError("'default' deve ser um objeto")
+    funnels = config.get("funnels")
+    if not isinstance(funnels, dict):
+        raise ValueError("'funnels' deve ser um objeto {nome: funil}")
+    default = _funnel("default", base, {})
+    routes = {}
+    for name, cfg in funnels.items():
+        if not isinstance(cfg, dict):
+            raise ValueError(f"funil {name!r} deve ser um objeto")
+        funnel = _funnel(name, cfg, base)
+        prices = cfg.get("prices", [])
+        if not isinstance(prices, list) or not all(isinstance(p, str) and p for p in prices):
+            raise ValueError(f"funil {name!r}: prices deve ser lista de price_ids")
+        for price_id in prices:
+            if price_id in routes:
+                raise ValueError(f"price {price_id} aparece nos funis {routes[price_id].name!r} e {name!r}")
+            routes[price_id] = funnel
+    return default, routes
+
+
+def check_catalog(routes: dict) -> list:
+    """Avisos para prices que o catálogo em cache não conhece ou que estão inativos."""
+    warnings = []
+    for price_id, funnel in routes.items():
+        price = catalog.cached_price(price_id)
+        if price is None:
+            warnings.append(f"{price_id} ({funnel.name}) não está no catálogo em cache")
+        elif not price.get("active", True):
+            warnings.append(f"{price_id} ({funnel.name}) está inativo na Stripe")
+    return warnings
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._default = None
+        self._routes = {}
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _read(self):
+        if FUNNELS_JSON:
+            return json.loads(FUNNELS_JSON), None
+        mtime = os.stat(FUNNELS_CONFIG).st_mtime
+        if mtime == self._mtime:
+            return None, mtime
+        with open(FUNNELS_CONFIG, encoding="utf-8") as f:
+            return json.load(f), mtime
+
+    def reload(self, force: bool = False) -> bool:
+        """Relê a config se mudou. Devolve True se a tabela foi trocada."""
+        with self._lock:
+            if force:
+                self._mtime = None
+            try:
+                config, mtime = self._read()
+                if config is None:
+                    return False
+                default, routes = parse(config)
+            except Exception as e:
+                # qualquer push malformado: a tabela anterior continua valendo
+                logger.warning("config de funis rejeitada; mantendo a anterior", error=repr(e))
+                if self._default is None:
+                    raise
+                return False
+            for w in check_catalog(routes):
+                logger.warning("funil inconsistente com o catálogo", detail=w)
+            self._default, self._routes, self._mtime = default, routes, mtime
+            logger.info("funis carregados", prices=len(routes))
+            return True
+
+    def route(self, price_id: str) -> Funnel:
+        now = time.monotonic()
+        if self._default is None or (not FUNNELS_JSON and now - self._checked_at > FUNNELS_RELOAD_INTERVAL):
+            self._checked_at = now
+            self.reload()
+        return self._routes.get(price_id, self._default)
+
+
+registry = Registry()
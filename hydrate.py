@@ -0,0 +1,70 @@
+"""
+Hidratação por evento: cada objeto da Stripe é buscado no máximo uma vez,
+já com a união dos expands que os handlers usam.
+
+O objeto do próprio evento (event["data"]["object"]) é reaproveitado em vez
+de um retrieve; só vai na API o que o payload não traz (line items,
+latest_charge, customer). As buscas aparecem em /metrics
+(stripe_hydration_fetches_total) e em Hydrator.fetches.
+"""
+import stripe
+
+import metrics
+from upstreams import stripe_call
+
+# expands pedidos em cada busca (a união do que os handlers leem)
+EXPAND = {
+    "line_items":     ["data.price.product"],
+    "payment_intent": ["latest_charge", "customer"],
+}
+
+FETCHES = metrics.Counter(
+    "stripe_hydration_fetches_total", "Buscas à Stripe feitas pela hidratação de eventos", ("kind",)
+)
+
+
+def _list_line_items(session_id: str) -> list:
+    items = stripe.checkout.Session.list_line_items(session_id, limit=100, expand=EXPAND["line_items"])
+    return list(items.auto_paging_iter())
+
+
+class Hydrator:
+    """Grafo de objetos memoizado de um único evento."""
+
+    def __init__(self, event: dict):
+        self.event = event
+        self.fetches = 0
+        self._objects = {}
+
+    async def _fetch(self, kind: str, key: str, fn, *args, **kwargs):
+        if (kind, key) not in self._objects:
+            self.fetches += 1
+            FETCHES.inc(kind=kind)
+            self._objects[(kind, key)] = await stripe_call(fn, *args, **kwargs)
+        return self._objects[(kind, key)]
+
+    def payload(self):
+        """O objeto do evento como StripeObject (sem chamada à API)."""
+        if ("payload", "") not in self._objects:
+            self._objects[("payload", "")] = stripe.util.convert_to_stripe_object(
+                self.event["data"]["object"], stripe.api_key
+            )
+        return self._objects[("payload", "")]
+
+    async def line_items(self, session_id: str) -> list:
+        """Todos os line items da Session, com price.product expandido."""
+        return await self._fetch("line_items", session_id, _list_line_items, session_id)
+
+    async def payment_intent(self, intent_id: str):
+        """PaymentIntent com latest_charge e customer expandidos."""
+        intent = await self._fetch(
+            "payment_intent", intent_id,
+            stripe.PaymentIntent.retrieve, intent_id, expand=EXPAND["payment_intent"],
+        )
+        cust = getattr(intent, "customer", None)
+        if hasattr(cust, "get"):
+            self._objects.setdefault(("customer", cust["id"]), cust)
+        return intent
+
+    async def customer(self, customer_id: str):
+        return await self._fetch("customer", customer_id, stripe.Customer.retrieve, customer_id)
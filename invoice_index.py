@@ -0,0 +1,147 @@
+"""
+Índice local sessão do Checkout -> InvoiceItems / Invoice espelho.
+
+Evita varrer o histórico inteiro do customer a cada compra: o
+mirror_invoice registra aqui o que cria, e os webhooks invoiceitem.* /
+invoice.* mantêm o estado (pendente, faturado, apagado) em dia. Quando o
+índice não conhece o customer ou a sessão, cai para a Search API da Stripe
+(metadata['parent_session_id']) e, só então, para InvoiceItem.list com
+pending=true.
+"""
+import time
+
+import stripe
+
+import metrics
+import store
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS invoice_index (
+    object_id  TEXT PRIMARY KEY,
+    kind       TEXT NOT NULL,            -- invoiceitem | invoice
+    customer   TEXT,
+    session_id TEXT,
+    invoice_id TEXT,                     -- invoiceitem: invoice que o incluiu (NULL = pendente)
+    status     TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS invoice_index_session ON invoice_index (session_id, kind);
+CREATE INDEX IF NOT EXISTS invoice_index_pending ON invoice_index (customer, kind, invoice_id);
+CREATE TABLE IF NOT EXISTS invoice_index_customers (
+    customer  TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL
+);
+""")
+
+LOOKUPS = metrics.Counter(
+    "invoice_index_lookups_total", "Consultas ao índice de invoices", ("kind", "result")
+)
+
+
+def _id(value):
+    return value.get("id") if hasattr(value, "get") else value
+
+
+def record(obj):
+    """Grava/atualiza um invoiceitem ou invoice (objeto da API ou do evento)."""
+    kind = obj.get("object")
+    if kind not in ("invoiceitem", "invoice"):
+        return
+    if obj.get("deleted"):
+        forget(obj["id"])
+        return
+    store.connect().execute(
+        "INSERT OR REPLACE INTO invoice_index "
+        "(object_id, kind, customer, session_id, invoice_id, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            obj["id"],
+            kind,
+            _id(obj.get("customer")),
+            (obj.get("metadata") or {}).get("parent_session_id"),
+            _id(obj.get("invoice")) if kind == "invoiceitem" else obj["id"],
+            obj.get("status"),
+            time.time(),
+        ),
+    )
+
+
+def mark_invoiced(session_id: str, invoice_id: str):
+    """
+    Os InvoiceItems pendentes da sessão foram incluídos na invoice (Invoice.create
+    com pending_invoice_items_behavior="include"): deixam de ser pendentes.
+    """
+    store.connect().execute(
+        "UPDATE invoice_index SET invoice_id = ?, updated_at = ? "
+        "WHERE session_id = ? AND kind = 'invoiceitem' AND invoice_id IS NULL",
+        (invoice_id, time.time(), session_id),
+    )
+
+
+def forget(object_id: str):
+    store.connect().execute("DELETE FROM invoice_index WHERE object_id = ?", (object_id,))
+
+
+def apply_event(event: dict):
+    """invoiceitem.* / invoice.*: mantém o índice em dia."""
+    obj = event["data"]["object"]
+    if event["type"].endswith(".deleted"):
+        forget(obj["id"])
+    else:
+        record(obj)
+
+
+def stale_pending_items(customer: str, session_id: str) -> list:
+    """
+    Ids dos InvoiceItems pendentes do customer que não são desta sessão.
+    Síncrona (pode listar na Stripe): rode via stripe_call.
+    """
+    conn = store.connect()
+    synced = conn.execute(
+        "SELECT 1 FROM invoice_index_customers WHERE customer = ?", (customer,)
+    ).fetchone()
+    if synced:
+        LOOKUPS.inc(kind="pending_items", result="hit")
+        rows = conn.execute(
+            "SELECT object_id FROM invoice_index "
+            "WHERE customer = ? AND kind = 'invoiceitem' AND invoice_id IS NULL "
+            "AND (session_id IS NULL OR session_id != ?)",
+            (customer, session_id),
+        ).fetchall()
+        return [r["object_id"] for r in rows]
+
+    # primeira vez que vemos o customer: só os pendentes (não o histórico)
+    LOOKUPS.inc(kind="pending_items", result="miss")
+    stale = []
+    for ii in stripe.InvoiceItem.list(customer=customer, pending=True, limit=100).auto_paging_iter():
+        record(ii)
+        if (ii.get("metadata") or {}).get("parent_session_id") != session_id:
+            stale.append(ii.id)
+    conn.execute(
+        "INSERT OR REPLACE INTO invoice_index_customers (customer, synced_at) VALUES (?, ?)",
+        (customer, time.time()),
+    )
+    return stale
+
+
+def find_invoice(session_id: str):
+    """
+    Invoice espelho da sessão (ou None): índice local, depois Search API.
+    Síncrona: rode via stripe_call.
+    """
+    row = store.connect().execute(
+        "SELECT object_id FROM invoice_index WHERE session_id = ? AND kind = 'invoice' "
+        "ORDER BY updated_at DESC LIMIT 1",
+        (session_id,),
+    ).fetchone()
+    if row is not None:
+        LOOKUPS.inc(kind="invoice", result="hit")
+        return stripe.Invoice.retrieve(row["object_id"])
+
+    LOOKUPS.inc(kind="invoice", result="miss")
+    # a Search API é eventualmente consistente (~1min), mas o índice já cobre
+    # o que este serviço criou; aqui sobram invoices antigas ou de outro deploy
+    found = stripe.Invoice.search(query=f"metadata['parent_session_id']:'{session_id}'", limit=1)
+    for inv in found.data:
+        record(inv)
+        return inv
+    return None
@@ -0,0 +1,228 @@
+"""
+Invoice espelho fora do webhook (INVOICE_MIRROR_MODE).
+
+- inline (padrão): o handler do checkout.session.completed gera a invoice
+  na hora, como sempre.
+- deferred: o handler só grava a sessão (e os line items já hidratados)
+  nesta fila; o scheduler gera as invoices em lotes dentro da janela fora
+  de pico (INVOICE_MIRROR_WINDOW, UTC, ex.: "03:00-07:00"; vazio = sempre),
+  com INVOICE_MIRROR_CONCURRENCY invoices em paralelo.
+- off: nenhuma invoice espelho.
+
+Sem store durável (store.DURABLE) deferred vira inline.
+
+Cada passada percorre a fila em ordem de chegada e grava o cursor (último
+seq concluído) a cada lote: se o processo cair ou a janela fechar no meio,
+a próxima continua de onde parou. Quem falhou fica para a passada
+seguinte. A passada tem lease no SQLite, então só um worker roda por vez.
+
+    python invoice_mirror.py status
+    python invoice_mirror.py run          # uma passada agora, ignorando a janela
+"""
+import argparse
+import asyncio
+import os
+import time
+import uuid
+
+import stripe
+
+import fastjson
+import log
+import metrics
+import store
+from upstreams import stripe_call
+
+INVOICE_MIRROR_MODE        = os.getenv("INVOICE_MIRROR_MODE", "inline")    # inline | deferred | off
+INVOICE_MIRROR_WINDOW      = os.getenv("INVOICE_MIRROR_WINDOW", "")        # "HH:MM-HH:MM" UTC
+INVOICE_MIRROR_CONCURRENCY = int(os.getenv("INVOICE_MIRROR_CONCURRENCY", "2"))
+INVOICE_MIRROR_BATCH_SIZE  = int(os.getenv("INVOICE_MIRROR_BATCH_SIZE", "50"))
+INVOICE_MIRROR_INTERVAL    = float(os.getenv("INVOICE_MIRROR_INTERVAL", "60"))
+INVOICE_MIRROR_MAX_ATTEMPTS = int(os.getenv("INVOICE_MIRROR_MAX_ATTEMPTS", "5"))
+INVOICE_MIRROR_LEASE_SECONDS = 300.0
+
+if INVOICE_MIRROR_MODE == "deferred" and not store.DURABLE:
+    # a fila sumiria num restart com o webhook já confirmado: gera na hora
+    INVOICE_MIRROR_MODE = "inline"
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS invoice_mirror_queue (
+    seq         INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id  TEXT    NOT NULL UNIQUE,
+    customer_id TEXT    NOT NULL,
+    session     TEXT    NOT NULL,
+    line_items  TEXT    NOT NULL,
+    queued_at   REAL    NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    done_at     REAL,
+    dead        INTEGER NOT NULL DEFAULT 0,
+    last_error  TEXT
+);
+CREATE INDEX IF NOT EXISTS invoice_mirror_pending ON invoice_mirror_queue (done_at, dead, seq);
+CREATE TABLE IF NOT EXISTS invoice_mirror_cursor (
+    id           INTEGER PRIMARY KEY CHECK (id = 1),
+    last_seq     INTEGER NOT NULL DEFAULT 0,
+    owner        TEXT,
+    locked_until REAL    NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO invoice_mirror_cursor (id) VALUES (1);
+""")
+
+
+def _collect_backlog():
+    row = store.connect().execute(
+        "SELECT COUNT(*) AS n, MIN(queued_at) AS oldest FROM invoice_mirror_queue WHERE done_at IS NULL AND dead = 0"
+    ).fetchone()
+    return {("pending",): row["n"], ("oldest_seconds",): round(time.time() - row["oldest"], 3) if row["oldest"] else 0}
+
+
+metrics.Gauge("invoice_mirror_backlog", "Fila de invoices espelho (pendentes e idade da mais antiga)", ("kind",),
+              collect=_collect_backlog)
+PROCESSED = metrics.Counter("invoice_mirror_processed_total", "Invoices espelho geradas em lote", ("result",))
+
+logger = log.get("invoice")
+_owner = uuid.uuid4().hex
+
+
+def enqueue(session, customer_id: str, line_items: list):
+    """Agenda a invoice espelho da sessão (reentrega do webhook não duplica)."""
+    store.connect().execute(
+        "INSERT OR IGNORE INTO invoice_mirror_queue (session_id, customer_id, session, line_items, queued_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (session["id"], customer_id, fastjson.dumps_str(session), fastjson.dumps_str(list(line_items)), time.time()),
+    )
+
+
+def in_window(now: float = None, window: str = None) -> bool:
+    """True se `now` (UTC) cai na janela "HH:MM-HH:MM" (pode virar a meia-noite)."""
+    window = INVOICE_MIRROR_WINDOW if window is None else window
+    if not window:
+        return True
+    start, end = ([int(x) for x in part.split(":")] for part in window.split("-"))
+    t = time.gmtime(now if now is not None else time.time())
+    minute, start, end = t.tm_hour * 60 + t.tm_min, start[0] * 60 + start[1], end[0] * 60 + end[1]
+    return start <= minute < end if start <= end else minute >= start or minute < end
+
+
+def _lease() -> bool:
+    now = time.time()
+    cur = store.connect().execute(
+        "UPDATE invoice_mirror_cursor SET owner = ?, locked_until = ? "
+        "WHERE id = 1 AND (locked_until <= ? OR owner = ?)",
+        (_owner, now + INVOICE_MIRROR_LEASE_SECONDS, now, _owner),
+    )
+    return cur.rowcount == 1
+
+
+def _release():
+    store.connect().execute("UPDATE invoice_mirror_cursor SET locked_until = 0 WHERE id = 1 AND owner = ?", (_owner,))
+
+
+def _cursor() -> int:
+    return store.connect().execute("SELECT last_seq FROM invoice_mirror_cursor WHERE id = 1").fetchone()[0]
+
+
+def _advance(last_seq: int):
+    store.connect().execute("UPDATE invoice_mirror_cursor SET last_seq = ? WHERE id = 1", (last_seq,))
+
+
+def _next_batch(after: int, limit: int) -> list:
+    return store.connect().execute(
+        "SELECT * FROM invoice_mirror_queue WHERE seq > ? AND done_at IS NULL AND dead = 0 ORDER BY seq LIMIT ?",
+        (after, limit),
+    ).fetchall()
+
+
+async def _mirror_one(mirror, row, limit: asyncio.Semaphore):
+    log.bind(session_id=row["session_id"])   # roda numa task própria (gather)
+    session = stripe.util.convert_to_stripe_object(fastjson.loads(row["session"]), stripe.api_key)
+    line_items = stripe.util.convert_to_stripe_object(fastjson.loads(row["line_items"]), stripe.api_key)
+    async with limit:
+        try:
+            await stripe_call(mirror, session, row["customer_id"], line_items)
+        except Exception as e:
+            attempts = row["attempts"] + 1
+            dead = attempts >= INVOICE_MIRROR_MAX_ATTEMPTS
+            store.connect().execute(
+                "UPDATE invoice_mirror_queue SET attempts = ?, dead = ?, last_error = ? WHERE seq = ?",
+                (attempts, int(dead), repr(e)[:2000], row["seq"]),
+            )
+            PROCESSED.inc(result="dead" if dead else "error")
+            logger.exception("falha na invoice espelho em lote", error=repr(e), attempt=attempts)
+        else:
+            store.connect().execute("UPDATE invoice_mirror_queue SET done_at = ? WHERE seq = ?", (time.time(), row["seq"]))
+            PROCESSED.inc(result="ok")
+
+
+async def run_pass(mirror, stop: asyncio.Event = None, respect_window: bool = True) -> int:
+    """
+    Uma passada pela fila a partir do cursor, em lotes. Para no fim da fila
+    (cursor volta a 0 para a próxima passada pegar as falhas), no `stop`
+    ou quando a janela fecha (cursor fica onde parou). Devolve quantas
+    sessões processou.
+    """
+    if not _lease():
+        return 0
+    done = 0
+    limit = asyncio.Semaphore(INVOICE_MIRROR_CONCURRENCY)
+    try:
+        cursor = _cursor()
+        while not (stop is not None and stop.is_set()) and (not respect_window or in_window()):
+            batch = _next_batch(cursor, INVOICE_MIRROR_BATCH_SIZE)
+            if not batch:
+                _advance(0)
+                break
+            started = time.monotonic()
+            await asyncio.gather(*(_mirror_one(mirror, row, limit) for row in batch))
+            cursor = batch[-1]["seq"]
+            _advance(cursor)
+            _lease()   # renova
+            done += len(batch)
+            logger.info("lote de invoices espelho", sessions=len(batch),
+                        seconds=round(time.monotonic() - started, 2), cursor=cursor)
+    finally:
+        _release()
+    return done
+
+
+async def run_scheduler(stop: asyncio.Event, mirror):
+    """Loop do modo deferred: uma passada a cada INVOICE_MIRROR_INTERVAL s dentro da janela."""
+    while not stop.is_set():
+        if in_window():
+            try:
+                await run_pass(mirror, stop)
+            except Exception as e:
+                logger.exception("falha no scheduler de invoices espelho", error=repr(e))
+        try:
+            await asyncio.wait_for(stop.wait(), INVOICE_MIRROR_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def status() -> dict:
+    conn = store.connect()
+    counts = conn.execute(
+        "SELECT SUM(done_at IS NULL AND dead = 0) AS pending, SUM(done_at IS NOT NULL) AS done, "
+        "SUM(dead) AS dead FROM invoice_mirror_queue"
+    ).fetchone()
+    return {**{k: counts[k] or 0 for k in ("pending", "done", "dead")}, "cursor": _cursor()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fila de invoices espelho (INVOICE_MIRROR_MODE=deferred)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status", help="pendentes, concluídas, descartadas e cursor")
+    sub.add_parser("run", help="roda uma passada agora, fora da janela")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        print(status())
+        return
+    import main as app
+    stripe.api_key = app.STRIPE_SECRET_KEY
+    n = asyncio.run(run_pass(app.mirror_invoice, respect_window=False))
+    print(f"→ {n} sessões processadas; {status()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Log estruturado (JSON por linha) sem I/O no caminho das requisições.
+
+Os handlers só montam o registro e o colocam numa fila em memória
+(QueueHandler); uma thread de background (QueueListener) formata e
+escreve no stdout. Fila cheia descarta o registro (conta em
+log_records_dropped_total) em vez de travar o event loop.
+
+    log = get("invoice")
+    log.info("invoice draft criada", invoice_id=inv.id, currency=inv.currency)
+
+- Categoria = nome do logger. LOG_LEVEL (padrão INFO) vale para todas;
+  LOG_LEVELS="invoice=WARNING,outbox=DEBUG" ajusta por categoria.
+- LOG_SAMPLING="outbox=0.1" mantém só 10% dos registros abaixo de WARNING
+  da categoria (warnings e erros sempre saem).
+- Strings longas (corpo de resposta dos upstreams etc.) são truncadas em
+  LOG_FIELD_MAX caracteres.
+- Correlação: bind()/context() guardam ids (event_id, session_id...) num
+  contextvar, que vai em todo registro da mesma task (e das chamadas à
+  Stripe que ela faz no pool de threads, ver upstreams.stripe_call).
+"""
+import atexit
+import contextvars
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+from contextlib import contextmanager
+
+import fastjson
+import metrics
+
+LOG_LEVEL      = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FIELD_MAX  = int(os.getenv("LOG_FIELD_MAX", "512"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+
+def _pairs(value: str) -> dict:
+    """"a=1,b=2" -> {"a": "1", "b": "2"}."""
+    return dict(p.split("=", 1) for p in value.replace(" ", "").split(",") if "=" in p)
+
+
+LOG_LEVELS   = {k: v.upper() for k, v in _pairs(os.getenv("LOG_LEVELS", "")).items()}
+LOG_SAMPLING = {k: float(v) for k, v in _pairs(os.getenv("LOG_SAMPLING", "")).items()}
+
+DROPPED = metrics.Counter("log_records_dropped_total", "Registros de log descartados (fila cheia)", ("category",))
+SAMPLED_OUT = metrics.Counter("log_records_sampled_out_total", "Registros de log descartados pela amostragem", ("category",))
+
+_ids = contextvars.ContextVar("log_ids", default={})
+
+
+def bind(**ids):
+    """Anexa ids de correlação aos próximos registros da task atual."""
+    _ids.set({**_ids.get(), **{k: v for k, v in ids.items() if v is not None}})
+
+
+@contextmanager
+def context(**ids):
+    """bind() só dentro do bloco."""
+    token = _ids.set({**_ids.get(), **{k: v for k, v in ids.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _ids.reset(token)
+
+
+def truncate(value, limit: int = None):
+    limit = limit or LOG_FIELD_MAX
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode("utf-8", "replace")
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}…(+{len(value) - limit})"
+    return value
+
+
+class _Sampler(logging.Filter):
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = LOG_SAMPLING.get(record.category)
+        if rate is None or random.random() < rate:
+            return True
+        SAMPLED_OUT.inc(category=record.category)
+        return False
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Só anexa os ids e enfileira; formatação e escrita ficam na thread do listener."""
+
+    def prepare(self, record):
+        record.ids = _ids.get()
+        if record.exc_info:
+            # o traceback é formatado aqui: a thread do listener não pode segurar os frames
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED.inc(category=record.category)
+
+
+class _JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts":       time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level":    record.levelname.lower(),
+            "category": record.category,
+            "msg":      record.getMessage(),
+            **getattr(record, "ids", {}),
+            **{k: truncate(v) for k, v in getattr(record, "fields", {}).items()},
+        }
+        if record.exc_text:
+            entry["exc"] = truncate(record.exc_text, LOG_FIELD_MAX * 8)
+        return fastjson.dumps_str(entry, default=str)
+
+
+class Logger:
+    """Logger de uma categoria: log.info("mensagem", campo=valor, ...)."""
+
+    def __init__(self, category: str):
+        self.category = category
+        self._logger = logging.getLogger(f"app.{category}")   # prefixo: não mexe no logger "stripe" do SDK
+        self._logger.setLevel(LOG_LEVELS.get(category, LOG_LEVEL))
+        self._logger.propagate = False
+        self._logger.addHandler(_handler)
+
+    def _log(self, level: int, msg: str, exc_info=False, **fields):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, msg, exc_info=exc_info, extra={"category": self.category, "fields": fields})
+
+    def debug(self, msg: str, **fields):
+        self._log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg: str, **fields):
+        self._log(logging.INFO, msg, **fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(logging.WARNING, msg, **fields)
+
+    def error(self, msg: str, **fields):
+        self._log(logging.ERROR, msg, **fields)
+
+    def exception(self, msg: str, **fields):
+        """error() com o traceback da exceção em tratamento."""
+        self._log(logging.ERROR, msg, exc_info=True, **fields)
+
+
+_queue = queue.Queue(LOG_QUEUE_SIZE)
+_handler = _NonBlockingQueueHandler(_queue)
+_handler.addFilter(_Sampler())
+_stream = logging.StreamHandler(sys.stdout)
+_stream.setFormatter(_JSONFormatter())
+_listener = logging.handlers.QueueListener(_queue, _stream)
+_listener.start()
+_loggers = {}
+
+
+def get(category: str) -> Logger:
+    if category not in _loggers:
+        _loggers[category] = Logger(category)
+    return _loggers[category]
+
+
+def flush():
+    """Espera a fila esvaziar (shutdown); o listener segue rodando."""
+    deadline = time.monotonic() + 5
+    while not _queue.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@atexit.register
+def _stop():
+    _listener.stop()
@@ -1,24 +1,94 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from decimal import Decimal
+from contextlib import asynccontextmanager
+import asyncio
 from fastapi import APIRouter
 import os
 import re
+import sqlite3
 import stripe
 import time
 import hashlib
-import requests
 import urllib.parse
 import hmac, base64
-import json
 import uuid
 
+import catalog
+import checkout_reuse
+import dedup
+import effects
+import fastjson
+import funnels
+import hydrate
+import invoice_index
+import invoice_mirror
+import log
+import metrics
+import orders
+import outbox
+import singleflight
+import store
+import upsell_context
+import upstreams
+import webhook_queue
+from fastjson import JSONResponse
+from upstreams import stripe_call
+
+logger      = log.get("app")
+webhook_log = log.get("webhook")
+invoice_log = log.get("invoice")
+
 def add_sid(url: str) -> str:
     sep = '&' if '?' in url else '?'
     return f"{url}{sep}sid={{CHECKOUT_SESSION_ID}}"
 
-app = FastAPI()
+# estado deste worker (com --workers cada processo tem o seu; ver /health)
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "15"))
+worker = {"state": "starting", "started_at": time.time(), "catalog_prices": 0, "tasks": {}}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not store.DURABLE:
+        # sem disco persistente (ex.: Heroku) a fila não vale como confirmação
+        logger.warning("store não durável: webhooks e IPNs processados antes da resposta",
+                       state_db=store.STATE_DB_PATH)
+    # workers do webhook e dispatcher do outbox (CAPI/UTMify) em background
+    stripe.api_key = STRIPE_SECRET_KEY
+    try:
+        # com --workers só um lista o catálogo; os outros usam o cache dele (SQLite)
+        worker["catalog_prices"] = await stripe_call(catalog.warm_shared)
+        logger.info("catálogo aquecido", prices=worker["catalog_prices"])
+    except Exception as e:
+        logger.warning("falha ao aquecer o catálogo (segue sob demanda)", error=str(e))
+    # carrega os funis já validando contra o catálogo aquecido
+    funnels.registry.reload(force=True)
+    stop = asyncio.Event()
+    background = {
+        "webhooks": webhook_queue.run_workers(stop, {**WEBHOOK_HANDLERS, "paypal.ipn": handle_paypal_ipn}),
+        "outbox":   outbox.run_dispatcher(stop),
+    }
+    if invoice_mirror.INVOICE_MIRROR_MODE == "deferred":
+        background["invoice_mirror"] = invoice_mirror.run_scheduler(stop, mirror_invoice)
+    worker["tasks"] = {name: asyncio.create_task(coro) for name, coro in background.items()}
+    worker["state"] = "ready"
+    yield
+    # SIGTERM: o uvicorn já parou de aceitar conexões e esperou as requisições;
+    # aqui os loops param de pegar trabalho e terminam o que está em andamento.
+    # O que passar do prazo é cancelado e volta para a fila (outro worker pega).
+    worker["state"] = "draining"
+    stop.set()
+    tasks = list(worker["tasks"].values())
+    _, pending = await asyncio.wait(tasks, timeout=SHUTDOWN_DRAIN_SECONDS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    logger.info("worker encerrado", pid=os.getpid(), cancelled=sorted(t.get_name() for t in pending),
+                drain_seconds=SHUTDOWN_DRAIN_SECONDS)
+    await upstreams.aclose()
+    await asyncio.to_thread(log.flush)
+
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 
 # CORS
 origins = origins = [
@@ -35,30 +105,114 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Lock do SQLite ocupado por outro worker: 503 (a Stripe/PayPal/o front tentam
+# de novo) em vez de segurar o event loop esperando
+@app.exception_handler(sqlite3.OperationalError)
+async def state_db_error(request: Request, exc: sqlite3.OperationalError):
+    if store.busy(exc):
+        logger.warning("SQLite ocupado; 503", error=str(exc))
+        return JSONResponse({"error": "busy, retry"}, status_code=503, headers={"Retry-After": "1"})
+    logger.error("erro no SQLite", error=repr(exc))
+    return JSONResponse({"error": "internal error"}, status_code=500)
+
+# Métricas por rota (duração, em andamento e status) — ver /metrics
+REQUEST_DURATION = metrics.Histogram(
+    "http_request_duration_seconds", "Duração das requisições por rota", ("route", "method", "status")
+)
+REQUESTS_IN_FLIGHT = metrics.Gauge(
+    "http_requests_in_flight", "Requisições em andamento por rota", ("route",)
+)
+REQUEST_ERRORS = metrics.Counter(
+    "http_request_errors_total", "Respostas 5xx/exceções por rota", ("route", "method")
+)
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    # nossas rotas não têm parâmetros de path; qualquer outro path vira "unmatched"
+    # (evita explodir a cardinalidade das labels com URLs aleatórias)
+    path = request.url.path
+    if path not in {getattr(r, "path", None) for r in app.routes}:
+        path = "unmatched"
+    REQUESTS_IN_FLIGHT.inc(route=path)
+    started = time.perf_counter()
+    status = 500
+    try:
+        # id da requisição em todo log dela (o handler herda este contexto)
+        with log.context(request_id=request.headers.get("x-request-id") or uuid.uuid4().hex[:16], route=path):
+            response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUEST_DURATION.observe(time.perf_counter() - started, route=path, method=request.method, status=status)
+        if status >= 500:
+            REQUEST_ERRORS.inc(route=path, method=request.method)
+        REQUESTS_IN_FLIGHT.dec(route=path)
+
 # Env vars
 STRIPE_SECRET_KEY   = os.getenv("STRIPE_SECRET_KEY")
 WEBHOOK_SECRET      = os.getenv("STRIPE_WEBHOOK_SECRET")
-PIXEL_ID            = os.getenv("PIXEL_ID")
-ACCESS_TOKEN        = os.getenv("ACCESS_TOKEN")
-UTMIFY_API_URL      = os.getenv("UTMIFY_API_URL")
-UTMIFY_API_KEY      = os.getenv("UTMIFY_API_KEY")
+UPSELL_RESULT_TTL   = float(os.getenv("UPSELL_RESULT_TTL_SECONDS", "60"))
+
+# /upsell/intent: um PaymentIntent por (sid, price_id, quantity) em andamento
+upsell_flight = singleflight.SingleFlight("upsell_intent", ttl=UPSELL_RESULT_TTL)
+
+# /create-checkout-session: cliques simultâneos do mesmo comprador (mesmo
+# Idempotency-Key, ou mesmos dados com e-mail/visitor_id) criam uma Session só
+# (o cache entre requisições é o checkout_reuse, no SQLite)
+checkout_flight = singleflight.SingleFlight("checkout_session", ttl=0)
+
+# IPNs do PayPal já processados (o PayPal reenvia o mesmo txn_id)
+paypal_txns = dedup.ProcessedStore("paypal_txn")
+# IPNs (id da fila, hash do corpo) que o PayPal já confirmou como VERIFIED
+paypal_verified = dedup.ProcessedStore("paypal_ipn_verified")
 
 @app.get("/health")
 async def health():
-    return {"status": "up"}
+    """Readiness deste worker: 503 enquanto aquece, drenando ou se um loop de background morreu."""
+    stopped = [name for name, task in worker["tasks"].items() if task.done()]
+    ready = worker["state"] == "ready" and not stopped
+    return JSONResponse({
+        "status":         "up" if ready else worker["state"],
+        "worker":         os.getpid(),
+        "uptime":         round(time.time() - worker["started_at"], 1),
+        "catalog_prices": worker["catalog_prices"],
+        "background":     {name: "stopped" if name in stopped else "running" for name in worker["tasks"]},
+    }, status_code=200 if ready else 503)
 
 @app.post("/ping")
 async def ping():
     return {"pong": True}
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def stripe_products(line_items) -> list:
+    """Line items do Checkout -> produtos do pedido (formato da UTMify)."""
+    return [
+        {
+            "id":           li.price.id,
+            "name":         li.description or li.price.id,
+            "planId":       li.price.id,
+            "planName":     li.price.nickname or None,
+            "quantity":     li.quantity,
+            "priceInCents": li.amount_subtotal,
+        }
+        for li in line_items
+    ]
+
 @app.post("/create-checkout-session")
 async def create_checkout_session(request: Request):
     stripe.api_key = STRIPE_SECRET_KEY
 
-    body = await request.json()
+    body = fastjson.loads(await request.body())
     price_id = body.get("price_id")
     quantity = body.get("quantity", 1)
     customer_email = body.get("customer_email")
+    # id do visitante/carrinho gerado no front (identifica o comprador sem e-mail)
+    visitor_id = body.get("visitor_id") or body.get("cart_id")
+    # página do comprador (event_source_url da CAPI), não a URL desta API
+    page_url = body.get("page_url") or request.headers.get("referer")
     # coletamos os UTMs
     utms = { k: body.get(k, "") for k in (
         "utm_source", 
@@ -71,36 +225,47 @@ async def create_checkout_session(request: Request):
     if not price_id:
         return JSONResponse(status_code=400, content={"error": "price_id is required"})
 
-    # escolhe a URL de sucesso de acordo com o produto
-    if price_id in (
-        'price_1RyNznEHsMKn9uopHakAFd56',
-        'price_1RwT5YEHsMKn9uopjNrvLDMO',
-        'price_1Rn3KKEHsMKn9uopolAv2nKU',
-        'price_1RxEEGEHsMKn9uopcL2e7CVo',
-        'price_1RwtdeEHsMKn9uop4VqGNZ8F'
-    ):
-        success_url = add_sid('https://learnmoredigitalcourse.com/yo-yo-pink-up1-stripe')
-    elif price_id in (
-        'price_1RpzFgEHsMKn9uop8tE1USBk',
-        'price_1RrsCbEHsMKn9uopRnYsH90a'
-    ):
-        success_url = add_sid('https://learnmoredigitalcourse.com/lipovive-up1-stripe')
-    elif price_id == 'price_1Rs89iEHsMKn9uopwkT6I5ya':
-        success_url = add_sid('https://learnmoredigitalcourse.com/lipomax-up1-stripe')
-    elif price_id == 'price_1S3MgZEHsMKn9uopn0VBzOH5':
-        success_url = add_sid('https://learnmoredigitalcourse.com/teste-audizen-up1')
-    else:
-        success_url = add_sid('https://burnjaroformula.online/members/')
-
-    session = stripe.checkout.Session.create(
+    # escolhe o funil (URLs de sucesso/erro) de acordo com o produto — ver funnels.json
+    funnel = funnels.registry.route(price_id)
+    if not funnel.allows(quantity):
+        return JSONResponse(status_code=400, content={"error": f"quantity {quantity} not allowed for this product"})
+
+    # reload/duplo clique: devolve a Session aberta, sem Stripe e sem tracking.
+    # Pelos dados só com comprador identificado; anônimo só pelo Idempotency-Key
+    idem_key = request.headers.get("idempotency-key") or None
+    fp = checkout_reuse.fingerprint(price_id, quantity, customer_email, utms, visitor_id)
+    by_fp = checkout_reuse.identified(customer_email, visitor_id)
+    try:
+        reused = checkout_reuse.get(fp, idem_key, by_fingerprint=by_fp)
+    except checkout_reuse.IdempotencyKeyMismatch:
+        return JSONResponse(status_code=422, content={"error": "Idempotency-Key already used with different parameters"})
+    if reused is not None:
+        return JSONResponse(
+            {"checkout_url": reused["checkout_url"], "session_id": reused["session_id"]},
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    flight_key = idem_key or (fp if by_fp else None)
+    if flight_key is None:
+        return await open_checkout_session(request, price_id, quantity, customer_email, utms, funnel, fp, idem_key, by_fp, page_url)
+    return await checkout_flight.do(
+        flight_key,
+        lambda: open_checkout_session(request, price_id, quantity, customer_email, utms, funnel, fp, idem_key, by_fp, page_url),
+        cache_if=lambda result: False,
+    )
+
+async def open_checkout_session(request, price_id, quantity, customer_email, utms, funnel, fp, idem_key, by_fp, page_url):
+    """Session.create + pedido no ledger + tracking; grava a Session no checkout_reuse."""
+    session = await stripe_call(
+        stripe.checkout.Session.create,
         payment_method_types=['card'],
         line_items=[{'price': price_id, 'quantity': quantity}],
         mode='payment',
         customer_creation='always',
         customer_email=customer_email,
         phone_number_collection={"enabled": True},
-        success_url=success_url,
-        cancel_url='https://learnmoredigitalcourse.com/erro',
+        success_url=add_sid(funnel.success_url),
+        cancel_url=funnel.cancel_url,
         # grava UTMs na própria Session
         metadata=utms,
         # grava UTMs também no PaymentIntent
@@ -109,140 +274,108 @@ async def create_checkout_session(request: Request):
             "setup_future_usage": "off_session"
         },
         invoice_creation={"enabled": False},
-        expand=["line_items"]
+        expand=["line_items"],
+        # a chave do cliente vale também na Stripe (retry depois de timeout)
+        idempotency_key=f"checkout:{idem_key}" if idem_key else None,
     )
+    checkout_reuse.put(fp, idem_key, session.id, session.url, by_fingerprint=by_fp)
 
-    # Conversions API: InitiateCheckout stripe
-    event_payload = {
-      "data": [{
-        "event_name":    "InitiateCheckout",
-        "event_time":    int(time.time()),
-        "event_id":      session.id,
-        "action_source": "website",
-        "event_source_url": str(request.url),
-        "user_data": {
-          "client_ip_address": request.client.host,
-          "client_user_agent": request.headers.get("user-agent")
-        },
-        "custom_data": {
-          "currency": session.currency,
-          "value":    session.amount_total / 100.0,
-          "content_ids": [item.price.id for item in session.line_items.data],
-          "content_type": "product"
-        }
-      }]
-    }
-    # envia e loga o response para debug
-    resp = requests.post(
-      f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-      params={"access_token": ACCESS_TOKEN},
-      json=event_payload
-    )
-    print("→ InitiateCheckout event sent:", resp.status_code, resp.text)
-
-    # ──────────────────────────────────────────────────
-    #  Envia pedido (order) ao UTMify
+    # Pedido no ledger; CAPI InitiateCheckout e UTMify (waiting_payment) saem
+    # dele pelo outbox (fora do caminho crítico do checkout)
     cd = session.customer_details or {}
-    customer_name  = getattr(cd, "name", "") or ""
-    customer_email = getattr(cd, "email", "") or ""
-    customer_phone = getattr(cd, "phone", None)
-    
-    utmify_order = {
-      "orderId":       session.id,
-      "platform":      "Stripe",
-      "paymentMethod": "credit_card",
-      "status":        "waiting_payment",
-      "createdAt":     time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-      "approvedDate":  None,
-      "refundedAt":    None,
-      "customer": {
-          "name":     customer_name,
-          "email":    customer_email,
-          "phone":    customer_phone,
-          "document": None
-      },
-      "products": [
-        {
-          "id":            item.price.id,
-          "name":          item.description or item.price.id,
-          "planId":        item.price.id,
-          "planName":      item.price.nickname or "",
-          "quantity":      item.quantity,
-          "priceInCents":  item.amount_subtotal
-        }
-        for item in session.line_items.data
-      ],
-      "trackingParameters": {
-        "utm_source":       session.metadata.get("utm_source",""),
-        "utm_medium":       session.metadata.get("utm_medium",""),
-        "utm_campaign":     session.metadata.get("utm_campaign",""),
-        "utm_term":         session.metadata.get("utm_term",""),
-        "utm_content":      session.metadata.get("utm_content","")
-      },
-      "commission": {
-        "totalPriceInCents":     session.amount_total,
-        "gatewayFeeInCents":     0,
-        "userCommissionInCents": 0,
-        "currency":              session.currency.upper()
-      }
-    }
-    resp_utm = requests.post(
-      UTMIFY_API_URL,
-      headers={
-        "Content-Type": "application/json",
-        "x-api-token":  UTMIFY_API_KEY
-      },
-      json=utmify_order
+    order = orders.record(
+        session.id, "waiting_payment",
+        platform="Stripe",
+        payment_method="credit_card",
+        currency=session.currency,
+        total_cents=session.amount_total,
+        fee_rate=orders.STRIPE_FEE_RATE,
+        customer_name=getattr(cd, "name", None),
+        customer_email=getattr(cd, "email", None),
+        customer_phone=getattr(cd, "phone", None),
+        source_url=page_url,
+        client_ip=request.client.host,
+        user_agent=request.headers.get("user-agent"),
+        products=stripe_products(session.line_items.data),
+        tracking=orders.utms(session.metadata),
+        capi_event="InitiateCheckout",
     )
-    print("→ Order enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
-    # ──────────────────────────────────────────────────
+    outbox.enqueue("capi", orders.capi_event(order, "InitiateCheckout"), label="InitiateCheckout")
+    outbox.enqueue("utmify", orders.utmify_order(order), label="Order UTMify (waiting_payment)")
 
     return {
         "checkout_url": session.url,
         "session_id": session.id,  # usaremos como eventID do Pixel
     }
 
-@app.post("/upsell/intent")
-async def create_upsell_intent(request: Request):
-    stripe.api_key = STRIPE_SECRET_KEY
-    body = await request.json()
-    sid      = body.get("sid")
-    price_id = body.get("price_id")
-    quantity = int(body.get("quantity", 1))
-
-    if not sid or not price_id:
-        return JSONResponse(status_code=400, content={"error": "sid and price_id are required"})
-
-    # 1) Recupera a Session anterior e extrai customer + payment_method
-    sess = stripe.checkout.Session.retrieve(
+async def load_upsell_context(sid: str):
+    """Contexto do upsell pela Session (caminho lento); grava em upsell_context."""
+    # Recupera a Session anterior e extrai customer + payment_method
+    sess = await stripe_call(
+        stripe.checkout.Session.retrieve,
         sid,
         expand=["payment_intent.payment_method", "customer"]
     )
     if not sess or not sess.customer:
         return JSONResponse(status_code=400, content={"error": "Invalid session or missing customer"})
-    
-    customer_id = sess.customer
+
+    cust = sess.customer
+    customer_id = cust.id if hasattr(cust, "id") else cust
 
     # preferimos o PM da PI da Session
     pm = getattr(getattr(sess, "payment_intent", None), "payment_method", None)
     pm_id = pm.id if pm else None
 
     # fallback: default do customer
-    if not pm_id and getattr(sess, "customer", None):
-        cust = sess.customer if isinstance(sess.customer, dict) else stripe.Customer.retrieve(customer_id)
+    if not pm_id:
+        cust = cust if hasattr(cust, "get") else await stripe_call(stripe.Customer.retrieve, customer_id)
         pm_id = (cust.get("invoice_settings", {}) or {}).get("default_payment_method")
 
     if not pm_id:
         # Sem método salvo? devolve erro orientando a abrir um novo Checkout
         return JSONResponse(status_code=409, content={"error": "No saved payment method; redirect to checkout"})
 
-    # 2) Carrega o price para pegar valor/moeda/identificação
-    price = stripe.Price.retrieve(price_id)
+    upsell_context.put(sid, customer_id, pm_id, sess.metadata)
+    return {"customer_id": customer_id, "payment_method": pm_id, "metadata": dict(sess.metadata or {})}
+
+@app.post("/upsell/intent")
+async def create_upsell_intent(request: Request):
+    stripe.api_key = STRIPE_SECRET_KEY
+    body = fastjson.loads(await request.body())
+    sid      = body.get("sid")
+    price_id = body.get("price_id")
+    quantity = int(body.get("quantity", 1))
+
+    if not sid or not price_id:
+        return JSONResponse(status_code=400, content={"error": "sid and price_id are required"})
+
+    # toques repetidos (mesma sid/price/qty) esperam a mesma execução ou
+    # pegam o resultado recente; erros não ficam em cache
+    return await upsell_flight.do(
+        (sid, price_id, quantity),
+        lambda: upsell_intent(sid, price_id, quantity),
+        cache_if=lambda result: isinstance(result, dict),
+    )
+
+async def upsell_intent(sid: str, price_id: str, quantity: int):
+    # 1) customer + payment_method + UTMs: gravados pelo webhook do checkout;
+    #    se o clique chegou antes do webhook, monta pela Session
+    log.bind(session_id=sid, price_id=price_id)
+    ctx = upsell_context.get(sid)
+    if ctx is None:
+        ctx = await load_upsell_context(sid)
+        if isinstance(ctx, JSONResponse):
+            return ctx
+    customer_id = ctx["customer_id"]
+    pm_id       = ctx["payment_method"]
+
+    # 2) Carrega o price para pegar valor/moeda/identificação (cache de catálogo)
+    price = await catalog.get_price(price_id)
     amount_minor = price["unit_amount"] * quantity
     currency = price["currency"]
 
     # 3) Metadados: copie UTMs da Session anterior e marque como upsell
-    base_meta = dict(sess.metadata or {})
+    base_meta = dict(ctx["metadata"])
     base_meta.update({
         "upsell": "true",
         "parent_session": sid,
@@ -253,7 +386,8 @@ async def create_upsell_intent(request: Request):
     # 4) Idempotência p/ evitar dupla cobrança por duplo clique
     idem_key = f"upsell:{sid}:{price_id}:{quantity}"
 
-    intent = stripe.PaymentIntent.create(
+    intent = await stripe_call(
+        stripe.PaymentIntent.create,
         amount=amount_minor,
         currency=currency,
         customer=customer_id,
@@ -265,563 +399,553 @@ async def create_upsell_intent(request: Request):
 
     return {"client_secret": intent.client_secret, "pm_id": pm_id}
 
-@app.post("/webhook")
-async def stripe_webhook(request: Request):
-    payload = await request.body()
-    sig     = request.headers.get("stripe-signature", "")
-
-    # 1) Garante que podemos chamar a API do Stripe
-    stripe.api_key = STRIPE_SECRET_KEY
+def clean_desc(raw: str) -> str:
+    return re.sub(r"\s*\(Session\s+cs_[a-zA-Z0-9_]+\)\s*$", "", (raw or "")).strip()
 
-    # 2) Valida a assinatura do webhook
+def mirror_invoice(session, cust, line_items):
+    """
+    Gera a Invoice espelho (sem "Payment for Invoice (canceled)") da Session.
+    `line_items` vem da hidratação do evento (price.product expandido).
+    Síncrona (SDK da Stripe): rode via stripe_call.
+    """
     try:
-        event = stripe.Webhook.construct_event(payload, sig, WEBHOOK_SECRET)
-    except stripe.error.SignatureVerificationError as e:
-        print("⚠️ Webhook signature mismatch:", e)
-        raise HTTPException(400, "Invalid webhook signature")
+        invoice_log.info("criando invoice espelho")
+        idem_prefix = f"cs:{session.id}"
+    
+        # 1) Line items já hidratados + inferir moeda do Checkout
+        # moeda preferencial do Checkout
+        checkout_currency = (getattr(session, "currency", None) or "usd").lower()
+    
+        # se o line item expõe currency, priorize ele (garante fidelidade)
+        first_li = line_items[0] if line_items else None
+        if first_li is None:
+            raise RuntimeError("Checkout sem line items; nada para faturar.")
+    
+        li_currency = (first_li.get("currency")
+                       or ((first_li.get("price") or {}).get("currency"))
+                       or checkout_currency).lower()
+        currency = li_currency
+    
+        # (Opcional, mas recomendado) Limpeza de itens PENDENTES antigos do mesmo customer
+        # para evitar que a Stripe "inclua" pendências de outra compra na nova invoice.
+        # Mantemos apenas os que têm parent_session_id == sessão atual.
+        # O índice local (invoice_index) evita varrer o histórico do customer.
+        for ii_id in invoice_index.stale_pending_items(cust, session.id):
+            try:
+                stripe.InvoiceItem.delete(ii_id)
+                invoice_index.forget(ii_id)
+                invoice_log.debug("InvoiceItem pendente antigo removido", invoiceitem_id=ii_id)
+            except stripe.error.InvalidRequestError:
+                invoice_index.forget(ii_id)  # já apagado ou já faturado
+            except Exception as _:
+                pass  # não falhar por limpeza
+    
+        # 2) Criar InvoiceItems PENDENTES (um por line item), na moeda do Checkout
+        #    Usamos amount_total (total exato do item já com qty/discount/imposto).
+        created_any = False
+        for li in line_items:
+            total = li.get("amount_total")
+            if total is None:
+                # Fallback defensivo
+                total = li.get("amount_subtotal")
+                if total is None:
+                    price = (li.get("price") or {})
+                    unit = int(price.get("unit_amount") or 0)
+                    qty = int(li.get("quantity") or 1)
+                    total = unit * qty
+    
+            price = li.get("price") or {}
+            product = price.get("product") or {}
+            name = product.get("name") or price.get("nickname") or li.get("description") or "Item"
+    
+            # idempotência por line_item.id
+            ii = stripe.InvoiceItem.create(
+                customer=cust,
+                currency=currency,
+                amount=int(total),   # total em centavos
+                description=clean_desc(name),
+                metadata={
+                    "source": "mirror_checkout_session",
+                    "parent_session_id": session.id,
+                    "line_item_id": li.get("id", "")
+                },
+                idempotency_key=f"{idem_prefix}:ii:{li.get('id')}",
+            )
+            invoice_index.record(ii)
+            created_any = True
+            invoice_log.debug("InvoiceItem pendente criado", invoiceitem_id=ii.id, total_cents=int(total), currency=currency)
+    
+        if not created_any:
+            raise RuntimeError("Nenhum InvoiceItem criado; verifique os line items.")
+    
+        # 3) Criar a Invoice com include dos pendentes (herda a MOEDA dos itens)
+        #    footer vem do funil do produto comprado
+        first_price_id = (first_li.get("price") or {}).get("id")
+        footer_text = funnels.registry.route(first_price_id).invoice_footer
+        invoice = stripe.Invoice.create(
+            customer=cust,
+            collection_method="send_invoice",               # evita criar PaymentIntent interno
+            days_until_due=30,                              # obrigatório com send_invoice
+            pending_invoice_items_behavior="include",       # inclui os pendentes criados acima
+            auto_advance=False,
+            description="Compra via Checkout",
+            footer=footer_text,                             # <— usa variável
+            metadata={**(dict(session.metadata or {})), "parent_session_id": session.id},
+        )
+        invoice_index.record(invoice)
+        invoice_index.mark_invoiced(session.id, invoice.id)   # senão viram "pendentes antigos" na próxima compra
+        invoice_log.debug("invoice draft criada", invoice_id=invoice.id, currency=invoice.currency)
 
-    # 3) Se for checkout.session.completed, processa
-    if event["type"] == "checkout.session.completed":
-        session = stripe.checkout.Session.retrieve(
-            event["data"]["object"]["id"],
-            expand=["line_items"]
+        # o create já manda send_invoice + days_until_due (obrigatório com
+        # send_invoice); o modify só vale se a Stripe não aplicou
+        if invoice.collection_method != "send_invoice":
+            stripe.Invoice.modify(invoice.id, collection_method="send_invoice", days_until_due=30)
+    
+        # 4) Finalizar e marcar como paga (sem e-mail e sem PI)
+        finalized = stripe.Invoice.finalize_invoice(
+            invoice.id,
+            auto_advance=False,
+            idempotency_key=f"{idem_prefix}:invoice:finalize",
         )
-        # captura o createdAt original a partir do timestamp da session:
-        original_created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(session.created))
-        cust = session["customer"]
+        invoice_log.debug("invoice finalizada", invoice_id=finalized.id, amount_due=finalized.amount_due)
 
-        # 3.1) Primeiro, guarda as UTMs no Customer
-        stripe.Customer.modify(
-            cust, 
+        if finalized.collection_method != "send_invoice":
+            stripe.Invoice.modify(finalized.id, collection_method="send_invoice", due_date=finalized.due_date or int(time.time()) + 30*24*60*60)
+        
+        state = stripe.Invoice.retrieve(finalized.id, expand=["payment_intent"])
+        pi_obj = getattr(state, "payment_intent", None)  # pode não existir
+        if pi_obj:
+            invoice_log.warning("PaymentIntent inesperado na invoice", invoice_id=finalized.id,
+                                payment_intent_id=getattr(pi_obj, "id", pi_obj),
+                                collection_method=state.collection_method)
+    
+        if finalized.status != "paid":
+            paid = stripe.Invoice.pay(
+                finalized.id,
+                paid_out_of_band=True,
+                idempotency_key=f"{idem_prefix}:invoice:pay",
+            )
+            invoice_log.info("invoice paga", invoice_id=paid.id, amount_paid=paid.amount_paid,
+                             currency=paid.currency, hosted_url=paid.hosted_invoice_url)
+            invoice_index.record(paid)
+        else:
+            invoice_log.info("invoice já estava paga (amount_due=0?)", invoice_id=finalized.id)
+            invoice_index.record(finalized)
+
+    except stripe.error.IdempotencyError as e:
+        # Ocorre quando o mesmo idempotency_key foi usado com parâmetros diferentes em alguma execução
+        invoice_log.warning("IdempotencyError ao criar invoice", error=str(e))
+        try:
+            # Tenta achar invoice já vinculada a esta sessão (índice local -> Search API)
+            inv = invoice_index.find_invoice(session.id)
+
+            if inv:
+                invoice_log.info("reutilizando invoice existente", invoice_id=inv.id, status=inv.status)
+                invoice_index.mark_invoiced(session.id, inv.id)
+                # Se ainda DRAFT, aproveita para garantir footer/descrição atualizados
+                if inv.status == "draft":
+                    inv = stripe.Invoice.modify(
+                        inv.id,
+                        collection_method="send_invoice",
+                        days_until_due=30,
+                        description="Compra via Checkout",
+                        footer=footer_text,
+                    )
+                    inv = stripe.Invoice.finalize_invoice(inv.id, auto_advance=False)
+                    invoice_log.debug("invoice finalizada", invoice_id=inv.id, amount_due=inv.amount_due)
+
+                # Paga out-of-band se ainda não estiver paga
+                if inv.status != "paid":
+                    paid = stripe.Invoice.pay(
+                        inv.id,
+                        paid_out_of_band=True,
+                        idempotency_key=f"{idem_prefix}:invoice:pay",
+                    )
+                    invoice_log.info("invoice paga", invoice_id=paid.id, amount_paid=paid.amount_paid,
+                                     currency=paid.currency, hosted_url=paid.hosted_invoice_url)
+                    invoice_index.record(paid)
+                else:
+                    invoice_log.info("invoice já estava paga", invoice_id=inv.id)
+            else:
+                invoice_log.warning("nenhuma invoice existente para a sessão; verifique as execuções anteriores")
+
+        except Exception:
+            invoice_log.exception("falha ao reaproveitar invoice após IdempotencyError")
+
+def record_checkout_paid(session, line_items, approved_at: float = None, save: bool = True) -> dict:
+    """Grava no ledger o pedido pago de uma Session (webhook e backfill; save=False só monta)."""
+    cd = session.customer_details
+    return (orders.record if save else orders.preview)(
+        session.id, "paid",
+        platform="Stripe",
+        payment_method="credit_card",
+        currency=session.currency,
+        total_cents=session.amount_total,
+        fee_rate=orders.STRIPE_FEE_RATE,
+        created_at=session.created,
+        approved_at=approved_at or time.time(),
+        customer_name=cd.name,
+        customer_email=cd.email,
+        customer_phone=cd.phone,
+        products=stripe_products(line_items),
+        tracking=orders.utms(session.metadata),
+        capi_event="Purchase",
+    )
+
+async def handle_checkout_completed(event: dict):
+    """checkout.session.completed: Customer, Invoice espelho, Purchase e UTMify."""
+    # a Session vem do próprio evento; só os line items vão na API
+    hydrator = hydrate.Hydrator(event)
+    session = hydrator.payload()
+    cust = session["customer"]
+    log.bind(session_id=session.id, customer_id=cust)
+    checkout_reuse.forget(session.id)   # paga: um novo clique abre outra Session
+
+    # 3.1) Guarda as UTMs no Customer
+    async def update_customer():
+        await stripe_call(
+            stripe.Customer.modify,
+            cust,
             metadata=session.metadata,
             name=session.customer_details.name,
             phone=session.customer_details.phone
         )
 
-        # 3.2) Prepara o payload de Purchase para o Meta
-        email_hash = hashlib.sha256(
-            session.customer_details.email.encode("utf-8")
-        ).hexdigest()
-        purchase_payload = {
-            "data": [{
-                "event_name":    "Purchase",
-                "event_time":    int(time.time()),
-                "event_id":      session.id,
-                "action_source": "website",
-                "event_source_url": session.url,
-                "user_data":     {"em": email_hash},
-                "custom_data":   {
-                    "currency":     session.currency,
-                    "value":        session.amount_total / 100.0,
-                    "content_ids":  [li.price.id for li in session.line_items.data],
-                    "content_type": "product"
-                }
-            }]
-        }
+    # 3.2) Pedido pago no ledger -> Purchase (Meta) e UTMify (paid)
+    def purchase(order):
+        return outbox.deliver("capi", orders.capi_event(order, "Purchase"), label="Purchase")
 
-        # 3.3) Gera a Invoice espelho (sem "Payment for Invoice (canceled)")
-        def clean_desc(raw: str) -> str:
-            return re.sub(r"\s*\(Session\s+cs_[a-zA-Z0-9_]+\)\s*$", "", (raw or "")).strip()
-        
+    def utmify_paid(order):
+        return outbox.deliver("utmify", orders.utmify_order(order), label="Order UTMify (paid)")
+
+    # Contexto do upsell 1-click: com ele o /upsell/intent só faz o PaymentIntent.create
+    async def store_upsell_context():
         try:
-            print(f"🔔 [webhook] criando invoice (safe) para sessão {session.id}")
-            idem_prefix = f"cs:{session.id}"
-        
-            # 1) Buscar line items via API (sempre) + inferir moeda do Checkout
-            line_items = stripe.checkout.Session.list_line_items(
-                session.id,
-                expand=["data.price.product", "data.price"]
-            )
-            # moeda preferencial do Checkout
-            checkout_currency = (getattr(session, "currency", None) or "usd").lower()
-        
-            # se o line item expõe currency, priorize ele (garante fidelidade)
-            first_li = None
-            for li in line_items.auto_paging_iter():
-                first_li = li
-                break
-            if first_li is None:
-                raise RuntimeError("Checkout sem line items; nada para faturar.")
-        
-            li_currency = (first_li.get("currency")
-                           or ((first_li.get("price") or {}).get("currency"))
-                           or checkout_currency).lower()
-            currency = li_currency
-        
-            # (Opcional, mas recomendado) Limpeza de itens PENDENTES antigos do mesmo customer
-            # para evitar que a Stripe "inclua" pendências de outra compra na nova invoice.
-            # Mantemos apenas os que têm parent_session_id == sessão atual.
-            pending_items = stripe.InvoiceItem.list(customer=cust, limit=100)
-            for ii in pending_items.auto_paging_iter():
-                if ii.get("invoice") is None and ii.get("metadata", {}).get("parent_session_id") != session.id:
-                    try:
-                        stripe.InvoiceItem.delete(ii.id)
-                        print(f"   → Pending InvoiceItem antigo removido: {ii.id}")
-                    except Exception as _:
-                        pass  # não falhar por limpeza
-        
-            # 2) Criar InvoiceItems PENDENTES (um por line item), na moeda do Checkout
-            #    Usamos amount_total (total exato do item já com qty/discount/imposto).
-            created_any = False
-            for li in line_items.auto_paging_iter():
-                total = li.get("amount_total")
-                if total is None:
-                    # Fallback defensivo
-                    total = li.get("amount_subtotal")
-                    if total is None:
-                        price = (li.get("price") or {})
-                        unit = int(price.get("unit_amount") or 0)
-                        qty = int(li.get("quantity") or 1)
-                        total = unit * qty
-        
-                price = li.get("price") or {}
-                product = price.get("product") or {}
-                name = product.get("name") or price.get("nickname") or li.get("description") or "Item"
-        
-                # idempotência por line_item.id
-                ii = stripe.InvoiceItem.create(
-                    customer=cust,
-                    currency=currency,
-                    amount=int(total),   # total em centavos
-                    description=clean_desc(name),
-                    metadata={
-                        "source": "mirror_checkout_session",
-                        "parent_session_id": session.id,
-                        "line_item_id": li.get("id", "")
-                    },
-                    idempotency_key=f"{idem_prefix}:ii:{li.get('id')}",
-                )
-                created_any = True
-                print(f"   → InvoiceItem pendente criado: {ii.id} | total: {int(total)/100:.2f} {currency.upper()}")
-        
-            if not created_any:
-                raise RuntimeError("Nenhum InvoiceItem criado; verifique os line items.")
-        
-            # 3) Criar a Invoice com include dos pendentes (herda a MOEDA dos itens)
-            footer_text = (
-                "Thank you for purchasing the formula. To access the material, "
-                "simply click on the link and follow the instructions: "
-                "https://burnjaroformula.online/members/\n\n"
-                "If you have any questions, please send an email to: "
-                "digital.solutions.ooh@gmail.com"
-            )
-            invoice = stripe.Invoice.create(
-                customer=cust,
-                collection_method="send_invoice",               # evita criar PaymentIntent interno
-                days_until_due=30,                              # obrigatório com send_invoice
-                pending_invoice_items_behavior="include",       # inclui os pendentes criados acima
-                auto_advance=False,
-                description="Compra via Checkout",
-                footer=footer_text,                             # <— usa variável
-                metadata={**(dict(session.metadata or {})), "parent_session_id": session.id},
-            )
-            print(f"   → Invoice draft criada: {invoice.id} | currency={invoice.currency.upper()}")
+            if not session.get("payment_intent"):
+                return
+            intent = await hydrator.payment_intent(session.payment_intent)
+            pm = intent.get("payment_method")
+            pm_id = pm.get("id") if hasattr(pm, "get") else pm
+            if pm_id:
+                upsell_context.put(session.id, cust, pm_id, session.metadata)
+        except Exception as e:
+            # sem contexto o /upsell/intent cai no caminho lento; não vale retry do evento
+            logger.warning("falha ao gravar contexto do upsell", error=str(e))
+
+    # Customer, Invoice espelho e tracking não dependem um do outro: rodam em
+    # paralelo, e Purchase/UTMify saem mesmo se a invoice falhar. No retry do
+    # evento só o ramo que falhou roda de novo (once=True, chave = id do evento).
+    graph = effects.TaskGraph("checkout.session.completed", key=event["id"])
+    graph.add("line_items", lambda: hydrator.line_items(session.id))
+    graph.add("customer",   update_customer, once=True)
+    graph.add("upsell_ctx", store_upsell_context, once=True)
+    if invoice_mirror.INVOICE_MIRROR_MODE == "inline":
+        graph.add("invoice", lambda items: stripe_call(mirror_invoice, session, cust, items),
+                  after=["line_items"], once=True)
+    elif invoice_mirror.INVOICE_MIRROR_MODE == "deferred":
+        # fora do caminho do webhook: o scheduler gera em lote fora de pico
+        graph.add("invoice", lambda items: invoice_mirror.enqueue(session, cust, items),
+                  after=["line_items"], once=True)
+    graph.add("order",      lambda items: record_checkout_paid(session, items), after=["line_items"])
+    graph.add("purchase",   purchase, after=["order"], once=True)
+    graph.add("utmify",     utmify_paid, after=["order"], once=True)
+    await graph.run()
+
+async def upsell_product_names(price_id):
+    """Nomes do produto/price na Stripe (para UTMify): (produto, plano, product_id)."""
+    product_name = "Upsell"   # fallback
+    plan_name    = "Upsell"   # fallback
+    product_id   = None
+    if price_id:
+        try:
+            pr = await catalog.get_price(price_id)
+            # apelido do price (se houver)
+            plan_name = getattr(pr, "nickname", None) or plan_name
+
+            prod_obj = getattr(pr, "product", None)
+            # StripeObject costuma ter .get(); se vier id string, busca o produto
+            if isinstance(prod_obj, dict) or hasattr(prod_obj, "get"):
+                product_name = prod_obj.get("name") or plan_name or product_name
+                product_id   = prod_obj.get("id")
+            elif isinstance(prod_obj, str):
+                prod = await stripe_call(stripe.Product.retrieve, prod_obj)
+                product_name = getattr(prod, "name", None) or plan_name or product_name
+                product_id   = getattr(prod, "id", None)
+        except Exception as e:
+            logger.warning("falha ao obter nome do upsell", price_id=price_id, error=str(e))
+    return product_name, plan_name, product_id
+
+async def record_upsell_paid(hydrator, approved_at: float = None, save: bool = True) -> dict:
+    """Grava no ledger o pedido pago de um upsell 1-click (webhook e backfill; save=False só monta)."""
+    payload = hydrator.payload()
+
+    # PaymentIntent e catálogo não dependem um do outro
+    graph = effects.TaskGraph("payment_intent.succeeded")
+    graph.add("intent", lambda: hydrator.payment_intent(payload.id))
+    graph.add("names",  lambda: upsell_product_names(payload.metadata.get("price_id")))
+    fetched = await graph.run()
+    intent = fetched["intent"]
+    product_name, plan_name, product_id = fetched["names"]
+
+    meta = dict(getattr(intent, "metadata", {}) or {})
+    price_id = meta.get("price_id")
+
+    # ── Dados do cliente (name/email/phone) ──────────────────────────
+    email = name = phone = None
+
+    # 1) billing_details da primeira charge
+    ch = getattr(intent, "charges", None)
+    if ch and getattr(ch, "data", None):
+        c0 = ch.data[0]
+        bd = getattr(c0, "billing_details", None)
+        if bd:
+            email = getattr(bd, "email", None) or None
+            name  = getattr(bd, "name",  None) or None
+            phone = getattr(bd, "phone", None) or None
+
+    if (not email or not name or not phone) and getattr(intent, "latest_charge", None):
+        bd = getattr(intent.latest_charge, "billing_details", None)
+        if bd:
+            email = getattr(bd, "email", None) or email
+            name  = getattr(bd, "name",  None) or name
+            phone = getattr(bd, "phone", None) or phone
+
+    # 2) fallback: Customer
+    cust = getattr(intent, "customer", None)   # expandido pela hidratação
+    if cust and (not email or not name or not phone):
+        if isinstance(cust, str):
+            cust = await hydrator.customer(cust)
+        email = email or (cust.get("email") or None)
+        name  = name  or (cust.get("name")  or None)
+        phone = phone or (cust.get("phone") or None)
+
+    # ── Pedido pago no ledger ────────────────────────────────────────
+    return (orders.record if save else orders.preview)(
+        intent.id, "paid",
+        platform="Stripe",
+        payment_method="credit_card",
+        currency=intent.currency,
+        total_cents=int(intent.amount),               # em centavos
+        fee_rate=orders.STRIPE_FEE_RATE,
+        created_at=intent.created,
+        approved_at=approved_at or time.time(),
+        customer_name=name,
+        customer_email=email,
+        customer_phone=phone,
+        products=[{
+            "id":           product_id or price_id,   # agrupar por produto? prefira product_id
+            "name":         product_name,             # nome real do produto (Stripe)
+            "planId":       price_id,                 # mantém o Price como plano
+            "planName":     plan_name,                # nickname do Price (ou fallback)
+            "quantity":     int(meta.get("quantity","1") or "1"),
+            "priceInCents": int(intent.amount),
+        }],
+        tracking=orders.utms(meta),
+        capi_event="Purchase",
+    )
 
-            stripe.Invoice.modify(invoice.id, collection_method="send_invoice", days_until_due=30)
-        
-            # 4) Finalizar e marcar como paga (sem e-mail e sem PI)
-            finalized = stripe.Invoice.finalize_invoice(
-                invoice.id,
-                auto_advance=False,
-                idempotency_key=f"{idem_prefix}:invoice:finalize",
-            )
-            print(
-                f"   → Invoice finalizada: {finalized.id} | "
-                f"amount_due: {finalized.amount_due/100:.2f} {finalized.currency.upper()}"
-            )
+async def handle_payment_intent_succeeded(event: dict):
+    """payment_intent.succeeded: Purchase e UTMify do upsell 1-click."""
+    # ↳ UPSSELL 1-CLICK (confirmado no front com confirmCardPayment)
+    hydrator = hydrate.Hydrator(event)
+    log.bind(payment_intent_id=hydrator.payload().get("id"))
+
+    # Só processa se marcamos como upsell no metadata
+    if (hydrator.payload().get("metadata") or {}).get("upsell") != "true":
+        # não é upsell, ignorar
+        return
+
+    # no retry do evento só sai de novo o envio que falhou
+    graph = effects.TaskGraph("payment_intent.succeeded:tracking", key=event["id"])
+    graph.add("order",    lambda: record_upsell_paid(hydrator))
+    graph.add("purchase", lambda order: outbox.deliver("capi", orders.capi_event(order, "Purchase"),
+                                                       label="Purchase (upsell)"), after=["order"], once=True)
+    graph.add("utmify",   lambda order: outbox.deliver("utmify", orders.utmify_order(order),
+                                                       label="Upsell UTMify (paid)"), after=["order"], once=True)
+    await graph.run()
+
+async def handle_invoice_index(event: dict):
+    """invoiceitem.* / invoice.*: mantém o índice sessão -> invoice em dia."""
+    invoice_index.apply_event(event)
+
+async def handle_catalog_update(event: dict):
+    """price.* / product.*: invalida o cache de catálogo."""
+    catalog.invalidate(event)
+    logger.info("catálogo invalidado", object_id=event["data"]["object"]["id"])
+
+# tipo de evento -> handler (rodam no pool de workers do webhook_queue)
+WEBHOOK_HANDLERS = {
+    "checkout.session.completed": handle_checkout_completed,
+    "payment_intent.succeeded":   handle_payment_intent_succeeded,
+    "price.updated":              handle_catalog_update,
+    "price.deleted":              handle_catalog_update,
+    "product.updated":            handle_catalog_update,
+    "product.deleted":            handle_catalog_update,
+    "invoiceitem.created":        handle_invoice_index,
+    "invoiceitem.updated":        handle_invoice_index,
+    "invoiceitem.deleted":        handle_invoice_index,
+    "invoice.created":            handle_invoice_index,
+    "invoice.updated":            handle_invoice_index,
+    "invoice.finalized":          handle_invoice_index,
+    "invoice.paid":               handle_invoice_index,
+    "invoice.voided":             handle_invoice_index,
+    "invoice.deleted":            handle_invoice_index,
+}
+
+def verify_webhook_signature(payload: bytes, header: str, tolerance: int = stripe.Webhook.DEFAULT_TOLERANCE):
+    """
+    Mesma checagem do stripe.Webhook.construct_event, direto nos bytes do
+    corpo (sem decode nem o parse para StripeObject que o SDK faz junto).
+    """
+    try:
+        parts = [p.split("=", 1) for p in header.split(",")]
+        timestamp = int(next(v for k, v in parts if k == "t"))
+        signatures = [v for k, v in parts if k == "v1"]
+    except (ValueError, StopIteration):
+        raise stripe.error.SignatureVerificationError("Unable to extract timestamp and signatures from header", header)
+    expected = hmac.new(WEBHOOK_SECRET.encode(), b"%d." % timestamp + payload, hashlib.sha256).hexdigest().encode()
+    # bytes: compare_digest com str não-ASCII (header forjado) levanta TypeError
+    if not any(hmac.compare_digest(expected, s.encode("utf-8", errors="replace")) for s in signatures):
+        raise stripe.error.SignatureVerificationError("No signatures found matching the expected signature for payload", header)
+    if tolerance and timestamp < time.time() - tolerance:
+        raise stripe.error.SignatureVerificationError(f"Timestamp outside the tolerance zone ({timestamp})", header)
 
-            if finalized.collection_method != "send_invoice":
-                stripe.Invoice.modify(finalized.id, collection_method="send_invoice", due_date=finalized.due_date or int(time.time()) + 30*24*60*60)
-            
-            state = stripe.Invoice.retrieve(finalized.id, expand=["payment_intent"])
-            pi_obj = getattr(state, "payment_intent", None)  # pode não existir
-            print(f"   → collection_method={state.collection_method} | has_pi={bool(pi_obj)}")
-            if pi_obj:
-                print(f"   → PI inesperado atrelado: {getattr(pi_obj, 'id', pi_obj)}")
-        
-            if finalized.status != "paid":
-                paid = stripe.Invoice.pay(
-                    finalized.id,
-                    paid_out_of_band=True,
-                    idempotency_key=f"{idem_prefix}:invoice:pay",
-                )
-                print(
-                    f"   → Invoice marcada como PAGA: {paid.id} | "
-                    f"amount_paid: {paid.amount_paid/100:.2f} {paid.currency.upper()}"
-                )
-                print(f"   → Links: hosted={paid.hosted_invoice_url} | pdf={paid.invoice_pdf}")
-            else:
-                print("   → Invoice já estava 'paid' (provavelmente amount_due=0).")
+@app.post("/webhook")
+async def stripe_webhook(request: Request):
+    payload = await request.body()
+    sig     = request.headers.get("stripe-signature", "")
 
-        except stripe.error.IdempotencyError as e:
-            # Ocorre quando o mesmo idempotency_key foi usado com parâmetros diferentes em alguma execução
-            print("⚠️ IdempotencyError ao criar invoice:", e)
-            try:
-                # Tenta achar invoice já vinculada a esta sessão
-                inv = None
-                invs = stripe.Invoice.list(customer=cust, limit=50)
-                for it in invs.auto_paging_iter():
-                    if (it.get("metadata") or {}).get("parent_session_id") == session.id:
-                        inv = it
-                        break
-
-                if inv:
-                    print(f"   → Reutilizando invoice existente: {inv.id} (status={inv.status})")
-                    # Se ainda DRAFT, aproveita para garantir footer/descrição atualizados
-                    if inv.status == "draft":
-                        inv = stripe.Invoice.modify(
-                            inv.id,
-                            collection_method="send_invoice",
-                            days_until_due=30,
-                            description="Compra via Checkout",
-                            footer=footer_text,
-                        )
-                        inv = stripe.Invoice.finalize_invoice(inv.id, auto_advance=False)
-                        print(f"   → Invoice finalizada: {inv.id} | amount_due: {inv.amount_due/100:.2f} {inv.currency.upper()}")
-
-                    # Paga out-of-band se ainda não estiver paga
-                    if inv.status != "paid":
-                        paid = stripe.Invoice.pay(
-                            inv.id,
-                            paid_out_of_band=True,
-                            idempotency_key=f"{idem_prefix}:invoice:pay",
-                        )
-                        print(
-                            f"   → Invoice marcada como PAGA: {paid.id} | "
-                            f"amount_paid: {paid.amount_paid/100:.2f} {paid.currency.upper()}"
-                        )
-                        print(f"   → Links: hosted={paid.hosted_invoice_url} | pdf={paid.invoice_pdf}")
-                    else:
-                        print("   → Invoice já estava 'paid'.")
-                else:
-                    print("   → Nenhuma invoice existente encontrada para esta sessão. Verifique os parâmetros/execuções anteriores.")
-
-            except Exception as _e:
-                import traceback
-                print("‼️ Falha ao reaproveitar invoice após IdempotencyError:", _e)
-                print(traceback.format_exc())
-
-        finally:
-            # 4) Mesmo se der erro acima, sempre envia o evento Purchase
-            resp = requests.post(
-                f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-                params={"access_token": ACCESS_TOKEN},
-                json=purchase_payload
-            )
-            print("→ Purchase event sent:", resp.status_code, resp.text)
-
-            # 4.1) Atualiza todo o order como "paid" — POST full payload
-            total = session.amount_total
-            fee   = total * Decimal("0.0674")   
-            net   = total - fee      
-            
-            utmify_order_paid = {
-              "orderId":       session.id,
-              "platform":      "Stripe",
-              "paymentMethod": "credit_card",
-              "status":        "paid",
-              "createdAt":     original_created_at,   # timestamp que você calculou lá em cima
-              "approvedDate":  time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-              "refundedAt":    None,
-              "customer": {
-                "name":     session.customer_details.name  or "",
-                "email":    session.customer_details.email,
-                "phone":    session.customer_details.phone or None,
-                "document": None
-              },
-              "products": [
-                  {
-                    "id":            li.price.id,
-                    "name":          li.description or li.price.id,
-                    "planId":        li.price.id,
-                    "planName":      li.price.nickname or None,
-                    "quantity":      li.quantity,
-                    "priceInCents":  li.amount_subtotal
-                  }
-                  for li in session.line_items.data
-                ],
-              "trackingParameters": {
-                "utm_source":     session.metadata.get("utm_source",""),
-                "utm_medium":     session.metadata.get("utm_medium",""),
-                "utm_campaign":   session.metadata.get("utm_campaign",""),
-                "utm_term":       session.metadata.get("utm_term",""),
-                "utm_content":    session.metadata.get("utm_content","")
-              },
-             "commission": {
-                "totalPriceInCents":     float(total),  
-                "gatewayFeeInCents":     float(fee),
-                "userCommissionInCents": float(net),
-                "currency":              session.currency.upper()
-             }
-            }
-            
-            resp_utm = requests.post(
-              UTMIFY_API_URL,
-              headers={
-                "Content-Type": "application/json",
-                "x-api-token":  UTMIFY_API_KEY
-              },
-              json=utmify_order_paid
-            )
-            print("→ Pedido atualizado como pago na UTMify:", resp_utm.status_code, resp_utm.text)
+    # 1) Valida a assinatura do webhook nos bytes e só então faz o parse (dict puro)
+    try:
+        verify_webhook_signature(payload, sig)
+        event = fastjson.loads(payload)
+    except stripe.error.SignatureVerificationError as e:
+        webhook_log.warning("assinatura do webhook não confere", error=str(e))
+        raise HTTPException(400, "Invalid webhook signature")
 
-    elif event["type"] == "payment_intent.succeeded":
-        # ↳ UPSSELL 1-CLICK (confirmado no front com confirmCardPayment)
-        intent_id = event["data"]["object"]["id"]
-        intent = stripe.PaymentIntent.retrieve(intent_id, expand=["latest_charge"])
-    
-        # Só processa se marcamos como upsell no metadata
-        meta = dict(getattr(intent, "metadata", {}) or {})
+    # 2) Ignora cedo o que não processamos (PaymentIntent só interessa se for upsell)
+    if event["type"] not in WEBHOOK_HANDLERS:
+        return JSONResponse({"received": True})
+    if event["type"] == "payment_intent.succeeded":
+        meta = event["data"]["object"].get("metadata") or {}
         if meta.get("upsell") != "true":
-            # não é upsell, ignorar
             return JSONResponse({"received": True})
-    
-        # ── Nomes do produto/price na Stripe (para UTMify) ─────────────────────
-        product_name = "Upsell"   # fallback
-        plan_name    = "Upsell"   # fallback
-        product_id   = None
-    
-        price_id = meta.get("price_id")
-        if price_id:
-            try:
-                pr = stripe.Price.retrieve(price_id, expand=["product"])
-                # apelido do price (se houver)
-                plan_name = getattr(pr, "nickname", None) or plan_name
-    
-                prod_obj = getattr(pr, "product", None)
-                # StripeObject costuma ter .get(); se vier id string, busca o produto
-                if isinstance(prod_obj, dict) or hasattr(prod_obj, "get"):
-                    product_name = prod_obj.get("name") or plan_name or product_name
-                    product_id   = prod_obj.get("id")
-                elif isinstance(prod_obj, str):
-                    prod = stripe.Product.retrieve(prod_obj)
-                    product_name = getattr(prod, "name", None) or plan_name or product_name
-                    product_id   = getattr(prod, "id", None)
-            except Exception as e:
-                print("→ Falha ao obter nome do upsell:", e)
-        # ───────────────────────────────────────────────────────────────────────
-    
-        # ── Dados do cliente (name/email/phone) ──────────────────────────
-        email = name = phone = None
-    
-        # 1) billing_details da primeira charge
-        ch = getattr(intent, "charges", None)
-        if ch and getattr(ch, "data", None):
-            c0 = ch.data[0]
-            bd = getattr(c0, "billing_details", None)
-            if bd:
-                email = getattr(bd, "email", None) or None
-                name  = getattr(bd, "name",  None) or None
-                phone = getattr(bd, "phone", None) or None
-    
-        if (not email or not name or not phone) and getattr(intent, "latest_charge", None):
-            bd = getattr(intent.latest_charge, "billing_details", None)
-            if bd:
-                email = getattr(bd, "email", None) or email
-                name  = getattr(bd, "name",  None) or name
-                phone = getattr(bd, "phone", None) or phone
-    
-        # 2) fallback: Customer
-        cust_id = getattr(intent, "customer", None)
-        if cust_id and (not email or not name or not phone):
-            cust = stripe.Customer.retrieve(cust_id)
-            email = email or (cust.get("email") or None)
-            name  = name  or (cust.get("name")  or None)
-            phone = phone or (cust.get("phone") or None)
-    
-        # ── Cálculos ─────────────────────────────────────────────────────
-        total = int(intent.amount)                         # em centavos
-        fee   = total * Decimal("0.0674")
-        net   = total - fee
-
-        # ── CAPI Purchase (email hash se disponível) ────────────────────
-        email_hash = hashlib.sha256(email.encode("utf-8")).hexdigest() if email else None
-        purchase_payload = {
-            "data": [{
-                "event_name": "Purchase",
-                "event_time": int(time.time()),
-                "event_id":   intent.id,
-                "action_source": "website",
-                "user_data": ({"em": email_hash} if email_hash else {}),
-                "custom_data": {
-                    "currency": intent.currency,
-                    "value":    total / 100.0,
-                    "content_ids":  [meta.get("price_id")] if meta.get("price_id") else [],
-                    "content_type": "product"
-                }
-            }]
-        }
-        try:
-            requests.post(
-                f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-                params={"access_token": ACCESS_TOKEN},
-                json=purchase_payload
-            )
-        except Exception as e:
-            print("→ CAPI (upsell) erro:", e)
-
-        # ── UTMify paid (mantendo campos e comissão como no principal) ──
-        utmify_order_paid = {
-          "orderId":       intent.id,
-          "platform":      "Stripe",
-          "paymentMethod": "credit_card",
-          "status":        "paid",
-          "createdAt":     time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(intent.created)),
-          "approvedDate":  time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-          "refundedAt":    None,
-          "customer": {
-            "name":     name  or "",
-            "email":    email or "",
-            "phone":    phone or None,
-            "document": None
-          },
-          "products": [
-              {
-                "id":           product_id or price_id,   # agrupar por produto? prefira product_id
-                "name":         product_name,             # nome real do produto (Stripe)
-                "planId":       price_id,                 # mantém o Price como plano
-                "planName":     plan_name,                # nickname do Price (ou fallback)
-                "quantity":     int(meta.get("quantity","1") or "1"),
-                "priceInCents": total
-              }
-            ],
-          "trackingParameters": {
-            "utm_source":   meta.get("utm_source",""),
-            "utm_medium":   meta.get("utm_medium",""),
-            "utm_campaign": meta.get("utm_campaign",""),
-            "utm_term":     meta.get("utm_term",""),
-            "utm_content":  meta.get("utm_content","")
-          },
-          "commission": {
-            "totalPriceInCents":     float(total),
-            "gatewayFeeInCents":     float(fee),
-            "userCommissionInCents": float(net),
-            "currency":              intent.currency.upper()
-          }
-        }
 
+    # 3) Sem store durável: processa antes do 200; se falhar, 500 e a Stripe reenvia
+    if not store.DURABLE:
         try:
-            resp_utm = requests.post(
-              UTMIFY_API_URL,
-              headers={"Content-Type": "application/json","x-api-token": UTMIFY_API_KEY},
-              json=utmify_order_paid
-            )
-            print("→ Upsell pago enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
+            await webhook_queue.process_now(WEBHOOK_HANDLERS[event["type"]], event["id"], event["type"], event)
         except Exception as e:
-            print("→ UTMify (upsell) erro:", e)
-    
+            webhook_log.exception("falha ao processar webhook", event_id=event["id"], event_type=event["type"],
+                                  error=repr(e))
+            return JSONResponse({"received": False}, status_code=500)
+        return JSONResponse({"received": True})
+
+    # 4) Persiste e confirma; o processamento roda no pool de workers
+    # o corpo vai para a fila como veio (bytes), sem decode
+    if not webhook_queue.persist(event["id"], event["type"], payload):
+        webhook_log.debug("webhook duplicado; ignorado", event_id=event["id"], event_type=event["type"])
+
     # 5) Retorna 200 sempre
     return JSONResponse({"received": True})
 
 @app.post("/track-paypal")
 async def track_paypal(request: Request):
-    raw_body = await request.body()
-    # 1) Validação back-and-forth com o PayPal
-    verify = requests.post(
-        "https://ipnpb.paypal.com/cgi-bin/webscr",
-        data=b"cmd=_notify-validate&" + raw_body,
-        headers={"Content-Type": "application/x-www-form-urlencoded"}
-    )
-    if verify.text != "VERIFIED":
-        return JSONResponse(status_code=400, content={"status": "invalid ipn"})
-
-    # 2) Parse dos dados do IPN
-    form = dict(urllib.parse.parse_qsl(raw_body.decode()))
-    utm_source       = form.get("custom_utm_source", "")
-    utm_medium       = form.get("custom_utm_medium", "")
-    utm_campaign     = form.get("custom_utm_campaign", "")
-    utm_term         = form.get("custom_utm_term", "")
-    utm_content      = form.get("custom_utm_content", "")
-
-    # ───────────────────────────────────────────────────────────
-    # 2.5) Dispara o Purchase para a Meta (Facebook) Conversion API
-    purchase_payload = {
-      "data": [{
-        "event_name":    "Purchase",
-        "event_time":    int(time.time()),
-        "event_id":      form.get("txn_id", ""),              # ID da transação PayPal
-        "action_source": "website",
-        "event_source_url": form.get("return_url", ""),
-        "user_data": {
-          "em": hashlib.sha256(
-                  form.get("payer_email", "").encode("utf-8")
-                ).hexdigest()
-        },
-        "custom_data": {
-          "currency": form.get("mc_currency", ""),
-          "value":    float(form.get("mc_gross", 0)),
-          "content_ids": [ form.get("item_number", "") ],
-          "content_type": "product"
-        }
-      }]
-    }
-    requests.post(
-      f"https://graph.facebook.com/v14.0/{PIXEL_ID}/events",
-      params={"access_token": ACCESS_TOKEN},
-      json=purchase_payload
-    )
+    # Só grava o IPN e devolve 200 (senão o PayPal reenvia); a validação com o
+    # PayPal e os efeitos rodam no pool de workers do webhook_queue. Sem store
+    # durável roda tudo antes de responder e uma falha vira 500 (o PayPal reenvia).
+    # latin-1 preserva os bytes exatos (a validação reenvia o corpo idêntico)
+    raw_body = (await request.body()).decode("latin-1")
+    form = dict(urllib.parse.parse_qsl(raw_body))
+    txn_id = form.get("txn_id")
+    if txn_id and paypal_txns.seen(txn_id):
+        webhook_log.debug("IPN já processado; ignorado", txn_id=txn_id)
+        return JSONResponse({"status": "ok"})
+
+    # id da fila pelo corpo, não pelo txn_id (que ainda não foi verificado):
+    # um IPN forjado com o txn de outro não barra o verdadeiro. Reenvios
+    # idênticos colapsam; o txn_id só deduplica depois do VERIFIED (paypal_txns)
+    key = hashlib.sha256(raw_body.encode("latin-1")).hexdigest()
+    ipn = {"id": f"paypal:{key}", "type": "paypal.ipn", "raw": raw_body}
+    if not store.DURABLE:
+        try:
+            await webhook_queue.process_now(handle_paypal_ipn, ipn["id"], ipn["type"], ipn)
+        except Exception as e:
+            webhook_log.exception("falha ao processar IPN", event_id=ipn["id"], error=repr(e))
+            return JSONResponse({"status": "error"}, status_code=500)
+        return JSONResponse({"status": "ok"})
+    if not webhook_queue.persist(ipn["id"], ipn["type"], fastjson.dumps_str(ipn)):
+        webhook_log.debug("IPN duplicado; ignorado", event_id=ipn["id"])
+    return JSONResponse({"status": "ok"})
 
-    # 2.5.1) Cria pedido inicial no UTMify (PayPal)
+async def handle_paypal_ipn(ipn: dict):
+    """IPN do PayPal: valida com o PayPal e só então Purchase, UTMify e Customer."""
+    raw_body = ipn["raw"]
+    # 1) Validação back-and-forth com o PayPal (uma vez por IPN, não a cada retry)
+    if not paypal_verified.seen(ipn["id"]):
+        verify = await upstreams.verify_ipn(raw_body.encode("latin-1"))
+        if verify == "INVALID":
+            webhook_log.warning("IPN inválido; descartado")
+            return
+        if verify != "VERIFIED":
+            raise RuntimeError(f"resposta inesperada do PayPal na validação do IPN: {verify[:200]!r}")
+        paypal_verified.mark(ipn["id"])
+
+    # 2) Parse dos dados do IPN (já verificado)
+    form = dict(urllib.parse.parse_qsl(raw_body))
+    utms = orders.utms({k[len("custom_"):]: v for k, v in form.items() if k.startswith("custom_utm_")})
     txn_id = form.get("txn_id", "")
-    created_at = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    utmify_order = {
-      "orderId":       txn_id,
-      "platform":      "PayPal",
-      "paymentMethod": "paypal",
-      "status":        "waiting_payment",
-      "createdAt":     created_at,
-      "approvedDate":  None,
-      "refundedAt":    None,
-      "customer": {
-        "email": form.get("payer_email", "")
-      },
-      "products": [
-        {
-          "id":           form.get("item_number", ""),
-          "name":         form.get("item_name", ""),
-          "quantity":     int(form.get("quantity", 1)),
-          "priceInCents": int(float(form.get("mc_gross", 0)) * 100)
-        }
-      ],
-      "trackingParameters": {
-        "utm_source":      utm_source,
-        "utm_medium":      utm_medium,
-        "utm_campaign":    utm_campaign,
-        "utm_term":        utm_term,
-        "utm_content":     utm_content
-      },
-      "commission": {
-        "totalPriceInCents":     int(float(form.get("mc_gross", 0)) * 100),
-        "gatewayFeeInCents":     0,
-        "userCommissionInCents": 0,
-        "currency":              form.get("mc_currency", "").upper()
-      }
-    }
-    resp_utm = requests.post(
-      UTMIFY_API_URL,
-      headers={
-        "Content-Type":  "application/json",
-        "x-api-token":   UTMIFY_API_KEY
-      },
-      json=utmify_order
-    )
-    print("→ Pedido inicial (PayPal) enviado ao UTMify:", resp_utm.status_code, resp_utm.text)
-    # ───────────────────────────────────────────────────────────
+    log.bind(txn_id=txn_id or None)
+    if txn_id and paypal_txns.seen(txn_id):
+        # outro IPN verificado do mesmo txn (corpo diferente) já foi processado
+        webhook_log.debug("IPN já processado; ignorado")
+        return
+
+    # 2.5) Pedido inicial no ledger -> Purchase (Meta) e UTMify (PayPal)
+    total_cents = round(float(form.get("mc_gross", 0)) * 100)
+
+    def record_order():
+        return orders.record(
+            txn_id or ipn["id"], "waiting_payment",
+            platform="PayPal",
+            payment_method="paypal",
+            currency=form.get("mc_currency", ""),
+            total_cents=total_cents,
+            customer_email=form.get("payer_email", ""),
+            source_url=form.get("return_url", ""),
+            products=[{
+                "id":           form.get("item_number", ""),
+                "name":         form.get("item_name", ""),
+                "planId":       form.get("item_number", ""),
+                "planName":     None,
+                "quantity":     int(form.get("quantity", 1)),
+                "priceInCents": total_cents,
+            }],
+            tracking=utms,
+            capi_event="Purchase",
+        )
 
     # 3) Cria o cliente na Stripe
-    stripe.api_key = STRIPE_SECRET_KEY
-    stripe.Customer.create(
-        email=form.get("payer_email"),
-        metadata={
-            "utm_source":   utm_source,
-            "utm_medium":   utm_medium,
-            "utm_campaign": utm_campaign,
-            "utm_term":     utm_term,
-            "utm_content":  utm_content,
-            "origin":       "paypal"
-        }
-    )
-    return JSONResponse({"status": "ok"})
+    def create_customer():
+        return stripe_call(
+            stripe.Customer.create,
+            email=form.get("payer_email"),
+            metadata={**utms, "origin": "paypal"},
+            idempotency_key=f"paypal:{txn_id}:customer" if txn_id else None,
+        )
+
+    # uma falha da Stripe (breaker, 5xx, 429) faz o IPN voltar; no retry só o
+    # que falhou roda de novo (chave = txn_id: vale também para outro corpo do mesmo txn)
+    graph = effects.TaskGraph("paypal.ipn", key=txn_id or ipn["id"])
+    graph.add("order",    record_order)
+    graph.add("purchase", lambda order: outbox.deliver("capi", orders.capi_event(order, "Purchase"),
+                                                       label="Purchase (PayPal)"), after=["order"], once=True)
+    graph.add("utmify",   lambda order: outbox.deliver("utmify", orders.utmify_order(order),
+                                                       label="Order UTMify (PayPal)"), after=["order"], once=True)
+    graph.add("customer", create_customer, once=True)
+    await graph.run()
+    if txn_id:
+        paypal_txns.mark(txn_id)
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,139 @@
+"""
+Métricas no formato texto do Prometheus, servidas em GET /metrics.
+
+Registro mínimo em memória (sem dependência externa): Counter, Gauge e
+Histogram com labels. Gauges podem ter uma função de coleta, avaliada a
+cada scrape (útil para valores que vivem no SQLite, como o backlog das
+filas).
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+_registry = []
+_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def samples(self):
+        with _lock:
+            return [(self.name, k, v) for k, v in self._values.items()]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{_fmt_labels(self.labels, key)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        """`collect`, se informado, devolve {tupla_de_labels: valor} a cada scrape."""
+        super().__init__(name, help, labels)
+        self._collect = collect
+
+    def set(self, value: float, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._collect is not None:
+            return [(self.name, k, v) for k, v in self._collect().items()]
+        return super().samples()
+
+
+# buckets em segundos: de chamadas locais (ms) a upstreams lentos (dezenas de s)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with _lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        out = []
+        with _lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for key, (counts, total, count) in items:
+            for bound, n in zip(self.buckets, counts):
+                out.append((f"{self.name}_bucket", key + (bound,), n))
+            out.append((f"{self.name}_bucket", key + ("+Inf",), count))
+            out.append((f"{self.name}_sum", key, round(total, 6)))
+            out.append((f"{self.name}_count", key, count))
+        return out
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            names = self.labels + ("le",) if name.endswith("_bucket") else self.labels
+            lines.append(f"{name}{_fmt_labels(names, key)} {value}")
+        return "\n".join(lines)
+
+
+def render() -> str:
+    """Texto completo do /metrics."""
+    return "\n".join(m.render() for m in _registry) + "\n"
@@ -0,0 +1,252 @@
+"""
+Ledger local de pedidos (SQLite): a fonte única dos payloads de tracking.
+
+Cada fluxo (checkout, webhook pago, upsell, PayPal) só grava o pedido com
+record(); os payloads da UTMify e da Meta CAPI saem de um serializer por
+destino a partir da linha do ledger. As mudanças de status ficam em
+order_transitions. Reenviar um dia de pedidos (resend) é leitura local,
+sem chamada à Stripe:
+
+    python orders.py resend --since 2025-09-01 --until 2025-09-02 --dest utmify
+"""
+import argparse
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import fastjson
+import outbox
+import store
+
+STRIPE_FEE_RATE = Decimal(os.getenv("STRIPE_FEE_RATE", "0.0674"))
+
+# status só avança (uma reentrega atrasada de waiting_payment não desfaz o paid)
+STATUS_RANK = {"waiting_payment": 0, "paid": 1, "refunded": 2}
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS orders (
+    order_id       TEXT PRIMARY KEY,
+    platform       TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    status         TEXT NOT NULL,
+    currency       TEXT NOT NULL,
+    total_cents    INTEGER NOT NULL,
+    fee_rate       TEXT NOT NULL DEFAULT '0',
+    created_at     REAL NOT NULL,
+    approved_at    REAL,
+    refunded_at    REAL,
+    customer_name  TEXT,
+    customer_email TEXT,
+    customer_phone TEXT,
+    source_url     TEXT,                 -- página do comprador (event_source_url da CAPI)
+    client_ip      TEXT,
+    user_agent     TEXT,
+    products       TEXT NOT NULL DEFAULT '[]',
+    tracking       TEXT NOT NULL DEFAULT '{}',
+    capi_event     TEXT,                 -- último evento da CAPI emitido (para reenvio)
+    updated_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_updated ON orders (updated_at);
+CREATE TABLE IF NOT EXISTS order_transitions (
+    order_id TEXT NOT NULL,
+    status   TEXT NOT NULL,
+    at       REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS order_transitions_order ON order_transitions (order_id, at);
+""")
+
+_COLUMNS = (
+    "platform", "payment_method", "status", "currency", "total_cents", "fee_rate", "created_at",
+    "approved_at", "refunded_at", "customer_name", "customer_email", "customer_phone",
+    "source_url", "client_ip", "user_agent", "products", "tracking", "capi_event",
+)
+UTM_KEYS = ("utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content")
+
+
+def utms(source) -> dict:
+    """Os cinco utm_* de um dict de metadata (faltando -> "")."""
+    source = source or {}
+    return {k: source.get(k, "") or "" for k in UTM_KEYS}
+
+
+def _row(row) -> dict:
+    order = dict(row)
+    order["products"] = fastjson.loads(order["products"])
+    order["tracking"] = fastjson.loads(order["tracking"])
+    return order
+
+
+def _merge(old, order_id: str, status: str, fields: dict, now: float) -> dict:
+    """Linha resultante de aplicar fields/status sobre old (None: pedido novo)."""
+    fields = {k: v for k, v in fields.items() if v is not None}
+    unknown = set(fields) - set(_COLUMNS)
+    if unknown:
+        raise ValueError(f"campos desconhecidos no pedido: {sorted(unknown)}")
+    for k in ("products", "tracking"):
+        if k in fields:
+            fields[k] = fastjson.dumps_str(fields[k])
+    if "fee_rate" in fields:
+        fields["fee_rate"] = str(fields["fee_rate"])
+
+    if old is None:
+        fields.setdefault("created_at", now)
+        merged = {**fields, "status": status}
+    else:
+        merged = {**dict(old), **fields}
+        if STATUS_RANK.get(status, 0) >= STATUS_RANK.get(old["status"], 0):
+            merged["status"] = status
+    merged.update(order_id=order_id, updated_at=now)
+    return merged
+
+
+def record(order_id: str, status: str, **fields) -> dict:
+    """
+    Cria ou atualiza o pedido e devolve a linha resultante. Campos None não
+    apagam o que já estava gravado; o status nunca regride.
+    """
+    now = time.time()
+    with store.transaction() as conn:
+        old = conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+        merged = _merge(old, order_id, status, fields, now)
+        cols = ["order_id", "updated_at", *[c for c in _COLUMNS if c in merged]]
+        conn.execute(
+            f"INSERT OR REPLACE INTO orders ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            [merged[c] for c in cols],
+        )
+        if old is None or old["status"] != merged["status"]:
+            conn.execute(
+                "INSERT INTO order_transitions (order_id, status, at) VALUES (?, ?, ?)",
+                (order_id, merged["status"], now),
+            )
+        row = conn.execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    return _row(row)
+
+
+def preview(order_id: str, status: str, **fields) -> dict:
+    """O que record() devolveria, sem gravar nada (dry-run do backfill)."""
+    old = store.connect().execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    merged = _merge(old, order_id, status, fields, time.time())
+    return _row({c: merged.get(c) for c in ("order_id", *_COLUMNS, "updated_at")})
+
+
+def get(order_id: str):
+    row = store.connect().execute("SELECT * FROM orders WHERE order_id = ?", (order_id,)).fetchone()
+    return _row(row) if row is not None else None
+
+
+def between(since: float, until: float, status: str = None) -> list:
+    """Pedidos criados em [since, until), opcionalmente só de um status."""
+    sql = "SELECT * FROM orders WHERE created_at >= ? AND created_at < ?"
+    params = [since, until]
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    return [_row(r) for r in store.connect().execute(sql + " ORDER BY created_at", params)]
+
+
+# ── serializers ─────────────────────────────────────────────────────────
+
+def _fmt(ts):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts)) if ts else None
+
+
+def utmify_order(order: dict) -> dict:
+    """Payload de pedido da UTMify."""
+    total = order["total_cents"]
+    commission = {
+        "totalPriceInCents":     total,
+        "gatewayFeeInCents":     0,
+        "userCommissionInCents": 0,
+        "currency":              order["currency"].upper(),
+    }
+    if order["status"] == "paid":
+        fee = total * Decimal(order["fee_rate"])
+        commission.update({
+            "totalPriceInCents":     float(total),
+            "gatewayFeeInCents":     float(fee),
+            "userCommissionInCents": float(total - fee),
+        })
+    return {
+        "orderId":       order["order_id"],
+        "platform":      order["platform"],
+        "paymentMethod": order["payment_method"],
+        "status":        order["status"],
+        "createdAt":     _fmt(order["created_at"]),
+        "approvedDate":  _fmt(order["approved_at"]),
+        "refundedAt":    _fmt(order["refunded_at"]),
+        "customer": {
+            "name":     order["customer_name"] or "",
+            "email":    order["customer_email"] or "",
+            "phone":    order["customer_phone"] or None,
+            "document": None,
+        },
+        "products":           order["products"],
+        "trackingParameters": utms(order["tracking"]),
+        "commission":         commission,
+    }
+
+
+def capi_event(order: dict, event_name: str) -> dict:
+    """Payload da Conversions API (um evento) para o pedido."""
+    user_data = {}
+    if order["customer_email"]:
+        user_data["em"] = hashlib.sha256(order["customer_email"].encode("utf-8")).hexdigest()
+    if order["client_ip"]:
+        user_data["client_ip_address"] = order["client_ip"]
+    if order["user_agent"]:
+        user_data["client_user_agent"] = order["user_agent"]
+    # event_time do momento da transição (reenvios mantêm o horário original)
+    when = (order["approved_at"] if event_name == "Purchase" else None) or order["created_at"]
+    event = {
+        "event_name":    event_name,
+        "event_time":    int(when),
+        "event_id":      order["order_id"],
+        "action_source": "website",
+        "user_data":     user_data,
+        "custom_data": {
+            "currency":     order["currency"],
+            "value":        order["total_cents"] / 100.0,
+            "content_ids":  [p["planId"] for p in order["products"] if p.get("planId")],
+            "content_type": "product",
+        },
+    }
+    if order["source_url"]:
+        event["event_source_url"] = order["source_url"]
+    return {"data": [event]}
+
+
+def resend(since: float, until: float, destinations=("utmify", "capi"), status: str = None) -> int:
+    """Reenfileira os pedidos do intervalo a partir do ledger (sem Stripe)."""
+    count = 0
+    for order in between(since, until, status):
+        if "utmify" in destinations:
+            outbox.enqueue("utmify", utmify_order(order), label=f"Order UTMify (resend {order['status']})")
+        if "capi" in destinations and order["capi_event"]:
+            event_name = order["capi_event"]
+            outbox.enqueue("capi", capi_event(order, event_name), label=f"{event_name} (resend)")
+        count += 1
+    return count
+
+
+def _date(value: str) -> float:
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ledger de pedidos")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("resend", help="reenfileira pedidos do ledger no outbox (o app envia)")
+    p.add_argument("--since", required=True, help="data/hora UTC ISO, ex.: 2025-09-01")
+    p.add_argument("--until", required=True)
+    p.add_argument("--dest", choices=("utmify", "capi"), action="append")
+    p.add_argument("--status", choices=tuple(STATUS_RANK))
+    args = parser.parse_args()
+
+    n = resend(_date(args.since), _date(args.until), tuple(args.dest or ("utmify", "capi")), args.status)
+    print(f"→ {n} pedidos reenfileirados")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+"""
+Outbox durável para as notificações de tracking (Meta CAPI e UTMify).
+
+Os handlers só fazem enqueue() (um INSERT local) e respondem; o dispatcher
+em background drena a fila com retry + backoff exponencial e limite de
+concorrência por destino. Como a fila vive no SQLite, um restart do worker
+não perde eventos: linhas "presas" num envio voltam para a fila quando o
+lease expira.
+
+Destinos em BATCHING (hoje só a CAPI) juntam vários eventos num request só:
+a fila acumula até o tamanho máximo ou até a janela expirar. Se o lote
+falhar por um evento ruim, cada evento é reenviado sozinho (a Meta
+deduplica por event_id, então reenviar o lote inteiro é seguro).
+
+Com o circuit breaker do upstream aberto o destino nem é drenado; linhas
+recusadas pelo breaker são adiadas sem gastar tentativa.
+
+Sem store durável (store.DURABLE) os handlers de webhook/IPN usam deliver(),
+que envia na hora em vez de enfileirar.
+"""
+import asyncio
+import functools
+import os
+import random
+import sqlite3
+import time
+
+import httpx
+
+import fastjson
+import log
+import store
+import upstreams
+from resilience import BREAKERS, CircuitOpenError
+
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_MAX_ATTEMPTS  = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "12"))
+OUTBOX_BACKOFF_BASE  = float(os.getenv("OUTBOX_BACKOFF_BASE", "2.0"))
+OUTBOX_BACKOFF_MAX   = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+CAPI_BATCH_SIZE      = min(int(os.getenv("CAPI_BATCH_SIZE", "500")), 1000)  # limite da Graph API
+CAPI_BATCH_WINDOW    = float(os.getenv("CAPI_BATCH_WINDOW", "2.0"))
+
+logger = log.get("outbox")
+
+# destino -> função que envia o payload
+SENDERS = {
+    "capi":   upstreams.send_capi,
+    "utmify": upstreams.send_utmify,
+}
+
+# destino -> circuit breaker do upstream
+BREAKER_OF = {
+    "capi":   "graph",
+    "utmify": "utmify",
+}
+
+
+def _merge_capi(payloads: list) -> dict:
+    return {"data": [event for p in payloads for event in p["data"]]}
+
+
+def _capi_accepted(resp, payload: dict) -> bool:
+    # a Graph responde {"events_received": N}; menos que o enviado = lote parcial
+    try:
+        body = resp.json()
+    except ValueError:
+        return False
+    # 2xx com JSON que não é objeto: não aceito (cai no reenvio um a um)
+    return isinstance(body, dict) and body.get("events_received") == len(payload["data"])
+
+
+# destino -> (tamanho máx do lote, janela em s, merge dos payloads, checagem do aceite)
+BATCHING = {
+    "capi": (CAPI_BATCH_SIZE, CAPI_BATCH_WINDOW, _merge_capi, _capi_accepted),
+}
+
+# requests simultâneos por destino (OUTBOX_CONCURRENCY_CAPI, OUTBOX_CONCURRENCY_UTMIFY)
+CONCURRENCY = {
+    dest: int(os.getenv(f"OUTBOX_CONCURRENCY_{dest.upper()}", "4"))
+    for dest in SENDERS
+}
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS outbox (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    destination     TEXT    NOT NULL,
+    label           TEXT    NOT NULL DEFAULT '',
+    payload         TEXT    NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,
+    locked_until    REAL    NOT NULL DEFAULT 0,
+    dead            INTEGER NOT NULL DEFAULT 0,
+    last_error      TEXT,
+    created_at      REAL    NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (destination, dead, next_attempt_at);
+""")
+
+_loop = None
+_wakeup = None
+
+
+def enqueue(destination: str, payload: dict, label: str = ""):
+    """Grava o payload na fila; o envio acontece no dispatcher."""
+    if destination not in SENDERS:
+        raise ValueError(f"destino de outbox desconhecido: {destination}")
+    now = time.time()
+    store.connect().execute(
+        "INSERT INTO outbox (destination, label, payload, next_attempt_at, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (destination, label, fastjson.dumps_str(payload), now, now),
+    )
+    _notify()
+
+
+async def deliver(destination: str, payload: dict, label: str = ""):
+    """
+    enqueue() quando o store é durável. Sem ele (store.DURABLE falso) envia
+    agora e levanta se o destino falhar: o handler falha e a Stripe/PayPal
+    reenvia o evento, em vez de a linha sumir da fila num restart.
+    """
+    if store.DURABLE:
+        enqueue(destination, payload, label)
+        return
+    resp = await SENDERS[destination](payload)
+    logger.info("enviado", label=label, status=resp.status_code, body=resp.text)
+    if 400 <= resp.status_code < 500 and resp.status_code != 429:
+        # não melhora com retry (como no _send): não faz o evento voltar
+        logger.error("envio recusado; descartado", label=label, destination=destination, status=resp.status_code)
+    elif not resp.is_success:
+        raise RuntimeError(f"{destination} respondeu HTTP {resp.status_code}: {resp.text[:200]}")
+
+
+def _notify():
+    # pode ser chamado do pool de threads da Stripe; acorda o dispatcher no loop dele
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+def _claim(destination: str, limit: int) -> list:
+    now = time.time()
+    with store.transaction() as conn:
+        if destination in BATCHING:
+            # só libera o lote quando encheu ou quando o mais antigo passou da janela
+            size, window = BATCHING[destination][:2]
+            due, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(next_attempt_at) FROM outbox "
+                "WHERE destination = ? AND dead = 0 AND next_attempt_at <= ? AND locked_until <= ?",
+                (destination, now, now),
+            ).fetchone()
+            if not due or (due < size and oldest > now - window):
+                return []
+            limit *= size
+        rows = conn.execute(
+            "SELECT id, label, payload, attempts FROM outbox "
+            "WHERE destination = ? AND dead = 0 AND next_attempt_at <= ? AND locked_until <= ? "
+            "ORDER BY id LIMIT ?",
+            (destination, now, now, limit),
+        ).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE outbox SET locked_until = ? WHERE id = ?",
+                [(now + OUTBOX_LEASE_SECONDS, r["id"]) for r in rows],
+            )
+    return rows
+
+
+def _done(row_id: int):
+    store.connect().execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+
+
+def _postpone(row_ids: list, delay: float):
+    # breaker aberto: volta para a fila sem contar tentativa
+    store.connect().executemany(
+        "UPDATE outbox SET next_attempt_at = ?, locked_until = 0 WHERE id = ?",
+        [(time.time() + delay, i) for i in row_ids],
+    )
+
+
+def _retry_later(row_id: int, attempts: int, error: str, permanent: bool = False):
+    attempts += 1
+    dead = permanent or attempts >= OUTBOX_MAX_ATTEMPTS
+    delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE ** attempts) * random.uniform(0.5, 1.0)
+    store.connect().execute(
+        "UPDATE outbox SET attempts = ?, next_attempt_at = ?, locked_until = 0, "
+        "dead = ?, last_error = ? WHERE id = ?",
+        (attempts, time.time() + delay, int(dead), error[:1000], row_id),
+    )
+    if dead:
+        logger.error("outbox descartado", outbox_id=row_id, attempts=attempts, error=error)
+
+
+def _done_many(row_ids: list):
+    store.connect().executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in row_ids])
+
+
+def _retry_many(rows: list, error: str):
+    for r in rows:
+        _retry_later(r["id"], r["attempts"], error)
+
+
+async def _send(destination: str, row):
+    log.bind(outbox_id=row["id"], destination=destination)
+    try:
+        resp = await SENDERS[destination](fastjson.loads(row["payload"]))
+        logger.info("enviado", label=row["label"], status=resp.status_code, body=resp.text)
+        if resp.is_success:
+            await asyncio.to_thread(_done, row["id"])
+        else:
+            # 4xx (exceto 429) não melhora com retry
+            permanent = 400 <= resp.status_code < 500 and resp.status_code != 429
+            await asyncio.to_thread(_retry_later, row["id"], row["attempts"],
+                                    f"HTTP {resp.status_code}: {resp.text}", permanent)
+    except asyncio.CancelledError:
+        # shutdown passou do prazo: volta para a fila já, sem esperar o lease
+        _postpone([row["id"]], 0)
+        raise
+    except CircuitOpenError as e:
+        await asyncio.to_thread(_postpone, [row["id"]], e.retry_after)
+    except (httpx.HTTPError, OSError) as e:
+        await asyncio.to_thread(_retry_later, row["id"], row["attempts"], repr(e))
+    except Exception as e:
+        logger.exception("erro inesperado no envio", error=repr(e))
+        await asyncio.to_thread(_retry_later, row["id"], row["attempts"], repr(e))
+
+
+async def _send_batch(destination: str, rows: list):
+    if len(rows) == 1:
+        return await _send(destination, rows[0])
+
+    _, _, merge, accepted = BATCHING[destination]
+    payload = merge([fastjson.loads(r["payload"]) for r in rows])
+    try:
+        resp = await SENDERS[destination](payload)
+    except asyncio.CancelledError:
+        _postpone([r["id"] for r in rows], 0)
+        raise
+    except CircuitOpenError as e:
+        await asyncio.to_thread(_postpone, [r["id"] for r in rows], e.retry_after)
+        return
+    except (httpx.HTTPError, OSError) as e:
+        # falha de rede: o lote todo volta para a fila
+        await asyncio.to_thread(_retry_many, rows, repr(e))
+        return
+
+    logger.info("lote enviado", destination=destination, events=len(rows), status=resp.status_code, body=resp.text)
+    if resp.is_success and accepted(resp, payload):
+        await asyncio.to_thread(_done_many, [r["id"] for r in rows])
+    elif resp.status_code == 429 or resp.status_code >= 500:
+        await asyncio.to_thread(_retry_many, rows, f"HTTP {resp.status_code}: {resp.text}")
+    else:
+        # lote recusado/parcial: isola o(s) evento(s) ruim(ns) reenviando um a um
+        step = CONCURRENCY[destination]
+        for i in range(0, len(rows), step):
+            await asyncio.gather(*(_send(destination, r) for r in rows[i:i + step]))
+
+
+async def run_dispatcher(stop: asyncio.Event):
+    """Loop do dispatcher; roda até `stop` ser setado (shutdown do app)."""
+    global _loop, _wakeup
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    busy = {dest: 0 for dest in SENDERS}
+    inflight = set()
+
+    def _finished(dest, task):
+        inflight.discard(task)
+        busy[dest] -= 1
+        _wakeup.set()
+
+    while not stop.is_set():
+        _wakeup.clear()
+        claimed = 0
+        for dest, limit in CONCURRENCY.items():
+            free = limit - busy[dest]
+            if free <= 0 or not BREAKERS[BREAKER_OF[dest]].available():
+                continue
+            try:
+                # BEGIN IMMEDIATE disputado entre workers: espera numa thread, não no loop
+                rows = await asyncio.to_thread(_claim, dest, free)
+            except sqlite3.OperationalError as e:
+                if not store.busy(e):
+                    raise
+                logger.warning("claim adiado (SQLite ocupado)", destination=dest)
+                continue
+            if dest in BATCHING:
+                size = BATCHING[dest][0]
+                jobs = [_send_batch(dest, rows[i:i + size]) for i in range(0, len(rows), size)]
+            else:
+                jobs = [_send(dest, row) for row in rows]
+            for job in jobs:
+                busy[dest] += 1
+                task = asyncio.create_task(job)
+                inflight.add(task)
+                task.add_done_callback(functools.partial(_finished, dest))
+                claimed += 1
+        if claimed:
+            await asyncio.sleep(0)
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    # drena o que já saiu da fila antes de desligar
+    if inflight:
+        await asyncio.gather(*inflight, return_exceptions=True)
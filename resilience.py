@@ -0,0 +1,196 @@
+"""
+Circuit breakers e deadlines por upstream (stripe, graph, utmify, paypal),
+e token buckets para limitar a taxa de chamadas.
+
+Fechado: tudo passa. Depois de N falhas seguidas o breaker abre e as
+chamadas falham na hora (CircuitOpenError) por `reset_timeout` segundos;
+aí ele fica meio-aberto e deixa passar uma sonda: sucesso fecha, falha
+reabre. Estado exportado em /metrics (circuit_breaker_state).
+"""
+import asyncio
+import os
+import threading
+import time
+
+import log
+import metrics
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Breaker aberto: a chamada nem foi feita."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"circuit breaker '{name}' aberto; tente de novo em {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+TRANSITIONS = metrics.Counter(
+    "circuit_breaker_transitions_total", "Mudanças de estado dos breakers", ("upstream", "state")
+)
+logger = log.get("breaker")
+
+REJECTIONS = metrics.Counter(
+    "circuit_breaker_rejections_total", "Chamadas recusadas com o breaker aberto", ("upstream",)
+)
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0, deadline: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.deadline = deadline
+        self.state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set(self, state: str):
+        if state != self.state:
+            self.state = state
+            TRANSITIONS.inc(upstream=self.name, state=state)
+            logger.warning("circuit breaker mudou de estado", upstream=self.name, state=state)
+
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def available(self) -> bool:
+        """True se uma chamada agora teria chance de passar (sem consumir a sonda)."""
+        with self._lock:
+            return self.state != OPEN or self.retry_after() == 0
+
+    def before_call(self):
+        """Reserva a passagem ou levanta CircuitOpenError."""
+        with self._lock:
+            if self.state == OPEN and self.retry_after() == 0:
+                self._set(HALF_OPEN)
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                REJECTIONS.inc(upstream=self.name)
+                raise CircuitOpenError(self.name, self.retry_after() or self.reset_timeout)
+            if self.state == HALF_OPEN:
+                self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._probing = False
+            if self.state != OPEN:  # resposta atrasada de antes da abertura não fecha o breaker
+                self._failures = 0
+                self._set(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set(OPEN)
+
+    async def call(self, fn, *args, is_failure=None, **kwargs):
+        """
+        Executa `await fn(*args, **kwargs)` sob o breaker e o deadline.
+        `is_failure(resultado)` marca respostas ruins (ex.: HTTP 5xx) como falha
+        sem levantar exceção.
+        """
+        self.before_call()
+        try:
+            result = await asyncio.wait_for(fn(*args, **kwargs), self.deadline)
+        except asyncio.CancelledError:
+            with self._lock:
+                self._probing = False
+            raise
+        except Exception:
+            self.record_failure()
+            raise
+        if is_failure is not None and is_failure(result):
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+
+class TokenBucket:
+    """
+    Limite de taxa: `rate` fichas por segundo, acumulando até `burst`.
+    reserve() é thread-safe e nunca recusa: devolve quanto esperar.
+
+    Adaptativo: throttle() (o upstream respondeu 429) pausa o balde e corta
+    a taxa pela metade; cada recover() devolve um pouco até a taxa
+    configurada. Assim a taxa assenta perto do limite real do upstream.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.max_rate = self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Consome uma ficha; devolve os segundos até ela valer (0 = já)."""
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def throttle(self, pause: float):
+        """Upstream recusou por taxa: ninguém passa por `pause` s e a taxa cai pela metade."""
+        with self._lock:
+            self._refill()
+            # os 429 das chamadas que já estavam no ar contam como um só
+            if self._updated >= self._paused_until:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+            self._paused_until = max(self._paused_until, self._updated + pause)
+            self._tokens = min(self._tokens, -pause * self.rate)
+
+    def recover(self):
+        """Chamada aceita: a taxa volta aos poucos para a configurada."""
+        if self.rate < self.max_rate:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+    def saturation(self) -> float:
+        """0 = balde cheio, 1 = vazio; acima de 1 há chamadas na fila esperando ficha."""
+        with self._lock:
+            self._refill()
+            return 1 - self._tokens / self.capacity
+
+
+def _breaker(name: str, failures: int, reset: float, deadline: float = None) -> CircuitBreaker:
+    prefix = f"BREAKER_{name.upper()}_"
+    deadline = os.getenv(prefix + "DEADLINE", deadline)
+    return CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv(prefix + "FAILURES", failures)),
+        reset_timeout=float(os.getenv(prefix + "RESET_SECONDS", reset)),
+        deadline=float(deadline) if deadline is not None else None,
+    )
+
+
+# stripe: sem deadline aqui, os timeouts ficam no cliente HTTP do SDK (upstreams.HTTP_CONFIG)
+BREAKERS = {
+    "stripe": _breaker("stripe", failures=10, reset=15.0),
+    "graph":  _breaker("graph",  failures=5,  reset=30.0, deadline=12.0),
+    "utmify": _breaker("utmify", failures=5,  reset=30.0, deadline=12.0),
+    "paypal": _breaker("paypal", failures=5,  reset=30.0, deadline=20.0),
+}
+
+metrics.Gauge(
+    "circuit_breaker_state", "Estado do breaker (0=fechado, 1=meio-aberto, 2=aberto)", ("upstream",),
+    collect=lambda: {(name,): _STATE_VALUE[b.state] for name, b in BREAKERS.items()},
+)
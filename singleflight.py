@@ -0,0 +1,70 @@
+"""
+Single-flight: requisições iguais e simultâneas compartilham uma única
+execução, e o resultado fica num cache curto para os retries que chegam
+logo depois (ex.: os 3-4 toques no botão de upsell no celular).
+
+É por processo; entre workers quem segura a cobrança dupla continua sendo
+o idempotency_key da Stripe.
+"""
+import asyncio
+import time
+
+import metrics
+
+REQUESTS = metrics.Counter(
+    "singleflight_requests_total", "Chamadas ao single-flight (leader executa, shared/cached reaproveitam)",
+    ("name", "result"),
+)
+
+
+class SingleFlight:
+    def __init__(self, name: str, ttl: float, maxsize: int = 10000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._inflight = {}   # key -> Future
+        self._results = {}    # key -> (expires_at, resultado)
+
+    def _cached(self, key):
+        hit = self._results.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= time.monotonic():
+            del self._results[key]
+            return None
+        return hit
+
+    def _store(self, key, value):
+        now = time.monotonic()
+        if len(self._results) >= self.maxsize:
+            self._results = {k: v for k, v in self._results.items() if v[0] > now}
+            if len(self._results) >= self.maxsize:
+                self._results.pop(next(iter(self._results)))
+        self._results[key] = (now + self.ttl, value)
+
+    async def do(self, key, fn, cache_if=lambda result: True):
+        """
+        `await fn()` uma vez por `key`; quem chega durante a execução espera
+        o mesmo resultado (ou a mesma exceção). Resultados com
+        `cache_if(resultado)` verdadeiro ficam `ttl` segundos em cache.
+        """
+        hit = self._cached(key)
+        if hit is not None:
+            REQUESTS.inc(name=self.name, result="cached")
+            return hit[1]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            REQUESTS.inc(name=self.name, result="shared")
+            # shield: um cliente que desconecta não cancela a execução dos outros
+            return await asyncio.shield(future)
+
+        REQUESTS.inc(name=self.name, result="leader")
+        future = self._inflight[key] = asyncio.ensure_future(fn())
+        future.add_done_callback(lambda f: self._finish(key, f, cache_if))
+        return await asyncio.shield(future)
+
+    def _finish(self, key, future, cache_if):
+        self._inflight.pop(key, None)
+        if not future.cancelled() and future.exception() is None and cache_if(future.result()):
+            self._store(key, future.result())
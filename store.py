@@ -0,0 +1,123 @@
+"""
+Estado local durável (SQLite em modo WAL).
+
+Cada módulo registra o próprio schema com register_schema(); connect()
+devolve uma conexão por thread (o pool da Stripe também grava aqui) já
+com todos os schemas aplicados. É o estado compartilhado entre os workers
+do uvicorn (--workers): caches, dedup e filas vivem aqui, não em memória.
+
+As filas (webhooks, outbox) só valem como confirmação para a Stripe/PayPal
+se o arquivo sobrevive a restart e deploy. DURABLE diz se é o caso:
+STATE_DB_DURABLE=1/0 força; no padrão (auto) é durável com STATE_DB_PATH
+definido e fora do Heroku (DYNO), cujo disco é apagado a cada restart. Sem
+store durável o app processa webhooks e IPNs antes de responder. Ver DEPLOY.md.
+
+No event loop a espera por lock é curta (STATE_DB_LOOP_BUSY_TIMEOUT): lock
+ocupado vira erro (503 nas rotas) em vez de travar o worker. Os loops das
+filas fazem o claim e a contabilidade em threads (asyncio.to_thread).
+"""
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+STATE_DB_DURABLE = os.getenv("STATE_DB_DURABLE", "auto")   # auto | 1 | 0
+
+if STATE_DB_DURABLE == "auto":
+    DURABLE = "STATE_DB_PATH" in os.environ and not os.getenv("DYNO")
+else:
+    DURABLE = STATE_DB_DURABLE == "1"
+
+# espera por lock de escrita entre processos (s): threads vs event loop
+STATE_DB_BUSY_TIMEOUT      = float(os.getenv("STATE_DB_BUSY_TIMEOUT", "30"))
+STATE_DB_LOOP_BUSY_TIMEOUT = float(os.getenv("STATE_DB_LOOP_BUSY_TIMEOUT", "0.25"))
+
+# identifica este processo nos leases
+OWNER = f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_schemas = []
+_local = threading.local()
+
+
+def register_schema(sql: str):
+    """Registra DDL idempotente (CREATE ... IF NOT EXISTS) para o banco local."""
+    _schemas.append(sql)
+
+
+def connect() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(STATE_DB_PATH, timeout=STATE_DB_BUSY_TIMEOUT, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.applied = 0
+        _local.busy_ms = int(STATE_DB_BUSY_TIMEOUT * 1000)
+    # no event loop a espera por lock trava o worker inteiro: lá ela é curta
+    # (e o lock ocupado vira 503, ver busy()); em threads espera o normal
+    busy_ms = int((STATE_DB_LOOP_BUSY_TIMEOUT if _on_loop() else STATE_DB_BUSY_TIMEOUT) * 1000)
+    if busy_ms != _local.busy_ms:
+        conn.execute(f"PRAGMA busy_timeout = {busy_ms}")
+        _local.busy_ms = busy_ms
+    # aplica schemas registrados depois que a conexão foi aberta
+    while _local.applied < len(_schemas):
+        conn.executescript(_schemas[_local.applied])
+        _local.applied += 1
+    return conn
+
+
+def _on_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def busy(exc: BaseException) -> bool:
+    """O erro é lock do SQLite ocupado por outro processo (vale tentar de novo)."""
+    return isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc))
+
+
+@contextmanager
+def transaction():
+    """BEGIN IMMEDIATE ... COMMIT: trava de escrita curta, segura entre processos."""
+    conn = connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+
+register_schema("""
+CREATE TABLE IF NOT EXISTS leases (
+    name       TEXT PRIMARY KEY,
+    owner      TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+""")
+
+
+def claim(name: str, seconds: float) -> bool:
+    """Lease nomeado entre processos: True se este processo ficou com ele por `seconds`."""
+    now = time.time()
+    cur = connect().execute(
+        "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+        "WHERE leases.expires_at <= ? OR leases.owner = excluded.owner",
+        (name, OWNER, now + seconds, now),
+    )
+    return cur.rowcount == 1
+
+
+def release(name: str):
+    connect().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, OWNER))
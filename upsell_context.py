@@ -0,0 +1,58 @@
+"""
+Contexto do upsell 1-click por sessão do Checkout (customer, payment
+method e UTMs).
+
+Gravado pelo handler do checkout.session.completed, assim o
+/upsell/intent só precisa do PaymentIntent.create. Se o clique chegar antes
+do webhook, o endpoint monta o contexto pelo caminho antigo e grava aqui
+(cliques seguintes já saem rápidos). Fica no SQLite local para valer em
+todos os workers; as entradas expiram por TTL.
+"""
+import os
+import time
+
+import fastjson
+import metrics
+import store
+
+UPSELL_CONTEXT_TTL_SECONDS = float(os.getenv("UPSELL_CONTEXT_TTL_SECONDS", str(6 * 3600)))
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS upsell_context (
+    sid            TEXT PRIMARY KEY,
+    customer_id    TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    metadata       TEXT NOT NULL,
+    expires_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS upsell_context_expiry ON upsell_context (expires_at);
+""")
+
+LOOKUPS = metrics.Counter("upsell_context_lookups_total", "Consultas ao contexto de upsell", ("result",))
+
+
+def put(sid: str, customer_id: str, payment_method: str, metadata: dict):
+    now = time.time()
+    conn = store.connect()
+    conn.execute(
+        "INSERT OR REPLACE INTO upsell_context (sid, customer_id, payment_method, metadata, expires_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (sid, customer_id, payment_method, fastjson.dumps_str(dict(metadata or {})), now + UPSELL_CONTEXT_TTL_SECONDS),
+    )
+    conn.execute("DELETE FROM upsell_context WHERE expires_at <= ?", (now,))
+
+
+def get(sid: str):
+    """{"customer_id", "payment_method", "metadata"} da sessão, ou None."""
+    row = store.connect().execute(
+        "SELECT customer_id, payment_method, metadata FROM upsell_context WHERE sid = ? AND expires_at > ?",
+        (sid, time.time()),
+    ).fetchone()
+    LOOKUPS.inc(result="miss" if row is None else "hit")
+    if row is None:
+        return None
+    return {
+        "customer_id":    row["customer_id"],
+        "payment_method": row["payment_method"],
+        "metadata":       fastjson.loads(row["metadata"]),
+    }
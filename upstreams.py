@@ -0,0 +1,341 @@
+"""
+Camada de I/O assíncrona para os serviços externos usados pelo main.py.
+
+- Graph (Meta CAPI), UTMify e PayPal IPN usam um httpx.AsyncClient
+  compartilhado por destino, com pool keep-alive, limites e timeouts
+  explícitos (HTTP_CONFIG) e HTTP/2 onde o upstream suporta.
+- O SDK da Stripe é síncrono: as chamadas rodam num ThreadPoolExecutor
+  limitado, assim uma Stripe lenta não trava o event loop do uvicorn. O
+  stripe.default_http_client usa uma requests.Session única com pool do
+  tamanho do executor, em vez de uma sessão por thread.
+- Toda chamada passa pelo circuit breaker do upstream (resilience.py):
+  com o breaker aberto ela falha na hora, sem segurar conexão nem thread.
+- Toda chamada é cronometrada em /metrics por upstream e operação
+  (ex.: stripe.Invoice.finalize_invoice, utmify.order).
+- As chamadas à Stripe passam por um token bucket por classe de operação
+  (read/write/search, STRIPE_RATE_LIMITS). Um 429 segura a classe pelo
+  Retry-After (ou backoff exponencial com jitter), reduz a taxa do balde e
+  é repetido com os mesmos headers, ou seja, com o mesmo Idempotency-Key,
+  em vez de estourar no handler.
+"""
+import asyncio
+import contextvars
+import functools
+import importlib.util
+import os
+import random
+import re
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import httpx
+import requests
+import stripe
+from requests.adapters import HTTPAdapter
+
+import fastjson
+import metrics
+from resilience import BREAKERS, CircuitOpenError, TokenBucket
+
+# Env vars
+PIXEL_ID               = os.getenv("PIXEL_ID")
+ACCESS_TOKEN           = os.getenv("ACCESS_TOKEN")
+UTMIFY_API_URL         = os.getenv("UTMIFY_API_URL")
+UTMIFY_API_KEY         = os.getenv("UTMIFY_API_KEY")
+GRAPH_API_URL          = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v14.0")
+PAYPAL_IPN_URL         = os.getenv("PAYPAL_IPN_URL", "https://ipnpb.paypal.com/cgi-bin/webscr")
+STRIPE_MAX_CONCURRENCY = int(os.getenv("STRIPE_MAX_CONCURRENCY", "16"))
+HTTP2_ENABLED          = os.getenv("HTTP2_ENABLED", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+STRIPE_API_BASE        = os.getenv("STRIPE_API_BASE")   # ex.: stub local nos benchmarks
+WEB_CONCURRENCY        = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))   # workers do uvicorn (Procfile)
+
+# operações/s por classe para o deploy todo, divididas entre os workers (a
+# Stripe limita ~100/s de leitura e de escrita em live e 20/s de search;
+# deixa folga para o backfill)
+STRIPE_RATE_LIMITS = {
+    "read":   float(os.getenv("STRIPE_RATE_READ", "50")) / WEB_CONCURRENCY,
+    "write":  float(os.getenv("STRIPE_RATE_WRITE", "50")) / WEB_CONCURRENCY,
+    "search": float(os.getenv("STRIPE_RATE_SEARCH", "10")) / WEB_CONCURRENCY,
+}
+STRIPE_429_RETRIES   = int(os.getenv("STRIPE_429_RETRIES", "5"))
+STRIPE_429_MAX_DELAY = float(os.getenv("STRIPE_429_MAX_DELAY", "20"))
+
+
+def _cfg(name: str, connect: float, read: float, pool: int, keepalive: int, http2: bool) -> dict:
+    # cada valor pode ser sobrescrito por env, ex.: HTTP_GRAPH_READ_TIMEOUT=5
+    prefix = f"HTTP_{name.upper()}_"
+    return {
+        "connect":   float(os.getenv(prefix + "CONNECT_TIMEOUT", connect)),
+        "read":      float(os.getenv(prefix + "READ_TIMEOUT", read)),
+        "pool":      int(os.getenv(prefix + "MAX_CONNECTIONS", pool)),
+        "keepalive": int(os.getenv(prefix + "MAX_KEEPALIVE", keepalive)),
+        "http2":     http2 and HTTP2_ENABLED,
+    }
+
+
+# destino -> timeouts (s), tamanho do pool e HTTP/2
+HTTP_CONFIG = {
+    "graph":  _cfg("graph",  connect=3.0, read=10.0, pool=20, keepalive=10, http2=True),
+    "utmify": _cfg("utmify", connect=3.0, read=10.0, pool=20, keepalive=10, http2=False),
+    "paypal": _cfg("paypal", connect=3.0, read=15.0, pool=10, keepalive=5,  http2=False),
+    "stripe": _cfg("stripe", connect=5.0, read=30.0, pool=STRIPE_MAX_CONCURRENCY, keepalive=STRIPE_MAX_CONCURRENCY, http2=False),
+}
+
+UPSTREAM_DURATION = metrics.Histogram(
+    "upstream_request_duration_seconds", "Duração das chamadas externas", ("upstream", "operation")
+)
+UPSTREAM_ERRORS = metrics.Counter(
+    "upstream_errors_total", "Erros nas chamadas externas", ("upstream", "operation", "kind")
+)
+UPSTREAM_IN_FLIGHT = metrics.Gauge(
+    "upstream_requests_in_flight", "Chamadas externas em andamento", ("upstream",)
+)
+
+
+@contextmanager
+def observe(upstream: str, operation: str):
+    """Cronometra uma chamada externa e conta exceções por tipo."""
+    UPSTREAM_IN_FLIGHT.inc(upstream=upstream)
+    started = time.perf_counter()
+    try:
+        yield
+    except CircuitOpenError:
+        UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation, kind="circuit_open")
+        raise
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation, kind=type(e).__name__)
+        raise
+    finally:
+        UPSTREAM_DURATION.observe(time.perf_counter() - started, upstream=upstream, operation=operation)
+        UPSTREAM_IN_FLIGHT.dec(upstream=upstream)
+
+
+def _count_status(upstream: str, operation: str, status: int):
+    if status >= 400:
+        UPSTREAM_ERRORS.inc(upstream=upstream, operation=operation, kind=f"http_{status // 100}xx")
+
+
+# (método, path normalizado) -> nome da operação no SDK
+_STRIPE_OPERATIONS = {
+    ("POST",   "/v1/checkout/sessions"):                "checkout.Session.create",
+    ("GET",    "/v1/checkout/sessions"):                "checkout.Session.list",
+    ("GET",    "/v1/checkout/sessions/{id}"):           "checkout.Session.retrieve",
+    ("GET",    "/v1/checkout/sessions/{id}/line_items"): "checkout.Session.list_line_items",
+    ("POST",   "/v1/customers"):                        "Customer.create",
+    ("GET",    "/v1/customers/{id}"):                   "Customer.retrieve",
+    ("POST",   "/v1/customers/{id}"):                   "Customer.modify",
+    ("GET",    "/v1/events"):                           "Event.list",
+    ("GET",    "/v1/prices"):                           "Price.list",
+    ("GET",    "/v1/prices/{id}"):                      "Price.retrieve",
+    ("GET",    "/v1/products/{id}"):                    "Product.retrieve",
+    ("POST",   "/v1/payment_intents"):                  "PaymentIntent.create",
+    ("GET",    "/v1/payment_intents/{id}"):             "PaymentIntent.retrieve",
+    ("GET",    "/v1/invoiceitems"):                     "InvoiceItem.list",
+    ("POST",   "/v1/invoiceitems"):                     "InvoiceItem.create",
+    ("DELETE", "/v1/invoiceitems/{id}"):                "InvoiceItem.delete",
+    ("GET",    "/v1/invoices"):                         "Invoice.list",
+    ("GET",    "/v1/invoices/search"):                  "Invoice.search",
+    ("POST",   "/v1/invoices"):                         "Invoice.create",
+    ("GET",    "/v1/invoices/{id}"):                    "Invoice.retrieve",
+    ("POST",   "/v1/invoices/{id}"):                    "Invoice.modify",
+    ("POST",   "/v1/invoices/{id}/finalize"):           "Invoice.finalize_invoice",
+    ("POST",   "/v1/invoices/{id}/pay"):                "Invoice.pay",
+}
+STRIPE_BUCKETS = {op_class: TokenBucket(rate) for op_class, rate in STRIPE_RATE_LIMITS.items()}
+
+STRIPE_THROTTLE_WAIT = metrics.Histogram(
+    "stripe_rate_limit_wait_seconds", "Espera por ficha do token bucket antes de chamar a Stripe", ("op_class",)
+)
+STRIPE_RATE_LIMITED = metrics.Counter(
+    "stripe_rate_limited_total", "Respostas 429 da Stripe (retried = repetida, gave_up = desistiu)",
+    ("op_class", "result"),
+)
+metrics.Gauge(
+    "stripe_rate_limit_saturation", "Uso do token bucket da Stripe (0 = livre, >1 = chamadas esperando)",
+    ("op_class",),
+    collect=lambda: {(op_class,): b.saturation() for op_class, b in STRIPE_BUCKETS.items()},
+)
+metrics.Gauge(
+    "stripe_rate_limit_current", "Taxa atual do token bucket da Stripe (cai a cada 429, volta aos poucos)",
+    ("op_class",),
+    collect=lambda: {(op_class,): b.rate for op_class, b in STRIPE_BUCKETS.items()},
+)
+
+# ids da Stripe: prefixo + sufixo com dígito/maiúscula (não casa "line_items")
+_STRIPE_ID = re.compile(r"/[a-z]+_(?=[A-Za-z0-9_]*[A-Z0-9])[A-Za-z0-9_]+(?=/|$)")
+
+
+def stripe_operation(method: str, url: str) -> str:
+    """Nome estável (sem ids) para a métrica de uma chamada à API da Stripe."""
+    path = _STRIPE_ID.sub("/{id}", urllib.parse.urlsplit(url).path)
+    method = method.upper()
+    return "stripe." + _STRIPE_OPERATIONS.get((method, path), f"{method} {path}")
+
+
+def stripe_operation_class(method: str, url: str) -> str:
+    """Classe do rate limit da Stripe: search, read (GET) ou write."""
+    if urllib.parse.urlsplit(url).path.endswith("/search"):
+        return "search"
+    return "read" if method.upper() == "GET" else "write"
+
+
+def _retry_delay(attempt: int, headers) -> float:
+    """Retry-After se a Stripe mandar; senão exponencial com jitter (0.5s, 1s, 2s...)."""
+    try:
+        delay = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        delay = 0.5 * 2 ** attempt
+    # jitter para os workers não voltarem todos no mesmo instante
+    return min(STRIPE_429_MAX_DELAY, delay * random.uniform(1.0, 1.5))
+
+
+_clients = {}
+_stripe_pool = ThreadPoolExecutor(
+    max_workers=STRIPE_MAX_CONCURRENCY,
+    thread_name_prefix="stripe",
+)
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """Devolve o cliente compartilhado do destino `name` (graph, utmify, paypal)."""
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        cfg = HTTP_CONFIG[name]
+        client = _clients[name] = httpx.AsyncClient(
+            timeout=httpx.Timeout(cfg["read"], connect=cfg["connect"]),
+            limits=httpx.Limits(
+                max_connections=cfg["pool"],
+                max_keepalive_connections=cfg["keepalive"],
+                keepalive_expiry=30.0,
+            ),
+            http2=cfg["http2"],
+        )
+    return client
+
+
+class GuardedRequestsClient(stripe.RequestsClient):
+    """RequestsClient do SDK com rate limit, retry de 429 e o circuit breaker da Stripe."""
+
+    def request(self, method, url, headers, post_data=None):
+        op_class = stripe_operation_class(method, url)
+        operation = stripe_operation(method, url)
+        for attempt in range(STRIPE_429_RETRIES + 1):
+            wait = STRIPE_BUCKETS[op_class].reserve()
+            STRIPE_THROTTLE_WAIT.observe(wait, op_class=op_class)
+            if wait:
+                time.sleep(wait)   # roda numa thread do _stripe_pool
+            # mesmos headers a cada tentativa: o Idempotency-Key do SDK (ou o
+            # nosso idempotency_key) vale para o retry também
+            content, status, resp_headers = self._guarded(method, url, operation, headers, post_data)
+            if status != 429:
+                STRIPE_BUCKETS[op_class].recover()
+                break
+            if attempt == STRIPE_429_RETRIES:
+                STRIPE_RATE_LIMITED.inc(op_class=op_class, result="gave_up")
+                break
+            STRIPE_RATE_LIMITED.inc(op_class=op_class, result="retried")
+            # o limite é da conta: segura a classe inteira, não só esta chamada
+            STRIPE_BUCKETS[op_class].throttle(_retry_delay(attempt, resp_headers))
+        return content, status, resp_headers
+
+    def _guarded(self, method, url, operation, headers, post_data):
+        breaker = BREAKERS["stripe"]
+        try:
+            with observe("stripe", operation):
+                breaker.before_call()
+                try:
+                    content, status, resp_headers = super().request(method, url, headers, post_data)
+                except stripe.error.APIConnectionError:
+                    breaker.record_failure()
+                    raise
+        except CircuitOpenError as e:
+            raise stripe.error.APIConnectionError(str(e), should_retry=False) from e
+        _count_status("stripe", operation, status)
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return content, status, resp_headers
+
+
+def configure_stripe_http():
+    """Sessão requests única (pool keep-alive) e timeouts para o SDK da Stripe."""
+    cfg = HTTP_CONFIG["stripe"]
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cfg["pool"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    stripe.default_http_client = GuardedRequestsClient(
+        timeout=(cfg["connect"], cfg["read"]),
+        session=session,
+    )
+    if STRIPE_API_BASE:
+        stripe.api_base = STRIPE_API_BASE
+
+
+configure_stripe_http()
+
+
+async def aclose():
+    """Fecha os clientes HTTP (chamado no shutdown do app)."""
+    for client in list(_clients.values()):
+        await client.aclose()
+    _clients.clear()
+
+
+async def stripe_call(fn, *args, **kwargs):
+    """Executa uma chamada síncrona do SDK da Stripe no pool de threads."""
+    loop = asyncio.get_running_loop()
+    # leva o contextvars da task junto (ids de correlação do log)
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(_stripe_pool, functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+def _unhealthy(resp: httpx.Response) -> bool:
+    # 5xx e 429 contam como falha para o breaker; 4xx é problema do payload
+    return resp.status_code >= 500 or resp.status_code == 429
+
+
+async def _post(upstream: str, operation: str, url: str, **kwargs) -> httpx.Response:
+    with observe(upstream, operation):
+        resp = await BREAKERS[upstream].call(get_client(upstream).post, url, is_failure=_unhealthy, **kwargs)
+    _count_status(upstream, operation, resp.status_code)
+    return resp
+
+
+async def send_capi(payload: dict) -> httpx.Response:
+    """POST de eventos para a Conversions API (Meta)."""
+    return await _post(
+        "graph", "graph.events",
+        f"{GRAPH_API_URL}/{PIXEL_ID}/events",
+        params={"access_token": ACCESS_TOKEN},
+        headers={"Content-Type": "application/json"},
+        content=fastjson.dumps(payload),
+    )
+
+
+async def send_utmify(order: dict) -> httpx.Response:
+    """POST de um pedido (order) para a UTMify."""
+    return await _post(
+        "utmify", "utmify.order",
+        UTMIFY_API_URL,
+        headers={
+            "Content-Type": "application/json",
+            "x-api-token":  UTMIFY_API_KEY,
+        },
+        content=fastjson.dumps(order),
+    )
+
+
+async def verify_ipn(raw_body: bytes) -> str:
+    """Validação back-and-forth do IPN com o PayPal; devolve o texto da resposta."""
+    resp = await _post(
+        "paypal", "paypal.ipn_verify",
+        PAYPAL_IPN_URL,
+        content=b"cmd=_notify-validate&" + raw_body,
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    return resp.text
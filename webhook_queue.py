@@ -0,0 +1,330 @@
+"""
+Fila durável dos webhooks da Stripe (e dos IPNs do PayPal, tipo "paypal.ipn").
+
+O endpoint /webhook só valida a assinatura, grava o evento aqui e devolve
+200 em milissegundos (o /track-paypal idem; a validação do IPN com o
+PayPal fica para o worker). O pool de workers processa em background, com
+limite de concorrência por tipo de evento e retry com backoff. O id do
+evento é a chave primária, então reentregas que chegam enquanto o evento
+ainda está na fila não duplicam trabalho; as que chegam depois de processado
+são barradas pelo store de deduplicação (dedup.ProcessedStore).
+
+A Stripe já recebeu 200, então a fila faz o papel dos reenvios dela: o
+retry vai até WEBHOOK_RETRY_WINDOW (3 dias, como a Stripe) desde o
+recebimento. Breaker aberto não conta tentativa, só adia. O que passar da
+janela fica dead = 1 e volta com:
+
+    python webhook_queue.py dead
+    python webhook_queue.py requeue [--id evt_...] [--type checkout.session.completed]
+
+Sem store durável (store.DURABLE) os endpoints usam process_now() no lugar
+da fila e deixam o retry para a Stripe/PayPal.
+"""
+import argparse
+import asyncio
+import functools
+import os
+import random
+import sqlite3
+import time
+
+import fastjson
+import log
+import metrics
+import store
+from dedup import ProcessedStore
+from resilience import CircuitOpenError
+from singleflight import SingleFlight
+
+WEBHOOK_POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "0.5"))
+WEBHOOK_LEASE_SECONDS = float(os.getenv("WEBHOOK_LEASE_SECONDS", "300"))
+WEBHOOK_RETRY_WINDOW  = float(os.getenv("WEBHOOK_RETRY_WINDOW", str(3 * 24 * 3600)))
+WEBHOOK_MAX_ATTEMPTS  = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "0"))    # 0 = só a janela limita
+WEBHOOK_BACKOFF_MAX   = float(os.getenv("WEBHOOK_BACKOFF_MAX", "3600"))
+
+# workers simultâneos por tipo de evento
+CONCURRENCY = {
+    "checkout.session.completed": int(os.getenv("WEBHOOK_CONCURRENCY_CHECKOUT", "4")),
+    "payment_intent.succeeded":   int(os.getenv("WEBHOOK_CONCURRENCY_UPSELL", "8")),
+    "paypal.ipn":                 int(os.getenv("WEBHOOK_CONCURRENCY_PAYPAL", "4")),
+}
+DEFAULT_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY_DEFAULT", "2"))
+
+store.register_schema("""
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id              TEXT    PRIMARY KEY,
+    type            TEXT    NOT NULL,
+    payload         TEXT    NOT NULL,
+    received_at     REAL    NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL    NOT NULL,
+    locked_until    REAL    NOT NULL DEFAULT 0,
+    dead            INTEGER NOT NULL DEFAULT 0,
+    last_error      TEXT
+);
+CREATE INDEX IF NOT EXISTS webhook_events_due ON webhook_events (type, dead, next_attempt_at);
+""")
+
+
+def _collect_backlog():
+    rows = store.connect().execute(
+        "SELECT type, COUNT(*) AS n FROM webhook_events WHERE dead = 0 GROUP BY type"
+    ).fetchall()
+    return {(r["type"],): r["n"] for r in rows}
+
+
+def _collect_lag():
+    now = time.time()
+    rows = store.connect().execute(
+        "SELECT type, MIN(received_at) AS oldest FROM webhook_events WHERE dead = 0 GROUP BY type"
+    ).fetchall()
+    return {(r["type"],): round(now - r["oldest"], 3) for r in rows}
+
+
+BACKLOG = metrics.Gauge(
+    "webhook_backlog_events", "Eventos aguardando processamento", ("type",), collect=_collect_backlog
+)
+LAG = metrics.Gauge(
+    "webhook_lag_seconds", "Idade do evento mais antigo na fila", ("type",), collect=_collect_lag
+)
+PROCESSED = metrics.Counter(
+    "webhook_processed_total", "Eventos processados", ("type", "result")
+)
+PROCESSING = metrics.Histogram(
+    "webhook_processing_seconds", "Duração do processamento de cada evento", ("type",)
+)
+
+processed = ProcessedStore("stripe_event")
+_inline = SingleFlight("webhook_inline", ttl=0)   # process_now
+logger = log.get("webhook")
+
+_loop = None
+_wakeup = None
+
+
+def persist(event_id: str, event_type: str, payload) -> bool:
+    """
+    Grava o evento (JSON em bytes ou str) na fila. Devolve False se ele já foi
+    processado ou já estava lá.
+    """
+    if processed.seen(event_id):
+        return False
+    now = time.time()
+    cur = store.connect().execute(
+        "INSERT OR IGNORE INTO webhook_events (id, type, payload, received_at, next_attempt_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (event_id, event_type, payload, now, now),
+    )
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wakeup.set)
+    return cur.rowcount == 1
+
+
+async def process_now(handler, event_id: str, event_type: str, event: dict) -> bool:
+    """
+    Sem store durável (store.DURABLE falso) o evento não passa pela fila: é
+    processado antes da resposta e a falha sobe, para o endpoint responder 5xx
+    e a Stripe/PayPal reenviar. Devolve False se ele já tinha sido processado.
+    Reentregas simultâneas esperam a mesma execução (no processo) ou falham
+    enquanto outro worker tem o lease do evento.
+    """
+    return await _inline.do(event_id, lambda: _process_now(handler, event_id, event_type, event),
+                            cache_if=lambda result: False)
+
+
+async def _process_now(handler, event_id: str, event_type: str, event: dict) -> bool:
+    if processed.seen(event_id):
+        return False
+    lease = f"webhook:{event_id}"
+    if not store.claim(lease, WEBHOOK_LEASE_SECONDS):
+        raise RuntimeError(f"evento {event_id} em processamento em outro worker")
+    try:
+        with PROCESSING.time(type=event_type):
+            await handler(event)
+    except Exception:
+        PROCESSED.inc(type=event_type, result="error")
+        raise
+    finally:
+        store.release(lease)
+    processed.mark(event_id)
+    PROCESSED.inc(type=event_type, result="ok")
+    return True
+
+
+def _claim(event_type: str, limit: int) -> list:
+    now = time.time()
+    with store.transaction() as conn:
+        rows = conn.execute(
+            "SELECT id, type, payload, attempts, received_at FROM webhook_events "
+            "WHERE type = ? AND dead = 0 AND next_attempt_at <= ? AND locked_until <= ? "
+            "ORDER BY received_at LIMIT ?",
+            (event_type, now, now, limit),
+        ).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE webhook_events SET locked_until = ? WHERE id = ?",
+                [(now + WEBHOOK_LEASE_SECONDS, r["id"]) for r in rows],
+            )
+    return rows
+
+
+def _retry_later(row, error: str):
+    attempts = row["attempts"] + 1
+    delay = min(WEBHOOK_BACKOFF_MAX, 2 ** attempts) * random.uniform(0.5, 1.0)
+    dead = (time.time() + delay - row["received_at"] > WEBHOOK_RETRY_WINDOW
+            or 0 < WEBHOOK_MAX_ATTEMPTS <= attempts)
+    store.connect().execute(
+        "UPDATE webhook_events SET attempts = ?, next_attempt_at = ?, locked_until = 0, "
+        "dead = ?, last_error = ? WHERE id = ?",
+        (attempts, time.time() + delay, int(dead), error[:2000], row["id"]),
+    )
+    if dead:
+        logger.error("webhook descartado", event_id=row["id"], event_type=row["type"], attempts=attempts)
+
+
+def _postpone(row, delay: float):
+    # breaker aberto: volta para a fila sem contar tentativa
+    store.connect().execute(
+        "UPDATE webhook_events SET next_attempt_at = ?, locked_until = 0 WHERE id = ?",
+        (time.time() + delay, row["id"]),
+    )
+
+
+def _delete(event_id: str):
+    store.connect().execute("DELETE FROM webhook_events WHERE id = ?", (event_id,))
+
+
+def _circuit_open(exc):
+    """CircuitOpenError na cadeia da exceção (o SDK da Stripe a embrulha em APIConnectionError)."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        if isinstance(exc, CircuitOpenError):
+            return exc
+        seen.add(id(exc))
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+async def _process(handler, row):
+    log.bind(event_id=row["id"], event_type=row["type"])   # a task é só deste evento
+    try:
+        with PROCESSING.time(type=row["type"]):
+            await handler(fastjson.loads(row["payload"]))
+    except asyncio.CancelledError:
+        # shutdown passou do prazo: devolve o evento já, sem esperar o lease
+        store.connect().execute("UPDATE webhook_events SET locked_until = 0 WHERE id = ?", (row["id"],))
+        raise
+    except Exception as e:
+        open_breaker = _circuit_open(e)
+        if open_breaker is not None:
+            logger.warning("breaker aberto; evento adiado", breaker=open_breaker.name,
+                           retry_after=open_breaker.retry_after)
+            await asyncio.to_thread(_postpone, row, open_breaker.retry_after)
+            PROCESSED.inc(type=row["type"], result="postponed")
+            return
+        logger.exception("falha ao processar webhook", error=repr(e), attempt=row["attempts"] + 1)
+        await asyncio.to_thread(_retry_later, row, repr(e))
+        PROCESSED.inc(type=row["type"], result="error")
+    else:
+        try:
+            processed.mark(row["id"])
+        except sqlite3.OperationalError as e:
+            if not store.busy(e):
+                raise
+            # sem a marca uma reentrega reprocessa; os efeitos com once não se repetem
+            logger.warning("evento processado sem marca de dedup (SQLite ocupado)", error=str(e))
+        await asyncio.to_thread(_delete, row["id"])
+        PROCESSED.inc(type=row["type"], result="ok")
+
+
+async def run_workers(stop: asyncio.Event, handlers: dict):
+    """
+    Pool de workers: `handlers` mapeia tipo de evento -> coroutine(event_dict).
+    Roda até `stop` ser setado; no shutdown espera os eventos em andamento.
+    """
+    global _loop, _wakeup
+    _loop = asyncio.get_running_loop()
+    _wakeup = asyncio.Event()
+    busy = {t: 0 for t in handlers}
+    inflight = set()
+
+    def _finished(event_type, task):
+        inflight.discard(task)
+        busy[event_type] -= 1
+        _wakeup.set()
+
+    while not stop.is_set():
+        _wakeup.clear()
+        claimed = 0
+        for event_type, handler in handlers.items():
+            free = CONCURRENCY.get(event_type, DEFAULT_CONCURRENCY) - busy[event_type]
+            if free <= 0:
+                continue
+            try:
+                # BEGIN IMMEDIATE disputado entre workers: espera numa thread, não no loop
+                rows = await asyncio.to_thread(_claim, event_type, free)
+            except sqlite3.OperationalError as e:
+                if not store.busy(e):
+                    raise
+                logger.warning("claim adiado (SQLite ocupado)", event_type=event_type)
+                continue
+            for row in rows:
+                busy[event_type] += 1
+                task = asyncio.create_task(_process(handler, row))
+                inflight.add(task)
+                task.add_done_callback(functools.partial(_finished, event_type))
+                claimed += 1
+        if claimed:
+            await asyncio.sleep(0)
+            continue
+        try:
+            await asyncio.wait_for(_wakeup.wait(), WEBHOOK_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    if inflight:
+        await asyncio.gather(*inflight, return_exceptions=True)
+
+
+def dead_events(event_type: str = None) -> list:
+    sql = "SELECT id, type, received_at, attempts, last_error FROM webhook_events WHERE dead = 1"
+    args = ()
+    if event_type:
+        sql, args = sql + " AND type = ?", (event_type,)
+    return store.connect().execute(sql + " ORDER BY received_at", args).fetchall()
+
+
+def requeue(ids: list = None, event_type: str = None) -> int:
+    """Volta eventos descartados para a fila, com tentativas zeradas e uma janela nova."""
+    sql = "UPDATE webhook_events SET dead = 0, attempts = 0, next_attempt_at = ?, received_at = ?, locked_until = 0 WHERE dead = 1"
+    now = time.time()
+    args = [now, now]
+    if ids:
+        sql += f" AND id IN ({','.join('?' * len(ids))})"
+        args += list(ids)
+    if event_type:
+        sql += " AND type = ?"
+        args.append(event_type)
+    return store.connect().execute(sql, args).rowcount
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fila de webhooks (Stripe e IPNs do PayPal)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("dead", help="lista os eventos descartados")
+    p.add_argument("--type")
+    p = sub.add_parser("requeue", help="volta eventos descartados para a fila (o app processa)")
+    p.add_argument("--id", action="append", help="só estes eventos (repetível); padrão: todos")
+    p.add_argument("--type")
+    args = parser.parse_args()
+
+    if args.command == "dead":
+        for r in dead_events(args.type):
+            received = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(r["received_at"]))
+            print(f"{r['id']}  {r['type']}  {received}Z  {r['attempts']} tentativas  {(r['last_error'] or '')[:120]}")
+        return
+    print(f"→ {requeue(args.id, args.type)} eventos de volta na fila")
+
+
+if __name__ == "__main__":
+    main()